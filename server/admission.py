@@ -0,0 +1,197 @@
+"""
+Admission Control
+Caps how many LLM calls run at once across all connections. Calls over the cap wait in a
+weighted fair queue, where every user is a flow weighted by their tier, so a few users
+with long transcripts cannot starve everyone else. Calls that cannot start within the
+deadline are shed with AdmissionRejected.
+"""
+
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from metrics import QUEUE_SHED, QUEUE_WAIT
+
+log = logging.getLogger("secretari.ws")
+
+QueueNotifier = Callable[[int, float], Awaitable[None]]     # (position, estimated wait in seconds)
+
+
+class AdmissionRejected(Exception):
+    """The call could not be started in time. Sent to the client as an "overloaded" error."""
+    code = "overloaded"
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class Flow:
+    """Who a call is made for. Calls of one flow share its fair share of the capacity."""
+    user: str
+    tier: str                                   # "subscriber", "balance" or "batch"
+    notify: Optional[QueueNotifier] = None      # told about queue position changes
+
+
+@dataclass(order=True)
+class _Waiter:
+    finish: float                               # virtual finish tag, the queue order
+    seq: int
+    start: float = field(compare=False)
+    flow: Flow = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    position: int = field(compare=False, default=-1)
+
+
+class AdmissionController:
+    """Global limit on concurrent LLM calls with weighted fair queuing"""
+
+    def __init__(self, limit: int = 32, deadline: float = 30.0, max_queue: int = 500,
+                 weights: Optional[dict[str, float]] = None):
+        self.limit = limit
+        self.deadline = deadline
+        self.max_queue = max_queue
+        self.weights = weights or {"subscriber": 2.0, "balance": 1.0, "batch": 0.25}
+        self.active = 0
+        self._queue: list[_Waiter] = []
+        self._virtual_time = 0.0
+        self._finish: dict[str, float] = {}     # last finish tag of every flow with queued calls
+        self._seq = itertools.count()
+        self._service_time = 5.0                # moving average of how long a call holds its slot
+        self._notifying: set[asyncio.Task] = set()     # queue status sends in flight, held so they are not collected
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. Called again by the hourly reload."""
+        self.limit = int(env.get("ADMISSION_LIMIT", "32"))
+        self.deadline = float(env.get("ADMISSION_DEADLINE", "30"))
+        self.max_queue = int(env.get("ADMISSION_MAX_QUEUE", "500"))
+        self.weights = {
+            "subscriber": float(env.get("ADMISSION_WEIGHT_SUBSCRIBER", "2")),
+            "balance": float(env.get("ADMISSION_WEIGHT_BALANCE", "1")),
+            "batch": float(env.get("ADMISSION_WEIGHT_BATCH", "0.25")),
+        }
+        while self._queue and self.active < self.limit:
+            self.active += 1
+            if not self._dispatch():
+                self.active -= 1
+
+    def load(self) -> float:
+        """Share of the slots in use, above 1 while calls are queued"""
+        return (self.active + len(self._queue)) / max(1, self.limit)
+
+    def estimated_wait(self, position: int) -> float:
+        return position * self._service_time / max(1, self.limit)
+
+    @asynccontextmanager
+    async def slot(self, flow: Flow):
+        """Hold one of the global slots for the duration of an LLM call"""
+        await self.acquire(flow)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    async def acquire(self, flow: Flow) -> None:
+        if self.active < self.limit and not self._queue:
+            self.active += 1
+            self.admitted += 1
+            QUEUE_WAIT.observe(0.0, flow.tier)
+            return
+
+        eta = self.estimated_wait(len(self._queue) + 1)
+        if len(self._queue) >= self.max_queue or eta > self.deadline:
+            self.shed += 1
+            QUEUE_SHED.inc(1, flow.tier)
+            raise AdmissionRejected("Server is busy. Please try again shortly.", eta)
+
+        weight = self.weights.get(flow.tier, 1.0)
+        start = max(self._virtual_time, self._finish.get(flow.user, 0.0))
+        waiter = _Waiter(start + 1 / weight, next(self._seq), start, flow, asyncio.get_running_loop().create_future())
+        self._finish[flow.user] = waiter.finish
+        bisect.insort(self._queue, waiter)
+        queued_at = time.monotonic()
+        self.queued += 1
+        self._notify_positions()
+
+        try:
+            # not wait_for, which in 3.11 swallows a cancel that comes after the slot was handed over
+            async with asyncio.timeout(self.deadline):
+                await waiter.future
+        except asyncio.TimeoutError:
+            self._withdraw(waiter)
+            self.shed += 1
+            QUEUE_SHED.inc(1, flow.tier)
+            raise AdmissionRejected("Server is busy. Please try again shortly.", self.estimated_wait(len(self._queue)))
+        except asyncio.CancelledError:
+            self._withdraw(waiter)
+            raise
+        self.admitted += 1
+        QUEUE_WAIT.observe(time.monotonic() - queued_at, flow.tier)
+
+    def release(self, held: float) -> None:
+        if held > 0:
+            self._service_time = 0.9 * self._service_time + 0.1 * held
+        if not self._dispatch():
+            self.active -= 1
+
+    def _dispatch(self) -> bool:
+        # hand a freed slot to the queued call with the smallest finish tag
+        while self._queue:
+            waiter = self._queue.pop(0)
+            if waiter.future.done():
+                continue
+            self._virtual_time = max(self._virtual_time, waiter.start)
+            waiter.future.set_result(True)
+            if not self._queue:
+                self._finish.clear()    # every flow is idle again
+            self._notify_positions()
+            return True
+        return False
+
+    def _withdraw(self, waiter: _Waiter) -> None:
+        if waiter.future.done() and not waiter.future.cancelled():
+            self.release(0.0)       # the slot was handed over just as the wait ended, pass it on
+        else:
+            self._remove(waiter)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        try:
+            self._queue.remove(waiter)
+        except ValueError:
+            pass
+        self._notify_positions()
+
+    def _notify_positions(self) -> None:
+        for position, waiter in enumerate(self._queue, start=1):
+            if waiter.position != position and waiter.flow.notify is not None:
+                waiter.position = position
+                task = asyncio.create_task(self._notify(waiter.flow.notify, position))
+                self._notifying.add(task)
+                task.add_done_callback(self._notifying.discard)
+
+    async def _notify(self, notify: QueueNotifier, position: int) -> None:
+        try:
+            await notify(position, round(self.estimated_wait(position), 1))
+        except Exception as e:
+            log.debug("Queue status not delivered: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued_now": len(self._queue),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+            "avg_call_seconds": round(self._service_time, 2),
+        }
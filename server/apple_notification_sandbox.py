@@ -43,6 +43,12 @@ def decode_renewal_info(payLoad):
     if payLoad.data and payLoad.data.signedRenewalInfo:
         return signed_data_verifier.verify_and_decode_signed_transaction(payLoad.data.signedRenewalInfo)
     
+async def update_account(lapi, write, userId: str, purchase: Purchase):
+    # under the user's lock like billing, so a recharge and a charge do not overwrite each other's balance
+    username = await lapi.get_user_name(userId)
+    async with lapi.user_lock(username or userId):
+        await write(userId, purchase)
+
 async def decode_notification(lapi, signedPayload):
     try:
         payLoad = signed_data_verifier.verify_and_decode_notification(signedPayload)
@@ -64,7 +70,7 @@ async def decode_notification(lapi, signedPayload):
                 transactionId = transaction.transactionId,
                 purchaseDate = transaction.purchaseDate/1000,       # convert to Python format
                 quantity = transaction.quantity)
-            lapi.recharge_user(transaction.appAccountToken.upper(), p)
+            await update_account(lapi, lapi.recharge_user, transaction.appAccountToken.upper(), p)
 
         elif payLoad.rawNotificationType == "SUBSCRIBED":
             transaction = decode_transaction_info(payLoad)
@@ -77,7 +83,7 @@ async def decode_notification(lapi, signedPayload):
                 transactionId = transaction.transactionId,
                 purchaseDate = transaction.purchaseDate/1000,       # convert to Python format
                 quantity = transaction.quantity)
-            lapi.subscribed(transaction.appAccountToken.upper(), p)
+            await update_account(lapi, lapi.subscribed, transaction.appAccountToken.upper(), p)
 
         elif payLoad.rawNotificationType == "DID_RENEW":
             transaction = decode_transaction_info(payLoad)
@@ -90,7 +96,7 @@ async def decode_notification(lapi, signedPayload):
                 transactionId = transaction.transactionId,
                 purchaseDate = transaction.purchaseDate/1000,       # convert to Python format
                 quantity = transaction.quantity)
-            lapi.subscribed(transaction.appAccountToken.upper(), p)
+            await update_account(lapi, lapi.subscribed, transaction.appAccountToken.upper(), p)
 
         elif payLoad.rawNotificationType == "REFUND":
             transaction = decode_transaction_info(payLoad)
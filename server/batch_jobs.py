@@ -0,0 +1,331 @@
+"""
+Batch Jobs
+Summaries of very long recordings as background jobs instead of one long WebSocket session.
+Jobs are kept in a local SQLite database, so queued jobs survive a restart and all workers of
+the host share one queue. A small pool of tasks per worker claims jobs one at a time, only
+while interactive load leaves room, and runs them at batch priority.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from metrics import BATCH_JOBS
+
+log = logging.getLogger("secretari.llm")
+
+STATES = ("queued", "running", "done", "failed", "cancelled")
+FINISHED = ("done", "failed", "cancelled")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    status TEXT NOT NULL,
+    request TEXT NOT NULL,          -- prompt, rawtext and parameters as JSON
+    created REAL NOT NULL,
+    not_before REAL NOT NULL,       -- not claimed before this time, for retries
+    started REAL,
+    finished REAL,
+    worker INTEGER,                 -- pid of the process running it
+    attempts INTEGER NOT NULL DEFAULT 0,
+    progress TEXT,                  -- chunks done, as JSON
+    result TEXT,
+    tokens INTEGER,
+    cost REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, not_before, created);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (username, created);
+"""
+
+
+@dataclass
+class Job:
+    id: str
+    username: str
+    status: str
+    request: dict
+    created: float
+    attempts: int = 0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    progress: Optional[dict] = None
+    result: Optional[str] = None
+    tokens: Optional[int] = None
+    cost: Optional[float] = None
+    error: Optional[str] = None
+
+    def public(self, with_result: bool = True) -> dict:
+        """What the owner sees. The transcript is not sent back."""
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "prompt_type": self.request.get("prompt_type"),
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": self.progress,
+        }
+        if self.status == "done":
+            job.update(tokens=self.tokens, cost=self.cost)
+            if with_result:
+                job["result"] = self.result
+        if self.error:
+            job["error"] = self.error
+        return job
+
+
+class JobStore:
+    """Jobs in SQLite. Every call is short, and safe from any thread or process."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._db() as db:
+            db.executescript(SCHEMA)
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)  # autocommit, explicit transactions
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        return Job(row["id"], row["username"], row["status"], json.loads(row["request"]), row["created"],
+                   row["attempts"], row["started"], row["finished"],
+                   json.loads(row["progress"]) if row["progress"] else None,
+                   row["result"], row["tokens"], row["cost"], row["error"])
+
+    def submit(self, username: str, request: dict) -> Job:
+        job = Job(uuid.uuid4().hex, username, "queued", request, time.time())
+        self._db().execute(
+            "INSERT INTO jobs (id, username, status, request, created, not_before) VALUES (?, ?, ?, ?, ?, ?)",
+            (job.id, username, job.status, json.dumps(request), job.created, job.created))
+        return job
+
+    def get(self, job_id: str, username: Optional[str] = None) -> Optional[Job]:
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (username is not None and row["username"] != username):
+            return None
+        return self._job(row)
+
+    def list(self, username: str, limit: int = 20) -> list[Job]:
+        rows = self._db().execute("SELECT * FROM jobs WHERE username = ? ORDER BY created DESC LIMIT ?",
+                                  (username, limit)).fetchall()
+        return [self._job(r) for r in rows]
+
+    def pending(self, username: str) -> int:
+        """Jobs of the user that are queued or running"""
+        return self._db().execute("SELECT COUNT(*) FROM jobs WHERE username = ? AND status IN ('queued', 'running')",
+                                  (username,)).fetchone()[0]
+
+    def claim(self, worker: int) -> Optional[Job]:
+        """Take the oldest queued job that is due. One process wins when several try at once."""
+        now = time.time()
+        row = self._db().execute(
+            "UPDATE jobs SET status = 'running', worker = ?, started = ?, attempts = attempts + 1 "
+            "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND not_before <= ? ORDER BY created LIMIT 1) "
+            "AND status = 'queued' RETURNING *", (worker, now, now)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def progress(self, job_id: str, progress: dict) -> None:
+        self._db().execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def finish(self, job_id: str, status: str, result: Optional[str] = None, tokens: Optional[int] = None,
+               cost: Optional[float] = None, error: Optional[str] = None) -> None:
+        # a job cancelled while it ran stays cancelled
+        self._db().execute(
+            "UPDATE jobs SET status = ?, finished = ?, result = ?, tokens = ?, cost = ?, error = ? "
+            "WHERE id = ? AND status = 'running'", (status, time.time(), result, tokens, cost, error, job_id))
+
+    def retry(self, job_id: str, delay: float) -> None:
+        self._db().execute("UPDATE jobs SET status = 'queued', worker = NULL, not_before = ? "
+                           "WHERE id = ? AND status = 'running'", (time.time() + delay, job_id))
+
+    def cancel(self, job_id: str, username: str) -> bool:
+        cursor = self._db().execute(
+            "UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND username = ? "
+            "AND status IN ('queued', 'running')", (time.time(), job_id, username))
+        return cursor.rowcount > 0
+
+    def recover(self, at_start: bool = True) -> int:
+        """
+        Put jobs of processes that died back in the queue. Returns how many.
+        At start, jobs of our own pid are left from an earlier process that had it, later they are ours.
+        """
+        rows = self._db().execute("SELECT id, worker FROM jobs WHERE status = 'running'").fetchall()
+        recovered = 0
+        for row in rows:
+            if row["worker"] == os.getpid() and not at_start:
+                continue
+            if row["worker"] is None or not _alive(row["worker"]):
+                recovered += self._db().execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ? AND status = 'running'",
+                    (row["id"],)).rowcount
+        return recovered
+
+    def purge(self, older_than: float) -> int:
+        cursor = self._db().execute("DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished < ?",
+                                    (time.time() - older_than,))
+        return cursor.rowcount
+
+    def counts(self) -> dict:
+        rows = self._db().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {status: 0 for status in STATES} | {r["status"]: r["n"] for r in rows}
+
+
+def _alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return False    # a job of an earlier life of this pid, we are not running it
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobRetry(Exception):
+    """Raised by a job handler for a job that should run again later"""
+
+    def __init__(self, message: str, delay: float):
+        super().__init__(message)
+        self.delay = delay
+
+
+JobHandler = Callable[[Job], Awaitable[tuple[str, int, float]]]     # returns (result, tokens, cost)
+
+
+class BatchRunner:
+    """Claims queued jobs and runs them with the handler, a few at a time per worker"""
+
+    def __init__(self, store: JobStore, handler: JobHandler, load: Callable[[], float]):
+        self.store = store
+        self.handler = handler
+        self.load = load            # share of the LLM slots taken, by interactive calls mostly
+        self.max_load = 0.5         # jobs are only claimed below this load
+        self.workers = 2
+        self.poll = 2.0
+        self.max_attempts = 5
+        self.retention = 7 * 86400
+        self._tasks: list[asyncio.Task] = []
+        self._running: dict[str, asyncio.Task] = {}
+        self._wake = asyncio.Event()
+        self.completed = 0
+        self.failed = 0
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. Called again by the hourly reload, the pool size only at start."""
+        self.workers = int(env.get("BATCH_WORKERS", "2"))
+        self.max_load = float(env.get("BATCH_MAX_LOAD", "0.5"))
+        self.poll = float(env.get("BATCH_POLL", "2"))
+        self.max_attempts = int(env.get("BATCH_MAX_ATTEMPTS", "5"))
+        self.retention = float(env.get("BATCH_RETENTION_DAYS", "7")) * 86400
+
+    def start(self) -> None:
+        recovered = self.store.recover()
+        if recovered:
+            log.info("Requeued %d batch jobs of stopped workers", recovered)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._housekeeping()))
+
+    async def stop(self) -> None:
+        # running jobs go back to the queue when the next worker starts
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        """A job was submitted here, look for it now instead of at the next poll"""
+        self._wake.set()
+
+    def cancel(self, job_id: str) -> None:
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+
+    async def _work(self) -> None:
+        while True:
+            job = None
+            if self.load() < self.max_load:
+                job = await asyncio.to_thread(self.store.claim, os.getpid())
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Job) -> None:
+        log.info("Batch job started", extra={"fields": {"job_id": job.id, "user": job.username, "attempt": job.attempts}})
+        self._running[job.id] = asyncio.current_task()
+        try:
+            result, tokens, cost = await self.handler(job)
+        except asyncio.CancelledError:
+            if (await asyncio.to_thread(self.store.get, job.id)).status == "cancelled":
+                log.info("Batch job cancelled", extra={"fields": {"job_id": job.id}})
+                asyncio.current_task().uncancel()   # the owner cancelled the job, not us
+                return
+            raise
+        except JobRetry as e:
+            if job.attempts < self.max_attempts:
+                log.info("Batch job deferred: %s", e, extra={"fields": {"job_id": job.id, "delay": e.delay}})
+                await asyncio.to_thread(self.store.retry, job.id, e.delay)
+                BATCH_JOBS.inc(1, "deferred")
+                return
+            await self._fail(job, str(e))
+            return
+        except Exception as e:
+            log.exception("Batch job %s failed: %s", job.id, e)
+            await self._fail(job, str(e))
+            return
+        finally:
+            self._running.pop(job.id, None)
+        await asyncio.to_thread(self.store.finish, job.id, "done", result, tokens, cost)
+        self.completed += 1
+        BATCH_JOBS.inc(1, "done")
+        log.info("Batch job done", extra={"fields": {"job_id": job.id, "tokens": tokens, "cost": cost}})
+
+    async def _fail(self, job: Job, error: str) -> None:
+        await asyncio.to_thread(self.store.finish, job.id, "failed", error=error)
+        self.failed += 1
+        BATCH_JOBS.inc(1, "failed")
+
+    async def _housekeeping(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.poll, 1.0))
+            try:
+                # a job cancelled by its owner may run in this worker, stop it
+                for job_id in list(self._running):
+                    job = await asyncio.to_thread(self.store.get, job_id)
+                    if job is not None and job.status == "cancelled":
+                        self.cancel(job_id)
+                # jobs of a worker that died while this one runs on
+                recovered = await asyncio.to_thread(self.store.recover, False)
+                if recovered:
+                    log.info("Requeued %d batch jobs of stopped workers", recovered)
+                    self._wake.set()
+                await asyncio.to_thread(self.store.purge, self.retention)
+            except Exception as e:
+                log.warning("Batch housekeeping failed: %s", e)
+
+    async def stats(self) -> dict:
+        counts = await asyncio.to_thread(self.store.counts)
+        return counts | {"running_here": len(self._running), "completed": self.completed, "failed": self.failed,
+                         "max_load": self.max_load}
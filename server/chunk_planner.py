@@ -0,0 +1,124 @@
+"""
+Chunk Planner
+Decides how large the chunks of a transcript can be for the model that will summarize it,
+so a transcript takes as few LLM round trips as the context window allows. Every request
+gets its own immutable plan, nothing is shared or changed in place between connections.
+"""
+
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+from key_scheduler import DEFAULT_KEY_TPM
+from tokenization import TextChunk, count_tokens
+
+
+@dataclass(frozen=True)
+class ModelLimits:
+    context_window: int         # prompt plus output, in tokens
+    max_output: int             # longest answer the model can give
+
+
+MODEL_LIMITS = {
+    "gpt-4o": ModelLimits(128000, 16384),
+    "gpt-4o-mini": ModelLimits(128000, 16384),
+    "gpt-4-turbo": ModelLimits(128000, 4096),
+    "gpt-4": ModelLimits(8192, 4096),
+    "gpt-3.5-turbo": ModelLimits(16385, 4096),
+}
+DEFAULT_LIMITS = ModelLimits(8192, 2048)
+LEGACY_CHUNK_SIZE = {           # the fixed sizes used before plans, to report what a plan saves
+    "gpt-4o": 6144,
+    "gpt-4": 3072,
+    "gpt-4-turbo": 6144,
+    "gpt-3.5-turbo": 3072,
+}
+MESSAGE_OVERHEAD = 64           # tokens of chat formatting around prompt and chunk
+MIN_CHUNK = 256
+KEY_TPM_SHARE = 0.5             # a call takes at most this share of a key's tokens per minute, leased at up to 4/3 of its size
+
+
+@dataclass(frozen=True)
+class ChunkPlan:
+    model: str
+    context_window: int
+    output_reserve: int
+    prompt_tokens: int
+    chunk_size: int
+    overlap: int
+    legacy_chunk_size: int
+
+    def calls(self, text_tokens: int, chunk_size: Optional[int] = None) -> int:
+        """LLM calls needed for a text of text_tokens, with this plan or another chunk size"""
+        size = chunk_size or self.chunk_size
+        if text_tokens <= size:
+            return 1 if text_tokens else 0
+        return 1 + math.ceil((text_tokens - size) / max(1, size - self.overlap))
+
+
+def text_tokens(chunks: list[TextChunk], overlap: int) -> int:
+    """Tokens of the text the chunks came from, without the overlaps counted twice"""
+    total = sum(getattr(c, "tokens", 0) for c in chunks)
+    return max(0, total - overlap * max(0, len(chunks) - 1))
+
+
+class ChunkPlanner:
+    """Builds a ChunkPlan per request from the model table, and keeps count of calls saved"""
+
+    def __init__(self, output_reserve: int = 4096, overlap: int = 50, max_chunk: int = 0, live_chunk: int = 6144,
+                 key_tpm: float = DEFAULT_KEY_TPM):
+        self.output_reserve = output_reserve    # tokens kept free for the answer
+        self.overlap = overlap
+        self.max_chunk = max_chunk              # upper bound on any chunk, 0 means the context window decides
+        self.live_chunk = live_chunk            # chunk size of live sessions, small enough to give early summaries
+        self.key_tpm = key_tpm                  # OPENAI_KEY_TPM, a call must fit a key's budget. 0 means no limit.
+        self.requests = 0
+        self.planned_calls = 0
+        self.legacy_calls = 0
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. Called again by the hourly reload."""
+        self.output_reserve = int(env.get("CHUNK_OUTPUT_RESERVE", "4096"))
+        self.max_chunk = int(env.get("MAX_CHUNK_TOKENS", "0"))
+        self.live_chunk = int(env.get("LIVE_CHUNK_TOKENS", "6144"))
+        self.key_tpm = float(env.get("OPENAI_KEY_TPM", DEFAULT_KEY_TPM))
+
+    def plan(self, model: str, prompt: str, live: bool = False) -> ChunkPlan:
+        limits = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+        reserve = min(self.output_reserve, limits.max_output)
+        prompt_tokens = count_tokens(prompt, model)
+        window = limits.context_window
+        if self.key_tpm > 0:
+            # a call larger than the key's budget would stall every later call on the key, or be refused by OpenAI
+            window = min(window, int(self.key_tpm * KEY_TPM_SHARE))
+        size = window - reserve - prompt_tokens - MESSAGE_OVERHEAD
+        for cap in (self.max_chunk, self.live_chunk if live else 0):
+            if cap > 0:
+                size = min(size, cap)
+        return ChunkPlan(
+            model=model,
+            context_window=limits.context_window,
+            output_reserve=reserve,
+            prompt_tokens=prompt_tokens,
+            chunk_size=max(MIN_CHUNK, size),
+            overlap=self.overlap,
+            legacy_chunk_size=LEGACY_CHUNK_SIZE.get(model, 3072),
+        )
+
+    def record(self, plan: ChunkPlan, chunks: list[TextChunk]) -> dict:
+        """Count the calls a plan made against the calls the fixed chunk size would have made"""
+        tokens = text_tokens(chunks, plan.overlap)
+        calls, legacy = len(chunks), plan.calls(tokens, plan.legacy_chunk_size)
+        self.requests += 1
+        self.planned_calls += calls
+        self.legacy_calls += legacy
+        return {"model": plan.model, "tokens": tokens, "chunk_size": plan.chunk_size,
+                "calls": calls, "legacy_calls": legacy, "saved": legacy - calls}
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "calls": self.planned_calls,
+            "legacy_calls": self.legacy_calls,
+            "saved_calls": self.legacy_calls - self.planned_calls,
+        }
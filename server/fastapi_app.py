@@ -1,22 +1,38 @@
-import json, sys, random
+import asyncio, json, logging, sys, time
+from collections import deque
 from datetime import datetime, timedelta, timezone
 from typing import Annotated, Union
 from fastapi import Depends, FastAPI, HTTPException, status, Query, WebSocket, WebSocketDisconnect, Request
 from fastapi.websockets import WebSocketState
 from contextlib import asynccontextmanager
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from jose import jwt, JWTError
 from pydantic import BaseModel
-from langchain_openai import ChatOpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from dotenv import load_dotenv, dotenv_values
 load_dotenv()
+from log_config import configure_logging, redact_event, setup_logging, shutdown_logging
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from openaiCBHandler import get_cost_tracker_callback
-from leither_api import LeitherAPI
+from summarizer import ChunkResult, ReduceDelta, Spend, frame_type, summarize_chunks, summarize_stream
+from live_session import LiveSession
+from transcript_upload import TranscriptUpload, UploadError, fragment_data
+from tokenization import split_tokens
+from text_prep import TextPrepPool
+from chunk_planner import ChunkPlanner
+from llm_cache import ResponseCache
+from llm_clients import LLMClientRegistry, ScheduledLLM
+from hedging import Hedger
+from key_scheduler import KeyScheduler
+from admission import AdmissionController, AdmissionRejected, Flow
+from ws_frames import FrameWriter
+from ws_watch import run_until_disconnect
+import metrics
+from stream_buffer import DELTA_TYPES, RequestStream, StreamBuffer
+from batch_jobs import FINISHED, BatchRunner, Job, JobRetry, JobStore
+from leither_api import AsyncLeitherAPI, LeitherAPI, LeitherTimeout
+from worker_state import WorkerState
 from utilities import ConnectionManager, UserIn, UserOut, UserInDB
 from pet_hash import get_password_hash, verify_password
 import apple_notification_sandbox, apple_notification_production
@@ -35,22 +51,61 @@ MAX_TOKEN = {
     "gpt-4-turbo": 8192,
     "gpt-3.5-turbo": 4096,
 }
-connectionManager = ConnectionManager()
-lapi = None  # Will be initialized after port detection
+connectionManager = ConnectionManager()    # open WebSockets by connection id and user, with heartbeats
+main_loop: Union[asyncio.AbstractEventLoop, None] = None     # the worker's event loop, set at startup
+lapi: Union[AsyncLeitherAPI, None] = None  # Will be initialized after port detection. Calls run on a thread pool.
 
 # Global state for Leither port
 LEITHER_PORT = None
 
 env = dotenv_values(".env")
+setup_logging(env)     # log records are written by a background thread, never on the event loop
+log = logging.getLogger("secretari.ws")
+token_log = logging.getLogger("secretari.tokens")     # stream deltas, sampled, DEBUG only
 LLM_MODEL = env["CURRENT_LLM_MODEL"]
 OPENAI_KEYS = env["OPENAI_KEYS"].split('|')
 SERVER_MAINTENCE = env["SERVER_MAINTENCE"]
+CHUNK_CONCURRENCY = int(env.get("CHUNK_CONCURRENCY", "1"))     # LLM calls in flight per request. 1 is sequential.
+REDUCE_SUMMARY = env.get("REDUCE_SUMMARY", "false") == "true"   # merge chunk summaries into one memo
+response_cache = ResponseCache.from_env(env)    # answers to transcripts that are sent again
+OPENAI_BASE_URL = env.get("OPENAI_BASE_URL")    # empty for OpenAI, or a compatible server such as mock_llm_server.py
+llm_clients = LLMClientRegistry(OPENAI_KEYS, base_url=OPENAI_BASE_URL)    # long-lived OpenAI clients sharing one connection pool
+key_scheduler = KeyScheduler(OPENAI_KEYS)       # spreads calls over the keys by their rate limits
+key_scheduler.configure(env)
+admission = AdmissionController()               # global cap on concurrent LLM calls, fair across users
+admission.configure(env)
+hedger = Hedger()   # opt-in: calls slow to start are raced against one on another key
+hedger.configure(env)
+STREAM_COALESCE_MS = float(env.get("STREAM_COALESCE_MS", "50"))        # for clients asking for coalesced stream frames
+STREAM_COALESCE_BYTES = int(env.get("STREAM_COALESCE_BYTES", "1024"))
+MAX_CONNECTION_REQUESTS = int(env.get("MAX_CONNECTION_REQUESTS", "4"))   # requests with an id running at once on one connection
+SEND_QUEUE_MESSAGES = int(env.get("SEND_QUEUE_MESSAGES", "256"))  # messages queued for a socket before its client counts as slow
+SLOW_CLIENT_POLICY = env.get("SLOW_CLIENT_POLICY", "coalesce")     # coalesce or results: what happens to stream deltas of slow clients
+SEND_TIMEOUT = float(env.get("SEND_TIMEOUT", "30"))     # seconds a message waits for room in a slow client's queue before it is closed
+UPLOAD_MAX_BYTES = int(float(env.get("UPLOAD_MAX_MB", "8")) * 1024 * 1024)  # largest transcript a connection may upload in fragments
 
-token_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-    encoding_name = "cl100k_base",
-    chunk_size = MAX_TOKEN[LLM_MODEL]/4*3,  # Set your desired chunk size in tokens
-    chunk_overlap = 50  # Set the overlap between chunks if needed
-)
+chunk_planner = ChunkPlanner()  # chunk sizes per model and prompt, as large as the context window allows
+chunk_planner.configure(env)
+text_prep = TextPrepPool()  # prepares huge transcripts off the event loop
+cancelled_usage = Spend()   # totals of LLM work cancelled because the client disconnected
+stream_buffer = StreamBuffer()  # output of resumable requests, kept while the client reconnects
+stream_buffer.configure(env)
+text_prep.configure(env)
+connectionManager.configure(env)
+worker_state = WorkerState.from_env(env)     # leader, Leither session, connection counts and user locks shared by the workers
+batch_store = JobStore(env.get("BATCH_DB") or "batch_jobs.db")  # queue of batch summaries, shared by the workers
+BATCH_CHUNK_CONCURRENCY = int(env.get("BATCH_CHUNK_CONCURRENCY", "2"))  # LLM calls in flight per batch job
+BATCH_REDUCE = env.get("BATCH_REDUCE", "true") == "true"       # merge the chunk summaries of a job into one memo
+BATCH_MAX_CHARS = int(env.get("BATCH_MAX_CHARS", "5000000"))    # longest transcript taken as a job
+BATCH_MAX_PENDING = int(env.get("BATCH_MAX_PENDING", "5"))      # jobs a user may have queued or running
+
+class BatchJobIn(BaseModel):
+    prompt: str
+    rawtext: str
+    prompt_type: str = "summary"
+    subscription: bool = False
+    llm: str = "openai"
+    temperature: float = 0.0
 
 class Token(BaseModel):
     access_token: str
@@ -64,7 +119,8 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize Leither port detection on startup"""
-    global LEITHER_PORT, lapi
+    global LEITHER_PORT, lapi, main_loop
+    main_loop = asyncio.get_running_loop()
     print("=" * 50, flush=True)
     print("LIFESPAN STARTUP TRIGGERED", flush=True)
     print("=" * 50, flush=True)
@@ -78,10 +134,21 @@ async def lifespan(app: FastAPI):
         print(f"LEITHER_PORT = {LEITHER_PORT}", flush=True)
         print(f"LEITHER_PORT type: {type(LEITHER_PORT)}", flush=True)
         
-        # Initialize the LeitherAPI with the detected port
-        lapi = LeitherAPI(LEITHER_PORT)
+        # Initialize the LeitherAPI with the detected port. Its calls are awaited, storage round trips never block the loop.
+        lapi = AsyncLeitherAPI(await asyncio.to_thread(LeitherAPI, LEITHER_PORT, worker_state),
+                               int(env.get("LEITHER_WORKERS", "8")))
+        lapi.configure(env)
         print("LeitherAPI initialized successfully", flush=True)
         print("=" * 50, flush=True)
+        if worker_state.is_leader():
+            worker_state.write("leither_port", {"port": LEITHER_PORT})
+        # the connection count is written off the loop, and not on every connect and disconnect
+        connection_counts = asyncio.create_task(worker_state.publish_connections(lambda: len(connectionManager)))
+        resume_sweep = asyncio.create_task(stream_buffer.sweep())
+        scheduler.start()
+        loop_lag_watch = asyncio.create_task(metrics.watch_event_loop_lag())
+        heartbeat = asyncio.create_task(connectionManager.heartbeat())
+        batch_runner.start()
         
     except RuntimeError as e:
         print(f"CRITICAL ERROR: {e}", flush=True)
@@ -95,44 +162,106 @@ async def lifespan(app: FastAPI):
     
     # Cleanup code goes here (shutdown)
     print("Shutting down...", flush=True)
+    scheduler.shutdown(wait=False)
+    loop_lag_watch.cancel()
+    heartbeat.cancel()
+    connection_counts.cancel()
+    resume_sweep.cancel()
+    await batch_runner.stop()
+    shutdown_logging()
+    await llm_clients.aclose()
+    text_prep.shutdown()
+    lapi.close()
 
 app = FastAPI(lifespan=lifespan)
-scheduler = BackgroundScheduler()
+scheduler = BackgroundScheduler()   # started by each worker once it is up, the Leither checks run in the leader only
 
 def periodic_task():
     env = dotenv_values(".env")
-    global LLM_MODEL, OPENAI_KEYS, SERVER_MAINTENCE, LEITHER_PORT, lapi
+    configure_logging(env)
+    # the settings belong to objects of the event loop, this runs on the scheduler's thread
+    main_loop.call_soon_threadsafe(apply_settings, env)
+    check_leither_port()
+
+def apply_settings(env: dict):
+    """Reloaded settings of .env, applied on the event loop"""
+    global LLM_MODEL, OPENAI_KEYS, SERVER_MAINTENCE, CHUNK_CONCURRENCY, REDUCE_SUMMARY
+    global STREAM_COALESCE_MS, STREAM_COALESCE_BYTES, MAX_CONNECTION_REQUESTS, SEND_QUEUE_MESSAGES, SLOW_CLIENT_POLICY, SEND_TIMEOUT
+    global BATCH_CHUNK_CONCURRENCY, BATCH_REDUCE, BATCH_MAX_CHARS, BATCH_MAX_PENDING, UPLOAD_MAX_BYTES
     # export as defualt parameters. Values updated hourly.
     LLM_MODEL = env["CURRENT_LLM_MODEL"]
     OPENAI_KEYS = env["OPENAI_KEYS"].split('|')
+    llm_clients.reload(OPENAI_KEYS, env.get("OPENAI_BASE_URL"))
+    key_scheduler.configure(env)
+    key_scheduler.reload(OPENAI_KEYS)
+    admission.configure(env)
+    hedger.configure(env)
+    text_prep.configure(env)
+    chunk_planner.configure(env)
+    stream_buffer.configure(env)
+    connectionManager.configure(env)
     SERVER_MAINTENCE=env["SERVER_MAINTENCE"]
-    
-    # Check if Leither port is still working (only if lapi is initialized)
-    if lapi is not None and LEITHER_PORT is not None:
-        import asyncio
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            is_working = loop.run_until_complete(leither_port_detector._test_port_connection(LEITHER_PORT))
-            if not is_working:
-                print(f"Leither port {LEITHER_PORT} is not responding, attempting to redetect...")
-                try:
-                    new_port = loop.run_until_complete(leither_port_detector.get_leither_port())
-                    if new_port != LEITHER_PORT:
-                        LEITHER_PORT = new_port
-                        lapi.update_port(LEITHER_PORT)
-                        print(f"Leither port updated to: {LEITHER_PORT}")
-                except RuntimeError as e:
-                    print(f"CRITICAL: Leither service no longer available: {e}")
-                    # Could implement service restart logic here if needed
-            loop.close()
-        except Exception as e:
-            print(f"Error checking Leither port health: {e}")
+    CHUNK_CONCURRENCY = int(env.get("CHUNK_CONCURRENCY", "1"))
+    REDUCE_SUMMARY = env.get("REDUCE_SUMMARY", "false") == "true"
+    response_cache.configure(env)
+    STREAM_COALESCE_MS = float(env.get("STREAM_COALESCE_MS", "50"))
+    STREAM_COALESCE_BYTES = int(env.get("STREAM_COALESCE_BYTES", "1024"))
+    MAX_CONNECTION_REQUESTS = int(env.get("MAX_CONNECTION_REQUESTS", "4"))
+    SEND_QUEUE_MESSAGES = int(env.get("SEND_QUEUE_MESSAGES", "256"))
+    SLOW_CLIENT_POLICY = env.get("SLOW_CLIENT_POLICY", "coalesce")
+    SEND_TIMEOUT = float(env.get("SEND_TIMEOUT", "30"))
+    UPLOAD_MAX_BYTES = int(float(env.get("UPLOAD_MAX_MB", "8")) * 1024 * 1024)
+    batch_runner.configure(env)
+    if lapi is not None:
+        lapi.configure(env)
+    BATCH_CHUNK_CONCURRENCY = int(env.get("BATCH_CHUNK_CONCURRENCY", "2"))
+    BATCH_REDUCE = env.get("BATCH_REDUCE", "true") == "true"
+    BATCH_MAX_CHARS = int(env.get("BATCH_MAX_CHARS", "5000000"))
+    BATCH_MAX_PENDING = int(env.get("BATCH_MAX_PENDING", "5"))
+
+def check_leither_port():
+    global LEITHER_PORT
+    if lapi is None or LEITHER_PORT is None:
+        return
+    if not worker_state.is_leader():
+        # the leader checks the port, the others follow what it found
+        shared = worker_state.read("leither_port")
+        if shared and shared["port"] != LEITHER_PORT:
+            LEITHER_PORT = shared["port"]
+            lapi.sync.update_port(LEITHER_PORT)
+            print(f"Leither port updated to: {LEITHER_PORT}")
+        return
+
+    # Check if Leither port is still working
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        is_working = loop.run_until_complete(leither_port_detector._test_port_connection(LEITHER_PORT))
+        if not is_working:
+            print(f"Leither port {LEITHER_PORT} is not responding, attempting to redetect...")
+            try:
+                new_port = loop.run_until_complete(leither_port_detector.get_leither_port())
+                if new_port != LEITHER_PORT:
+                    LEITHER_PORT = new_port
+                    lapi.sync.update_port(LEITHER_PORT)
+                    worker_state.write("leither_port", {"port": LEITHER_PORT})
+                    print(f"Leither port updated to: {LEITHER_PORT}")
+            except RuntimeError as e:
+                print(f"CRITICAL: Leither service no longer available: {e}")
+                # Could implement service restart logic here if needed
+        loop.close()
+    except Exception as e:
+        print(f"Error checking Leither port health: {e}")
 
 scheduler.add_job(periodic_task, 'interval', seconds=3600)
-scheduler.start()
 
 
+@app.exception_handler(LeitherTimeout)
+async def leither_timeout_handler(request: Request, exc: LeitherTimeout):
+    # storage is slow or down. The client may retry.
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": str(exc)},
+                        headers={"Retry-After": str(round(exc.retry_after))})
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -142,15 +271,15 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
-def authenticate_user(username: str, password: str, lapi_instance) -> UserOut:
-    user = lapi_instance.get_user(username)    # check index db
+async def authenticate_user(username: str, password: str, lapi_instance: AsyncLeitherAPI) -> UserOut:
+    user = await lapi_instance.get_user(username, fresh=True)    # check index db. The password may have just changed.
     if user is None:
         return None
     if password != "" and not verify_password(password, user.hashed_password):
         # if password is empty string, this is a temp user. "" not equal to None.
         return None
     # check if index db record exists. If not, the user has been deleted.
-    user_in_db = lapi_instance.get_user_in_db(user)
+    user_in_db = await lapi_instance.get_user_in_db(user)
     if user_in_db is None:
         return None
     return UserOut(**user.model_dump())
@@ -193,15 +322,15 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Leither service not available"
         )
-    user = lapi.get_user(username=token_data.username)
+    user = await lapi.get_user(username=token_data.username)
     if user is None:
         raise credentials_exception
     return user
 
 @app.post(BASE_ROUTE + "/token")
-async def login_for_access_token( form_data: Annotated[OAuth2PasswordRequestForm, Depends()], lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]):
+async def login_for_access_token( form_data: Annotated[OAuth2PasswordRequestForm, Depends()], lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]):
     print("form data", form_data.username, form_data.client_id)
-    user = authenticate_user(form_data.username, form_data.password, lapi_instance)
+    user = await authenticate_user(form_data.username, form_data.password, lapi_instance)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -216,23 +345,23 @@ async def login_for_access_token( form_data: Annotated[OAuth2PasswordRequestForm
     return {"token": token, "user": user.model_dump()}
 
 @app.post(BASE_ROUTE + "/users/register")
-async def register_user(user: UserIn, lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]) -> UserOut:
+async def register_user(user: UserIn, lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]) -> UserOut:
     # If user has tried service, there is valid mid attribute. Otherwise, it is None
     print("User in for register:", user)
     user_in_db = user.model_dump(exclude=["password"])
     user_in_db.update({"hashed_password": get_password_hash(user.password)})  # save hashed password in DB
-    user = lapi_instance.register_in_db(UserInDB(**user_in_db))
+    user = await lapi_instance.register_in_db(UserInDB(**user_in_db))
     if not user:
         raise HTTPException(status_code=400, detail="Username already taken")
     print("User out", user)
     return user
 
 @app.post(BASE_ROUTE + "/users/temp")
-async def register_temp_user(user: UserIn, lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]):
+async def register_temp_user(user: UserIn, lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]):
     # A temp user has been assigned a username, usually the device identifier.
     user_in_db = user.model_dump(exclude=["password"])
     user_in_db.update({"hashed_password": get_password_hash(user.password)})  # save hashed password in DB
-    user = lapi_instance.register_temp_user(UserInDB(**user_in_db))
+    user = await lapi_instance.register_temp_user(UserInDB(**user_in_db))
     if not user:
         raise HTTPException(status_code=400, detail="Failed to create temp User.")
     
@@ -247,24 +376,30 @@ async def register_temp_user(user: UserIn, lapi_instance: Annotated[LeitherAPI,
 
 # redeem coupons
 @app.post(BASE_ROUTE + "/users/redeem")
-async def cash_coupon(coupon: str, current_user: Annotated[UserInDB, Depends(get_current_user)], lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]) -> bool:
-    return lapi_instance.cash_coupon(current_user, coupon)
+async def cash_coupon(coupon: str, current_user: Annotated[UserInDB, Depends(get_current_user)], lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]) -> bool:
+    async with worker_state.user_lock(current_user.username):
+        current_user = await lapi_instance.get_user(current_user.username, fresh=True) or current_user
+        return await lapi_instance.cash_coupon(current_user, coupon)
 
 #update user infor
 @app.put(BASE_ROUTE + "/users")
-async def update_user_by_obj(user: UserIn, user_in_db: Annotated[UserInDB, Depends(get_current_user)], lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]):
-    user_in_db.family_name = user.family_name
-    user_in_db.given_name = user.given_name
-    user_in_db.email = user.email
-    # if User password is null, do not update it.
-    if user.password:
-        user_in_db.hashed_password = get_password_hash(user.password)  # save hashed password in DB
-    return lapi_instance.update_user(user_in_db).model_dump()
+async def update_user_by_obj(user: UserIn, user_in_db: Annotated[UserInDB, Depends(get_current_user)], lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]):
+    # the whole record is written back. Read it again under the user's lock, the cached copy may miss a charge.
+    async with worker_state.user_lock(user_in_db.username):
+        user_in_db = await lapi_instance.get_user(user_in_db.username, fresh=True) or user_in_db
+        user_in_db.family_name = user.family_name
+        user_in_db.given_name = user.given_name
+        user_in_db.email = user.email
+        # if User password is null, do not update it.
+        if user.password:
+            user_in_db.hashed_password = get_password_hash(user.password)  # save hashed password in DB
+        return (await lapi_instance.update_user(user_in_db)).model_dump()
 
 # delete current user, return {id: user_id}
 @app.delete(BASE_ROUTE + "/users")
-async def delete_user(user_in_db: Annotated[UserInDB, Depends(get_current_user)], lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]):
-    ret = lapi_instance.delete_user(user_in_db)
+async def delete_user(user_in_db: Annotated[UserInDB, Depends(get_current_user)], lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]):
+    async with worker_state.user_lock(user_in_db.username):
+        ret = await lapi_instance.delete_user(user_in_db)
     print("delete=", ret)
     return ret
 
@@ -287,10 +422,22 @@ async def get_server_status():
             "server_time": datetime.now().isoformat(),
             "leither_port": LEITHER_PORT,
             "leither_connected": is_leither_working,
-            "active_connections": len(connectionManager.active_connections),
+            "active_connections": len(connectionManager),
+            "connections": connectionManager.stats(),
+            "workers": await asyncio.to_thread(worker_state.stats),
+            "leither": lapi.stats() if lapi else None,
             "llm_model": LLM_MODEL,
             "server_maintenance": SERVER_MAINTENCE,
-            "max_token_limits": MAX_TOKEN
+            "max_token_limits": MAX_TOKEN,
+            "response_cache": response_cache.stats(),
+            "openai_keys": key_scheduler.utilization(),
+            "admission": admission.stats(),
+            "hedging": hedger.stats(),
+            "text_prep": text_prep.stats(),
+            "chunk_planner": chunk_planner.stats(),
+            "cancelled": cancelled_usage.stats(),
+            "resumable": stream_buffer.stats(),
+            "batch": await batch_runner.stats(),
         }
     except Exception as e:
         return {
@@ -300,22 +447,41 @@ async def get_server_status():
             "leither_connected": False
         }
 
+def collect_metrics():
+    # gauges read from their owners at scrape time, instead of being kept in sync on every change
+    metrics.WS_CONNECTIONS.set(len(connectionManager))
+
+metrics.REGISTRY.add_collector(collect_metrics)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    # SQLite is read on a thread, not in a collector on the loop
+    metrics.BATCH_QUEUED.set((await asyncio.to_thread(batch_store.counts))["queued"])
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.post(BASE_ROUTE + "/app_server_notifications_production")
-async def apple_notifications_production(request: Request, lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]):
+async def apple_notifications_production(request: Request, lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]):
+    started = time.perf_counter()
     try:
         body = await request.json()
         await apple_notification_production.decode_notification(lapi_instance, body["signedPayload"])
+        metrics.APPLE_SECONDS.observe(time.perf_counter() - started, "production", "ok")
         return {"status": "ok"}
     except:
+        metrics.APPLE_SECONDS.observe(time.perf_counter() - started, "production", "error")
         raise HTTPException(status_code=400, detail="Invalid notification data")
 
 @app.post(BASE_ROUTE + "/app_server_notifications_sandbox")
-async def apple_notifications_sandbox(request: Request, lapi_instance: Annotated[LeitherAPI, Depends(get_lapi)]):
+async def apple_notifications_sandbox(request: Request, lapi_instance: Annotated[AsyncLeitherAPI, Depends(get_lapi)]):
+    started = time.perf_counter()
     try:
         body = await request.json()
         await apple_notification_sandbox.decode_notification(lapi_instance, body["signedPayload"])
+        metrics.APPLE_SECONDS.observe(time.perf_counter() - started, "sandbox", "ok")
         return {"status": "ok"}
     except:
+        metrics.APPLE_SECONDS.observe(time.perf_counter() - started, "sandbox", "error")
         raise HTTPException(status_code=400, detail="Invalid notification data")
 
 @app.get(BASE_ROUTE + "/notice")
@@ -334,9 +500,186 @@ async def get_files(page: str):
         content = file.read()
     return HTMLResponse(content=content)
 
+async def charge(user: UserInDB, total_cost: float, total_tokens: int) -> None:
+    """
+    Bill the user on top of their latest record, under their lock. Other connections and
+    workers bill the same account, so the copy loaded at connect time may be stale.
+    Shielded, a handler cancelled while storage answers still has its user billed.
+    """
+    await asyncio.shield(_charge(user, total_cost, total_tokens))
+
+async def _charge(user: UserInDB, total_cost: float, total_tokens: int) -> None:
+    async with worker_state.user_lock(user.username):
+        try:
+            latest = await lapi.get_user_to_bill(user.username)
+        except Exception as e:
+            # bill the record we hold rather than not at all
+            log.warning("Billing read of %s failed, billing the record held: %s", user.username, e)
+            latest = None
+        if latest is not None:
+            for name in UserInDB.model_fields:
+                setattr(user, name, getattr(latest, name))
+        await lapi.bookkeeping(total_cost, total_tokens, user)
+
+def billed(item: ChunkResult) -> tuple[float, int]:
+    # a replayed answer is billed by the configured cache policy
+    if item.cached:
+        return response_cache.charge(item.total_cost, item.total_tokens)
+    return item.total_cost, item.total_tokens
+
+async def settle_cancelled(spend: Spend, user) -> None:
+    """Bill LLM calls that were cut off, for what they generated, and count what cancelling saved"""
+    if spend.cancelled_calls or spend.skipped_chunks or spend.tokens:
+        log.info("Cancelled LLM calls", extra={"fields": spend.stats()})
+        if user is not None and spend.tokens:
+            await charge(user, spend.cost, spend.tokens)
+        cancelled_usage.add(spend)
+
+async def run_batch_job(job: Job) -> tuple[str, int, float]:
+    """Summarize the transcript of a batch job. The owner is billed once, for the whole job."""
+    request = job.request
+    user = await lapi.get_user(job.username)
+    if user is None:
+        raise ValueError("User not found")
+    model, temperature = request["model"], request["temperature"]
+    # batch calls queue behind interactive ones for the global slots
+    llm = ScheduledLLM(llm_clients, key_scheduler, model, temperature, admission, Flow(job.username, "batch"), hedger)
+    plan = chunk_planner.plan(model, request["prompt"])
+    chunks = await text_prep.prepare(request["rawtext"], plan.chunk_size, plan.overlap, plan.model)
+    log.info("Chunk plan", extra={"fields": chunk_planner.record(plan, chunks) | {"job_id": job.id}})
+    metrics.REQUEST_CHUNKS.observe(len(chunks))
+
+    spend = Spend()
+    answer, total_cost, total_tokens, done = "", 0.0, 0, 0
+    try:
+        async for item in summarize_chunks(llm, request["prompt"], chunks, model, BATCH_CHUNK_CONCURRENCY, BATCH_REDUCE,
+                                           response_cache, temperature, spend, plan.chunk_size):
+            if not isinstance(item, ChunkResult):
+                if not isinstance(item, ReduceDelta):
+                    answer += item
+                continue
+            # on a retry, chunks replayed from the cache were billed by the attempt that made them
+            cost, tokens = (0.0, 0) if item.cached and job.attempts > 1 else billed(item)
+            total_cost += cost
+            total_tokens += tokens
+            if item.reduced:
+                answer = item.text
+            else:
+                done += 1
+            await asyncio.to_thread(batch_store.progress, job.id, {"chunks": len(chunks), "done": done})
+    except AdmissionRejected as e:
+        # interactive traffic took the slots. Chunks done so far come back from the response cache.
+        raise JobRetry(str(e), max(e.retry_after, 30.0)) from e
+    finally:
+        # also what a failed, cancelled or deferred attempt used
+        total_cost += spend.cost
+        total_tokens += spend.tokens
+        if total_tokens:
+            await charge(user, total_cost, total_tokens)
+    return answer, int(total_tokens * lapi.cost_efficiency), total_cost * lapi.cost_efficiency
+
+batch_runner = BatchRunner(batch_store, run_batch_job, admission.load)   # runs queued jobs while interactive load is low
+batch_runner.configure(env)
+
+@app.post(BASE_ROUTE + "/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_batch_job(job: BatchJobIn, current_user: Annotated[UserInDB, Depends(get_current_user)]):
+    """Queue a transcript for summarizing in the background. Returns the job, poll it by its job_id."""
+    if SERVER_MAINTENCE == "true":
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is under maintenance. Please try again later.")
+    if job.llm != "openai":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported LLM: {job.llm}")
+    if len(job.rawtext) > BATCH_MAX_CHARS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Transcript longer than {BATCH_MAX_CHARS} characters.")
+    if not job.subscription:
+        if current_user.dollar_balance < MIN_BALANCE:
+            raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Low balance. Please purchase consumable product or subscribe.")
+    else:
+        current_month = str(datetime.now().month)
+        if current_user.monthly_usage.get(current_month) and current_user.monthly_usage.get(current_month) >= MAX_EXPENSE:
+            raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Monthly max expense exceeded. Purchase consumable product if necessary.")
+    if await asyncio.to_thread(batch_store.pending, current_user.username) >= BATCH_MAX_PENDING:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=f"At most {BATCH_MAX_PENDING} jobs can wait at once.")
+
+    request = {"prompt": job.prompt, "rawtext": job.rawtext, "prompt_type": job.prompt_type,
+               "subscription": job.subscription, "model": LLM_MODEL, "temperature": job.temperature}
+    queued = await asyncio.to_thread(batch_store.submit, current_user.username, request)
+    batch_runner.notify()
+    log.info("Batch job queued", extra={"fields": {"job_id": queued.id, "user": current_user.username, "chars": len(job.rawtext)}})
+    return queued.public()
+
+@app.get(BASE_ROUTE + "/jobs")
+async def list_batch_jobs(current_user: Annotated[UserInDB, Depends(get_current_user)]):
+    """The user's recent jobs, without their results"""
+    jobs = await asyncio.to_thread(batch_store.list, current_user.username)
+    return [job.public(with_result=False) for job in jobs]
+
+@app.get(BASE_ROUTE + "/jobs/{job_id}")
+async def get_batch_job(job_id: str, current_user: Annotated[UserInDB, Depends(get_current_user)]):
+    job = await asyncio.to_thread(batch_store.get, job_id, current_user.username)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job.public()
+
+@app.delete(BASE_ROUTE + "/jobs/{job_id}")
+async def cancel_batch_job(job_id: str, current_user: Annotated[UserInDB, Depends(get_current_user)]):
+    """Cancel a queued or running job. What a running job used so far is billed."""
+    if not await asyncio.to_thread(batch_store.cancel, job_id, current_user.username):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No queued or running job with this id")
+    batch_runner.cancel(job_id)     # if it runs in this worker, others notice within BATCH_POLL seconds
+    metrics.BATCH_JOBS.inc(1, "cancelled")
+    return (await asyncio.to_thread(batch_store.get, job_id)).public()
+
+@app.get(BASE_ROUTE + "/jobs/{job_id}/events")
+async def follow_batch_job(job_id: str, request: Request, current_user: Annotated[UserInDB, Depends(get_current_user)]):
+    """Server-sent events with the job's status on every change, the last one with the result"""
+    if await asyncio.to_thread(batch_store.get, job_id, current_user.username) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+
+    async def events():
+        last, idle = None, 0
+        while not await request.is_disconnected():
+            job = await asyncio.to_thread(batch_store.get, job_id)
+            if job is None:
+                return
+            state = job.public()
+            if state != last:
+                yield f"event: status\ndata: {json.dumps(state)}\n\n"
+                last, idle = state, 0
+            elif idle >= 15:
+                yield ": keepalive\n\n"   # proxies close streams that stay silent
+                idle = 0
+            if job.status in FINISHED:
+                return
+            idle += 1
+            await asyncio.sleep(1.0)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.websocket(BASE_ROUTE + "/ws/")
-async def websocket_endpoint(websocket: WebSocket, token: str = Query()):
-    await connectionManager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, token: str = Query(), framing: str = Query("json"), coalesce: bool = Query(False),
+                             queue_status: bool = Query(False), heartbeat: bool = Query(False)):
+    connection = await connectionManager.connect(websocket)
+    metrics.WS_SESSIONS.inc()
+    connected_at = time.monotonic()
+    # Old clients get one JSON text frame per token. New ones may ask for coalesced deltas and/or binary frames.
+    # A sender task writes to the socket, so a slow client never holds up the LLM stream.
+    writer = FrameWriter(websocket, framing,
+                         STREAM_COALESCE_MS if coalesce else 0,
+                         STREAM_COALESCE_BYTES if coalesce else 0,
+                         SEND_QUEUE_MESSAGES, SLOW_CLIENT_POLICY, SEND_TIMEOUT)
+    # clients connecting with heartbeat=true get pings, must answer them, and are closed when they go silent
+    connection.writer = writer
+    connection.heartbeat = heartbeat
+    if framing != "json":
+        # tell the client which framing it got, in JSON since it may have fallen back
+        await websocket.send_text(json.dumps({"type": "framing", "framing": writer.framing}))
+    session: Union[LiveSession, None] = None   # live recording being summarized incrementally
+    upload: Union[TranscriptUpload, None] = None    # transcript arriving in fragments, one at a time per connection
+    upload_task: Union[asyncio.Task, None] = None   # its summary, running while the fragments arrive
+    backlog: deque[Union[str, bytes]] = deque()    # messages received while a summary was running
+    spend = Spend()                 # LLM calls of this connection cut off by a disconnect
+    requests: dict[str, asyncio.Task] = {}     # deliveries of requests with an id, running next to the receive loop
+    user = None
     try:
         # token = websocket.query_params.get("token")
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -345,22 +688,136 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query()):
             raise WebSocketDisconnect
         token_data = TokenData(username=username)
         if lapi is None:
-            await websocket.send_text(json.dumps({
+            await writer.send({
                 "type": "error",
                 "message": "Leither service not available",
-            }))
+            })
+            await writer.drain()
             await websocket.close()
             return
         
-        user = lapi.get_user(username=token_data.username)
+        user = await lapi.get_user(username=token_data.username)
         if not user:
             raise WebSocketDisconnect
+        connectionManager.identify(connection, user.username)
+
+        def seen():
+            connectionManager.touch(connection)
         
+        async def send_queue_status(position: int, wait: float):
+            # only clients that asked for it know the "queue" message type
+            if writer.connected:
+                await writer.send({"type": "queue", "position": position, "eta": wait})
+
+        async def deliver(stream: RequestStream, offset: int):
+            # every message of a resumable request carries its id and the offset to resume after it
+            async for offset, message in stream.follow(offset):
+                if message["type"] in DELTA_TYPES:
+                    # replayed and live deltas are coalesced and bounded like any other stream
+                    await writer.stream(message["data"], message["type"], request_id=stream.request_id, offset=offset)
+                else:
+                    await writer.send(message | {"request_id": stream.request_id, "offset": offset})
+
+        def start_delivery(stream: RequestStream, offset: int):
+            # the receive loop goes on, so further requests and cancels are taken meanwhile
+            async def run():
+                try:
+                    await deliver(stream, offset)
+                except Exception as e:
+                    log.info("Delivery of request %s ended: %s", stream.request_id, e)
+                finally:
+                    if requests.get(stream.request_id) is asyncio.current_task():
+                        del requests[stream.request_id]
+            requests[stream.request_id] = asyncio.create_task(run())
+
+        async def send_chunk(item: ChunkResult):
+            # summary of a complete chunk of a live session, ready before the recording ends
+            total_cost, total_tokens = billed(item)
+            try:
+                if writer.connected:
+                    await writer.send({
+                        "type": "chunk",
+                        "index": item.index,
+                        "summary": item.text,
+                        "tokens": int(total_tokens * lapi.cost_efficiency),
+                        "cost": total_cost * lapi.cost_efficiency,
+                        })
+            finally:
+                # generated and paid for, whether the client got it or not
+                await charge(user, total_cost, total_tokens)
+
+        def live_splitter(llm_model: str, prompt: str):
+            # chunks of LIVE_CHUNK_TOKENS, so the first ones go to the LLM while text still arrives
+            plan = chunk_planner.plan(llm_model, prompt, live=True)
+
+            # the transcript is encoded once. Chunks carry their token counts to the cost tracker.
+            def split_text(text: str) -> list[str]:
+                return split_tokens(text, plan.chunk_size, plan.overlap, plan.model)
+            return split_text
+
+        async def summarize_upload(upload: TranscriptUpload, chain, prompt: str, llm_model: str, temperature: float):
+            # runs next to the receive loop, which goes on taking fragments. Output as for a plain request.
+            resp = ""
+            try:
+                reduce_tokens = chunk_planner.plan(llm_model, prompt).chunk_size
+                async for item in summarize_stream(chain, prompt, upload.chunks(), llm_model, CHUNK_CONCURRENCY,
+                                                   REDUCE_SUMMARY, response_cache, temperature, spend, reduce_tokens):
+                    if not isinstance(item, ChunkResult):
+                        if not isinstance(item, ReduceDelta):
+                            resp += item
+                        if writer.connected:
+                            await writer.stream(item, frame_type(item))
+                        continue
+                    total_cost, total_tokens = billed(item)
+                    try:
+                        if writer.connected:
+                            await writer.send({
+                                "type": "result",
+                                "answer": item.text if item.reduced else resp,
+                                "tokens": int(total_tokens * lapi.cost_efficiency),
+                                "cost": total_cost * lapi.cost_efficiency,
+                                "eof": item.eof,
+                                })
+                    finally:
+                        await charge(user, total_cost, total_tokens)
+            except UploadError:
+                pass    # the receive loop told the client
+            except (AdmissionRejected, LeitherTimeout) as e:
+                if writer.connected:
+                    await writer.send({"type": "error", "code": e.code, "message": str(e), "retry_after": round(e.retry_after, 1)})
+            except Exception as e:
+                log.exception("Upload summary failed: %s", e)
+                if writer.connected:
+                    await writer.send({"type": "error", "message": f"Server error: {str(e)}"})
+
+        async def take_fragment(seq: int, data: Union[str, bytes]):
+            nonlocal upload
+            if upload is None:
+                await writer.send({"type": "error", "code": "no_upload", "message": "No upload. Send upload_start first."})
+                return
+            try:
+                upload.append(seq, fragment_data(data, upload.encoding))
+            except UploadError as e:
+                log.warning("Upload rejected", extra={"fields": {"user": user.username, "code": e.code, "bytes": upload.received}})
+                upload.abort(e)     # chunks already cut are cancelled with the summary
+                upload = None
+                await stop_upload()
+                await writer.send({"type": "error", "code": e.code, "message": str(e)})
+
+        async def stop_upload():
+            # cancels the summary of the upload. What its calls used is in `spend`, billed when the connection ends.
+            nonlocal upload_task
+            if upload_task is not None and not upload_task.done():
+                upload_task.cancel()
+                await asyncio.gather(upload_task, return_exceptions=True)
+            upload_task = None
+
         if SERVER_MAINTENCE == "true":
-            await websocket.send_text(json.dumps({
+            await writer.send({
                 "type": "error",
                 "message": "Server is under maintenance. Please try again later.",
-                }))
+                })
+            await writer.drain()
             await websocket.close()
             return
         
@@ -368,12 +825,150 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query()):
             try:
                 # Check if WebSocket is still connected before receiving
                 if websocket.client_state != WebSocketState.CONNECTED:
-                    print("WebSocket disconnected, breaking loop")
+                    log.info("WebSocket disconnected, breaking loop")
                     break
                     
-                message = await websocket.receive_text()
+                if backlog:
+                    message = backlog.popleft()
+                else:
+                    received = await websocket.receive()
+                    if received["type"] == "websocket.disconnect":
+                        raise WebSocketDisconnect(received.get("code", 1000), received.get("reason"))
+                    seen()
+                    message = received["text"] if received.get("text") is not None else received.get("bytes")
+                if isinstance(message, bytes):
+                    # a fragment of a transcript upload: 4 byte big-endian sequence number, then the data
+                    await take_fragment(int.from_bytes(message[:4], "big"), message[4:])
+                    continue
                 event = json.loads(message)
-                print("Incoming event: ", event)    # request from client, with parameters
+                if event.get("action") == "pong":
+                    continue
+                # request from client, with parameters. The transcript is logged by its length only.
+                log.info("Incoming event", extra={"fields": {"user": user.username, "event": redact_event(event)}})
+                action = event.get("action")        # None for a plain summary request
+                request_id = event.get("request_id")    # opt-in: output is buffered, can be resumed, and runs concurrently
+                if request_id is not None:
+                    request_id = str(request_id)
+
+                if action == "cancel":
+                    task = requests.pop(request_id, None)
+                    stopped = stream_buffer.cancel(user.username, request_id)
+                    if task is not None:
+                        task.cancel()
+                        await asyncio.gather(task, return_exceptions=True)
+                    if task is None and not stopped:
+                        await writer.send({
+                            "type": "error",
+                            "code": "not_found",
+                            "request_id": request_id,
+                            "message": "No such request.",
+                            })
+                    else:
+                        log.info("Request cancelled", extra={"fields": {"user": user.username, "request_id": request_id}})
+                        await writer.send({"type": "cancelled", "request_id": request_id})
+                    continue
+
+                if request_id and action in (None, "resume"):
+                    if request_id in requests:
+                        await writer.send({
+                            "type": "error",
+                            "code": "in_progress",
+                            "request_id": request_id,
+                            "message": "The request is already running on this connection.",
+                            })
+                        continue
+                    if len(requests) >= MAX_CONNECTION_REQUESTS:
+                        await writer.send({
+                            "type": "error",
+                            "code": "too_many_requests",
+                            "request_id": request_id,
+                            "message": f"At most {MAX_CONNECTION_REQUESTS} requests can run at once. Wait for one to finish.",
+                            })
+                        continue
+
+                # a client back after a network switch, or resubmitting a request still buffered
+                stream = stream_buffer.get(user.username, request_id) if request_id and action in (None, "resume") else None
+                if action == "resume" or stream is not None:
+                    if stream is None:
+                        await writer.send({
+                            "type": "error",
+                            "code": "not_found",
+                            "request_id": request_id,
+                            "message": "Request expired. Please send it again.",
+                            })
+                        continue
+                    log.info("Resuming request", extra={"fields": {"request_id": request_id, "offset": event.get("offset", 0)}})
+                    start_delivery(stream, int(event.get("offset", 0)))
+                    continue
+
+                # fragments of a transcript upload, in JSON for clients that cannot send binary frames
+                if action == "upload_part":
+                    await take_fragment(int(event.get("seq", 0)), event.get("data", ""))
+                    continue
+                if action == "upload_end":
+                    if upload is None:
+                        await writer.send({"type": "error", "code": "no_upload", "message": "No upload. Send upload_start first."})
+                        continue
+                    try:
+                        upload.finish(event.get("parts"))
+                    except UploadError as e:
+                        upload.abort(e)
+                        await stop_upload()
+                        await writer.send({"type": "error", "code": e.code, "message": str(e)})
+                    else:
+                        log.info("Upload finished", extra={"fields": {"user": user.username, "bytes": upload.received,
+                                                                      "text_bytes": upload.size, "chunks": upload.chunk_count}})
+                        if not upload.chunk_count:
+                            await writer.send({"type": "error", "code": "upload_empty", "message": "The upload has no text."})
+                    upload = None   # its summary runs on until the last result
+                    continue
+
+                # follow-up events of a live session. They carry transcript segments only.
+                if action in ("append", "memo", "stop"):
+                    if session is None:
+                        await writer.send({
+                            "type": "error",
+                            "message": "No live session. Send session_start first.",
+                            })
+                        continue
+                    if action == "append":
+                        session.append(event.get("text", ""))
+                    elif action == "memo":
+                        await writer.send({
+                            "type": "memo",
+                            "memo": session.memo(),
+                            "chunks": session.chunk_count,
+                            "pending": session.pending,
+                            })
+                    else:
+                        async def finish_session(session=session):
+                            async for item in session.stop():
+                                if not isinstance(item, ChunkResult):
+                                    if writer.connected:
+                                        await writer.stream(item, frame_type(item))
+                                elif not item.eof:
+                                    await send_chunk(item)
+                                else:
+                                    total_cost, total_tokens = billed(item)
+                                    try:
+                                        if writer.connected:
+                                            await writer.send({
+                                                "type": "result",
+                                                "answer": item.text,
+                                                "tokens": int(total_tokens * lapi.cost_efficiency),
+                                                "cost": total_cost * lapi.cost_efficiency,
+                                                "eof": True,
+                                                })
+                                    finally:
+                                        await charge(user, total_cost, total_tokens)
+
+                        disconnected = await run_until_disconnect(websocket, finish_session(), backlog, seen)
+                        session = None
+                        if disconnected:
+                            log.info("WebSocket disconnected while the session was finishing, calls cancelled")
+                            break
+                    continue
+
                 query = event["input"]
                 params = event["parameters"]
                 llm_model = LLM_MODEL
@@ -385,99 +980,187 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query()):
                 # when dollar balance is lower than $0.1, user gpt-3.5-turbo
                 if not query["subscription"]:
                     if user.dollar_balance < MIN_BALANCE:
-                        await websocket.send_text(json.dumps({
+                        await writer.send({
                             "type": "error",
                             "message": "Low balance. Please purchase consumable product or subscribe.", 
-                            }))
+                            })
                         continue
                     elif user.dollar_balance < MIN_BALANCE:
                         llm_model = "gpt-3.5-turbo"
-                        token_splitter._chunk_size = MAX_TOKEN["gpt-3.5-turbo"]
                 else:
                     # a subscriber. Check monthly usage
                     current_month = str(datetime.now().month)
                     if user.monthly_usage.get(current_month) and user.monthly_usage.get(current_month) >= MAX_EXPENSE:
-                        await websocket.send_text(json.dumps({
+                        await writer.send({
                             "type": "error",
                             "message": "Monthly max expense exceeded. Purchase consumable product if necessary.", 
-                            }))
+                            })
                         continue
 
                 # create the right Chat LLM
                 if params["llm"] == "openai":
-                    # randomly select OpenAI key from a list
-                    CHAT_LLM = ChatOpenAI(
-                        api_key = random.choice(OPENAI_KEYS),       # pick a random OpenAI key from a list
-                        temperature = float(params["temperature"]),
-                        model = llm_model,
-                        streaming = True,
-                        verbose = True
-                    )
+                    # every call waits for a global slot, then leases the least loaded OpenAI key and reuses its pooled client
+                    flow = Flow(user.username, "subscriber" if query["subscription"] else "balance",
+                                send_queue_status if queue_status else None)
+                    CHAT_LLM = ScheduledLLM(llm_clients, key_scheduler, llm_model, float(params["temperature"]), admission, flow,
+                                            hedger)
                 elif params["llm"] == "qianfan":
                     continue
 
+                if action == "session_start":
+                    # a recording in progress: its transcript arrives later in "append" events
+                    if session is not None:
+                        session.close()
+                    session = LiveSession(CHAT_LLM, query["prompt"], llm_model, live_splitter(llm_model, query["prompt"]),
+                                          send_chunk, CHUNK_CONCURRENCY, response_cache, float(params["temperature"]), spend,
+                                          chunk_planner.plan(llm_model, query["prompt"]).chunk_size)
+                    await writer.send({"type": "session", "state": "started"})
+                    if query.get("rawtext"):
+                        session.append(query["rawtext"])
+                    continue
+
+                if action == "upload_start":
+                    # a finished transcript sent in fragments, summarized while it arrives
+                    if upload is not None or (upload_task is not None and not upload_task.done()):
+                        await writer.send({
+                            "type": "error",
+                            "code": "in_progress",
+                            "message": "An upload is still running on this connection.",
+                            })
+                        continue
+                    try:
+                        upload = TranscriptUpload(live_splitter(llm_model, query["prompt"]), UPLOAD_MAX_BYTES,
+                                                  event.get("encoding") or "identity")
+                    except UploadError as e:
+                        await writer.send({"type": "error", "code": e.code, "message": str(e)})
+                        continue
+                    upload_task = asyncio.create_task(summarize_upload(upload, CHAT_LLM, query["prompt"], llm_model,
+                                                                       float(params["temperature"])))
+                    await writer.send({"type": "upload", "state": "started", "max_bytes": UPLOAD_MAX_BYTES})
+                    continue
+
                 # lapi.bookkeeping(0.015, 123, user)
-                # await websocket.send_text(json.dumps({
+                # await writer.send({
                 #     "type": "result",
                 #     "answer": event["input"]["rawtext"], 
                 #     "tokens": int(111 * lapi.cost_efficiency),
                 #     "cost": 0.015 * lapi.cost_efficiency,
                 #     "eof": True,
-                #     }))
+                #     })
                 # continue
 
                 chain = CHAT_LLM
-                resp = ""
-                chunks = token_splitter.split_text(query["rawtext"])
-                for index, ci in enumerate(chunks):
-                    with get_cost_tracker_callback(llm_model) as cb:
-                        # chain = ConversationChain(llm=CHAT_LLM, memory=memory, output_parser=StrOutputParser())
-                        async for chunk in chain.astream(query["prompt"] + "\n\n" + ci):
-                            print(chunk.content, end="|", flush=True)    # chunk size can be big
-                            resp += chunk.content
+                # chunks as large as the model allows, so the transcript takes the fewest LLM calls
+                plan = chunk_planner.plan(llm_model, query["prompt"])
+                chunks = await text_prep.prepare(query["rawtext"], plan.chunk_size, plan.overlap, plan.model)
+                log.info("Chunk plan", extra={"fields": chunk_planner.record(plan, chunks)})
+                metrics.REQUEST_CHUNKS.observe(len(chunks))
+
+                # `out` is the socket's writer, or the buffer of a resumable request
+                async def summarize(out, spend, chain=chain, prompt=query["prompt"], chunks=chunks, llm_model=llm_model,
+                                    temperature=float(params["temperature"]), reduce_tokens=plan.chunk_size):
+                    resp = ""
+                    # chunks go to the LLM concurrently, but their output comes back in chunk order.
+                    async for item in summarize_chunks(chain, prompt, chunks, llm_model, CHUNK_CONCURRENCY, REDUCE_SUMMARY,
+                                                       response_cache, temperature, spend, reduce_tokens):
+                        if not isinstance(item, ChunkResult):
+                            if not isinstance(item, ReduceDelta):
+                                resp += item     # the chunk summaries, a reduce pass streams its own "reduce" frames
+                            if token_log.isEnabledFor(logging.DEBUG):
+                                token_log.debug("delta", extra={"fields": {"user": user.username, "data": item}})
                             # Check connection before sending
-                            if websocket.client_state == WebSocketState.CONNECTED:
-                                await websocket.send_text(json.dumps({"type": "stream", "data": chunk.content}))
-                            else:
-                                print("WebSocket disconnected during streaming")
-                                break
-                        print('\n', cb, '\nLLMModel:', llm_model, index, len(chunks))
-                        sys.stdout.flush()
-
-                        # Check connection before sending final result
-                        if websocket.client_state == WebSocketState.CONNECTED:
-                            await websocket.send_text(json.dumps({
-                                "type": "result",
-                                "answer": resp,
-                                "tokens": int(cb.total_tokens * lapi.cost_efficiency),  # sum of prompt tokens and completion tokens. Prices are different.
-                                "cost": cb.total_cost * lapi.cost_efficiency,           # total cost in USD
-                                "eof": index == (len(chunks) - 1),                      # end of content
-                                }))
-                        lapi.bookkeeping(cb.total_cost, cb.total_tokens, user)
-                        
+                            if out.connected:
+                                await out.stream(item, frame_type(item))
+                            continue
+
+                        log.info("Chunk done", extra={"fields": {
+                            "user": user.username, "model": llm_model, "index": item.index, "chunks": len(chunks),
+                            "tokens": item.total_tokens, "cost": item.total_cost, "cached": item.cached,
+                            "cached_tokens": item.cached_tokens, "eof": item.eof}})
+                        total_cost, total_tokens = billed(item)
+
+                        # Check connection before sending final result. The chunk is billed even if the client is gone.
+                        try:
+                            if out.connected:
+                                await out.send({
+                                    "type": "result",
+                                    "answer": item.text if item.reduced else resp,    # the merged memo replaces the chunk summaries
+                                    "tokens": int(total_tokens * lapi.cost_efficiency),   # sum of prompt tokens and completion tokens. Prices are different.
+                                    "cost": total_cost * lapi.cost_efficiency,            # total cost in USD
+                                    "eof": item.eof,                                      # end of content
+                                    })
+                        finally:
+                            await charge(user, total_cost, total_tokens)
+
+                if request_id:
+                    # runs on if the client goes away, it can resume from the buffer
+                    async def produce(out: RequestStream, summarize=summarize, user=user):
+                        request_spend = Spend()
+                        try:
+                            await summarize(out, request_spend)
+                        except (AdmissionRejected, LeitherTimeout) as e:
+                            await out.send({"type": "error", "code": e.code, "message": str(e),
+                                            "retry_after": round(e.retry_after, 1)})
+                        finally:
+                            await settle_cancelled(request_spend, user)
+
+                    # runs concurrently with other requests of the connection, its frames tagged with the id
+                    start_delivery(stream_buffer.start(user.username, request_id, produce), 0)
+                    continue
+
+                # a client that goes away stops the calls in flight and the chunks not sent yet
+                if await run_until_disconnect(websocket, summarize(writer, spend), backlog, seen):
+                    log.info("WebSocket disconnected during summary, remaining LLM calls cancelled")
+                    break
+
             except WebSocketDisconnect:
-                print("WebSocket disconnected during message processing")
+                log.info("WebSocket disconnected during message processing")
                 break
+            except (AdmissionRejected, LeitherTimeout) as e:
+                # shed under load, or storage did not answer. The connection stays open, so the client can retry later.
+                log.warning("Request shed", extra={"fields": {"user": user.username, "code": e.code, "retry_after": e.retry_after}})
+                if writer.connected:
+                    await writer.send({
+                        "type": "error",
+                        "code": e.code,
+                        "message": str(e),
+                        "retry_after": round(e.retry_after, 1),
+                    })
             except Exception as e:
-                print(f"Error processing WebSocket message: {e}")
+                log.exception("Error processing WebSocket message: %s", e)
                 # Send error to client if still connected
-                if websocket.client_state == WebSocketState.CONNECTED:
-                    await websocket.send_text(json.dumps({
+                if writer.connected:
+                    await writer.send({
                         "type": "error",
                         "message": f"Server error: {str(e)}"
-                    }))
+                    })
                 break
 
     except WebSocketDisconnect:
-        connectionManager.disconnect(websocket)
+        connectionManager.disconnect(connection)
     except JWTError:
-        print("JWTError", e)
-        sys.stdout.flush()
-        await websocket.send_text(json.dumps({"type": "error", "message": "Invalid token. Try to re-login."}))
+        log.warning("JWTError")
+        await writer.send({"type": "error", "message": "Invalid token. Try to re-login."})
     except HTTPException as e:
-        print("HTTPException", e)
-        sys.stdout.flush()
+        log.warning("HTTPException %s", e)
         # connectionManager.disconnect(websocket)
+    finally:
+        metrics.WS_SESSION_SECONDS.observe(time.monotonic() - connected_at)
+        for task in requests.values():
+            task.cancel()   # only the delivery, the requests run on for a resume
+        if requests:
+            log.info("WebSocket disconnected, requests keep running for a resume", extra={"fields": {"requests": list(requests)}})
+        await writer.aclose()
+        if session is not None:
+            await session.cancel()
+        if upload_task is not None:
+            upload_task.cancel()
+            await asyncio.gather(upload_task, return_exceptions=True)
+        connectionManager.disconnect(connection)
+        try:
+            await settle_cancelled(spend, user)
+        except Exception as e:
+            log.exception("Billing cancelled calls failed: %s", e)
     # finally:
     #     if websocket.client_state == WebSocketState.CONNECTED:
     #         await websocket.close()
@@ -0,0 +1,106 @@
+"""
+Hedged LLM Calls
+Some OpenAI calls sit for seconds before their first token. With hedging on, a call that has
+no first token after the recent p95 (HEDGE_PERCENTILE) time to first token is sent again on
+another key. The stream that starts first is used and the other one is cancelled. Hedges are
+paid by the server, not the user, so a budget caps them at a fraction of all calls.
+"""
+
+import math
+import threading
+from collections import deque
+
+from metrics import LLM_HEDGE_COST, LLM_HEDGES
+
+MIN_SAMPLES = 50        # time to first token samples needed before the percentile is trusted
+WINDOW = 500            # recent samples kept per model
+MAX_CREDIT = 5.0        # hedges that can be saved up while calls are fast
+
+
+class Hedger:
+    """Decides when a call is hedged, and keeps the duplicate spend in bounds"""
+
+    def __init__(self):
+        self.enabled = False
+        self.percentile = 95.0
+        self.min_delay = 0.5        # never hedge earlier than this
+        self.default_delay = 2.0    # used until there are enough samples
+        self.budget = 0.05          # hedges per call
+        self._ttft: dict[str, deque] = {}
+        self._delay: dict[str, float] = {}
+        self._credit = 1.0
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.won = 0                # hedges that started first
+        self.over_budget = 0        # calls that would have been hedged
+        self.wasted_cost = 0.0
+        self.wasted_tokens = 0
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. Called again by the hourly reload."""
+        self.enabled = env.get("HEDGE_ENABLED", "false") == "true"
+        self.percentile = float(env.get("HEDGE_PERCENTILE", "95"))
+        self.min_delay = float(env.get("HEDGE_MIN_DELAY", "0.5"))
+        self.default_delay = float(env.get("HEDGE_DEFAULT_DELAY", "2"))
+        self.budget = float(env.get("HEDGE_BUDGET", "0.05"))
+        with self._lock:
+            self._delay.clear()
+
+    def observe(self, model: str, ttft: float) -> None:
+        with self._lock:
+            samples = self._ttft.get(model)
+            if samples is None:
+                samples = self._ttft[model] = deque(maxlen=WINDOW)
+            samples.append(ttft)
+            if len(samples) % 20 == 0:
+                self._delay.pop(model, None)    # recomputed on the next call
+
+    def delay(self, model: str) -> float:
+        """Seconds to wait for a first token before hedging"""
+        with self._lock:
+            self.calls += 1
+            self._credit = min(MAX_CREDIT, self._credit + self.budget)
+            delay = self._delay.get(model)
+            if delay is None:
+                samples = sorted(self._ttft.get(model, ()))
+                if len(samples) < MIN_SAMPLES:
+                    delay = self.default_delay
+                else:
+                    delay = samples[min(len(samples) - 1, math.ceil(len(samples) * self.percentile / 100) - 1)]
+                delay = self._delay[model] = max(self.min_delay, delay)
+            return delay
+
+    def allow(self, model: str) -> bool:
+        """Take one hedge from the budget, if there is one left"""
+        with self._lock:
+            if self._credit >= 1:
+                self._credit -= 1
+                self.hedged += 1
+                LLM_HEDGES.inc(1, model, "sent")
+                return True
+            self.over_budget += 1
+            LLM_HEDGES.inc(1, model, "over_budget")
+            return False
+
+    def settle(self, model: str, hedge_won: bool, wasted_cost: float, wasted_tokens: int) -> None:
+        """Outcome of a hedged call. The cost of the cancelled stream is the server's."""
+        with self._lock:
+            self.won += hedge_won
+            self.wasted_cost += wasted_cost
+            self.wasted_tokens += wasted_tokens
+        LLM_HEDGES.inc(1, model, "won" if hedge_won else "lost")
+        LLM_HEDGE_COST.inc(wasted_cost, model)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "delay": {model: round(d, 3) for model, d in self._delay.items()},
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "won": self.won,
+                "over_budget": self.over_budget,
+                "wasted_cost": round(self.wasted_cost, 6),
+                "wasted_tokens": self.wasted_tokens,
+            }
@@ -0,0 +1,180 @@
+"""
+OpenAI Key Scheduler
+Spreads LLM calls over the OpenAI keys according to each key's requests-per-minute and
+tokens-per-minute budget, its in-flight calls and recent 429 responses.
+"""
+
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+MAX_WAIT = 10.0             # seconds to wait for a key with spare budget before using the least bad one
+BASE_COOLDOWN = 2.0         # first cooldown after a 429, doubled on every further one
+MAX_COOLDOWN = 120.0
+DEFAULT_KEY_TPM = 30000     # OPENAI_KEY_TPM when .env has none
+
+
+class TokenBucket:
+    """Budget refilled continuously at `per_minute` units per minute"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.level
+
+    def has(self, amount: float, now: float) -> bool:
+        # a request larger than the whole bucket goes through when the bucket is full
+        return self.available(now) >= min(amount, self.capacity)
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= amount        # may go negative, paid back by the refill
+
+    def wait_time(self, amount: float, now: float) -> float:
+        missing = min(amount, self.capacity) - self.available(now)
+        return max(0.0, missing * 60 / self.capacity)
+
+    def resize(self, per_minute: float) -> None:
+        self.level = min(self.level, per_minute)
+        self.capacity = per_minute
+
+
+@dataclass
+class KeyState:
+    key: str
+    requests: TokenBucket
+    tokens: TokenBucket
+    in_flight: int = 0
+    cooldown_until: float = 0.0
+    strikes: int = 0                # 429s in a row
+    total_requests: int = 0
+    total_tokens: int = 0
+    rate_limited: int = 0
+
+
+@dataclass
+class KeyLease:
+    """A key handed out for one LLM call. Give it back with KeyScheduler.release."""
+    key: str
+    estimated_tokens: int
+    started: float = field(default_factory=time.monotonic)
+
+
+def mask_key(key: str) -> str:
+    return key[:3] + "..." + key[-4:] if len(key) > 10 else "***"
+
+
+class KeyScheduler:
+    """Picks the least loaded healthy key for every LLM call"""
+
+    def __init__(self, keys: list[str], rpm: float = 500, tpm: float = DEFAULT_KEY_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        self._states: dict[str, KeyState] = {}
+        self.reload(keys)
+
+    def configure(self, env: dict) -> None:
+        """Apply per-key limits from .env"""
+        self.rpm = float(env.get("OPENAI_KEY_RPM", "500"))
+        self.tpm = float(env.get("OPENAI_KEY_TPM", DEFAULT_KEY_TPM))
+        with self._lock:
+            for state in self._states.values():
+                state.requests.resize(self.rpm)
+                state.tokens.resize(self.tpm)
+
+    def reload(self, keys: list[str]) -> None:
+        """Swap in a new key list. Keys that stay keep their budget, load and cooldown."""
+        with self._lock:
+            self._states = {k: self._states.get(k) or KeyState(k, TokenBucket(self.rpm), TokenBucket(self.tpm))
+                            for k in dict.fromkeys(keys)}
+
+    def _load(self, state: KeyState, now: float) -> float:
+        # fraction of the tightest budget in use, plus in-flight calls as a tie breaker
+        used_requests = 1 - state.requests.available(now) / state.requests.capacity
+        used_tokens = 1 - state.tokens.available(now) / state.tokens.capacity
+        return max(used_requests, used_tokens) + state.in_flight * 0.01
+
+    def _pick(self, estimated_tokens: int, force: bool, exclude: tuple[str, ...]) -> Optional[KeyState]:
+        now = time.monotonic()
+        states = [s for s in self._states.values() if s.key not in exclude] or list(self._states.values())
+        ready = [s for s in states if s.cooldown_until <= now
+                 and s.requests.has(1, now) and s.tokens.has(estimated_tokens, now)]
+        if ready:
+            return min(ready, key=lambda s: self._load(s, now))
+        if force and states:
+            # nothing has budget left: take the key that frees up first
+            return min(states, key=lambda s: max(s.cooldown_until - now,
+                                                 s.requests.wait_time(1, now),
+                                                 s.tokens.wait_time(estimated_tokens, now)))
+        return None
+
+    def _next_ready(self, estimated_tokens: int) -> float:
+        now = time.monotonic()
+        return min((max(s.cooldown_until - now, s.requests.wait_time(1, now), s.tokens.wait_time(estimated_tokens, now))
+                    for s in self._states.values()), default=MAX_WAIT)
+
+    async def acquire(self, estimated_tokens: int, exclude: tuple[str, ...] = ()) -> KeyLease:
+        """
+        Lease a key for a call of about `estimated_tokens` (prompt plus expected output).
+        Waits up to MAX_WAIT for a key with spare budget, keys in `exclude` are only used as a last resort.
+        """
+        deadline = time.monotonic() + MAX_WAIT
+        while True:
+            force = time.monotonic() >= deadline
+            with self._lock:
+                state = self._pick(estimated_tokens, force, exclude)
+                if state is not None:
+                    now = time.monotonic()
+                    state.requests.take(1, now)
+                    state.tokens.take(estimated_tokens, now)
+                    state.in_flight += 1
+                    state.total_requests += 1
+                    return KeyLease(state.key, estimated_tokens)
+                wait = self._next_ready(estimated_tokens)
+            await asyncio.sleep(min(max(wait, 0.05), deadline - time.monotonic(), 1.0))
+
+    def release(self, lease: KeyLease, used_tokens: Optional[int] = None,
+                rate_limited: bool = False, retry_after: Optional[float] = None) -> None:
+        """Return a key. `used_tokens` corrects the estimate, `rate_limited` puts the key in cooldown."""
+        with self._lock:
+            state = self._states.get(lease.key)
+            if state is None:       # key was removed by a reload meanwhile
+                return
+            now = time.monotonic()
+            state.in_flight = max(0, state.in_flight - 1)
+            if used_tokens is not None:
+                state.tokens.take(used_tokens - lease.estimated_tokens, now)
+                state.total_tokens += used_tokens
+            if rate_limited:
+                state.rate_limited += 1
+                backoff = min(MAX_COOLDOWN, BASE_COOLDOWN * 2 ** state.strikes)
+                state.strikes += 1
+                state.cooldown_until = now + max(backoff, retry_after or 0)
+            else:
+                state.strikes = 0
+
+    def utilization(self) -> list[dict]:
+        """Per-key budget use, for /server/status. Keys are masked."""
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "key": mask_key(s.key),
+                "in_flight": s.in_flight,
+                "rpm_used": round(1 - s.requests.available(now) / s.requests.capacity, 3),
+                "tpm_used": round(1 - s.tokens.available(now) / s.tokens.capacity, 3),
+                "cooldown": round(max(0.0, s.cooldown_until - now), 1),
+                "requests": s.total_requests,
+                "tokens": s.total_tokens,
+                "rate_limited": s.rate_limited,
+            } for s in self._states.values()]
@@ -1,25 +1,36 @@
-import hprose, json, time, sys
+import asyncio, contextlib, functools, hprose, json, logging, threading, time, sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from utilities import UserInDB, UserOut, Purchase
 from dotenv import load_dotenv, dotenv_values
+from metrics import LEITHER_ERRORS, LEITHER_SECONDS, LEITHER_TIMEOUTS, timed
+from user_cache import TTLCache
 
 APPID_MIMEI_KEY: str = "FmKK37e1T0oGaQJXRMcMjyrmoxa"
 USER_ACCOUNT_KEY: str = "SECRETARI_APP_USER_ACCOUNT_KEY"
 MIMEI_EXT: str = "mimei file"
 MIMEI_COUPON_KEY: str = "SECRETARI_USER_COUPON_KEY"
 PRODUCTS={}     # in-app purchase products defined in Appconnect
+log = logging.getLogger("secretari.leither")
+billing_log = logging.getLogger("secretari.billing")
+
+SID_LIFETIME = 3600     # seconds a Leither session id is used before logging in again
 
 class LeitherAPI:
  
-    def __init__(self):
-        self.client = hprose.HttpClient('http://localhost:8081/webapi/')
+    def __init__(self, port=None, shared=None):
+        # with several workers, `shared` is the WorkerState through which they use one session id
+        self.shared = shared
+        self.url = f'http://localhost:{port or 8081}/webapi/'
+        self._local = threading.local()     # hprose clients per thread, calls run on a thread pool
+        self._sid_lock = threading.Lock()
+        self.users = TTLCache("user", 10000, 30)        # username: UserInDB, as last read or written here
+        self.mids = TTLCache("mid", 10000, 86400)       # username: mid. Derived from the name, it never changes.
         print(self.client.GetVar("", "ver"))
-        self.ppt = self.client.GetVarByContext("", "context_ppt")
-        self.api = self.client.Login(self.ppt)
-        self.sid = self.api.sid
-        self.uid = self.api.uid
+        self.sid_time = 0
+        self.get_sid()
+        self.uid = self.api.uid if self.api else None
         self.mid = self.client.MMCreate(self.sid, APPID_MIMEI_KEY, "App", "secretari backend", 2, 0x07276705)
-        self.sid_time = time.time()
 
         # user .env to update important parameters. To update app settings without reboot.
         self.load_env()
@@ -34,10 +45,14 @@ class LeitherAPI:
         self.init_balance = float(env["SIGNUP_BONUS"])
         self.cost_efficiency = float(env["COST_EFFICIENCY"])
         PRODUCTS = json.loads(env["SECRETARI_PRODUCT_ID_IOS"])["ver0"]["productIDs"]     #{"890842":8.99,"Yearly.bunny0":89.99,"monthly.bunny0":8.99}
+        size = int(env.get("USER_CACHE_SIZE", "10000"))
+        self.users.configure(size, float(env.get("USER_CACHE_TTL", "30")))
+        self.mids.configure(size, float(env.get("USER_MID_CACHE_TTL", "86400")))
         print("Products of the hour:", PRODUCTS)
 
     # keep a record of all the purchase and subscriptions a customer made.
     # process message from Apple notification server. UserId is the only identifier of the user.
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def recharge_user(self, userId: str, transaction: Purchase):
         mmsid = self.client.MMOpen("", self.mid, "last")
         user = UserInDB(**json.loads(self.client.Hget(mmsid, USER_ACCOUNT_KEY, userId)))
@@ -61,9 +76,11 @@ class LeitherAPI:
 
         self.client.MFSetObject(mmsid, json.dumps(user.model_dump()))
         self.client.MMBackup(self.sid, user.mid, "", "delRef=true")
+        self.users.put(user.username, user.model_copy(deep=True))
         print("After recharge:", user)
         return user
 
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def subscribed(self, userId: str, transaction: Purchase):
         mmsid = self.client.MMOpen("", self.mid, "last")
         user = UserInDB(**json.loads(self.client.Hget(mmsid, USER_ACCOUNT_KEY, userId)))
@@ -81,26 +98,74 @@ class LeitherAPI:
 
         self.client.MFSetObject(mmsid, json.dumps(user.model_dump()))
         self.client.MMBackup(self.sid, user.mid, "", "delRef=true")
+        self.users.put(user.username, user.model_copy(deep=True))
         print("After subscription:", user)
 
-    def get_sid(self) -> str:
-        if time.time() - self.sid_time > 3600:
-            self.ppt = self.client.GetVarByContext("", "context_ppt")   # get new ppt everytime
-            self.api = self.client.Login(self.ppt)
-            self.sid = self.api.sid
-            self.sid_time = time.time()
+    def update_port(self, port):
+        # Leither moved to another port. The session stays valid. Threads make new clients on their next call.
+        self.url = f'http://localhost:{port}/webapi/'
 
-            # reload some parameters. Every hour with the sid update
-            self.load_env()
+    @property
+    def client(self):
+        """This thread's hprose client. A client is not shared between threads."""
+        local = self._local
+        if getattr(local, "url", None) != self.url:
+            local.client = hprose.HttpClient(self.url)
+            local.url = self.url
+        return local.client
 
-            # publish data changes every hour
-            self.client.MiMeiPublish(self.sid, "", self.mid)
+    def get_sid(self) -> str:
+        if time.time() - self.sid_time > SID_LIFETIME:
+            with self._sid_lock:
+                self._refresh_sid()
         return self.sid
 
+    def _refresh_sid(self):
+        # under the lock, another thread may have refreshed it meanwhile
+        if time.time() - self.sid_time > SID_LIFETIME:
+            first = self.sid_time == 0
+            if self.shared is None:
+                self._login()
+            else:
+                # one worker logs in and publishes, the others pick up its session
+                with self.shared.locked("leither_session"):
+                    session = self.shared.read("leither_session")
+                    if session and time.time() - session["time"] <= SID_LIFETIME:
+                        self.api = None
+                        self.sid, self.sid_time = session["sid"], session["time"]
+                        log.info("Using the Leither session of worker %s", session["pid"])
+                    else:
+                        self._login()
+                        self.shared.write("leither_session", {"sid": self.sid, "time": self.sid_time, "pid": self.shared.pid})
+
+            if not first:
+                # reload some parameters. Every hour with the sid update
+                self.load_env()
+
+                # publish data changes every hour, by the worker that logged in
+                if self.api is not None:
+                    self.client.MiMeiPublish(self.sid, "", self.mid)
+
+    def _login(self):
+        self.ppt = self.client.GetVarByContext("", "context_ppt")   # get new ppt everytime
+        self.api = self.client.Login(self.ppt)
+        self.sid = self.api.sid
+        self.sid_time = time.time()
+
     def create_user_mm(self, username) -> str:
         # given username, get its corresponding mimei
-        return self.client.MMCreate(self.get_sid(), APPID_MIMEI_KEY, MIMEI_EXT, username, 1, 0x07276705)
+        mid = self.mids.get(username)
+        if mid is None:
+            mid = self.client.MMCreate(self.get_sid(), APPID_MIMEI_KEY, MIMEI_EXT, username, 1, 0x07276705)
+            self.mids.put(username, mid)
+        return mid
+
+    def cached_user(self, username) -> UserInDB:
+        """The user as last read or written by this process, if recent. A copy, the caller may change it."""
+        user = self.users.get(username)
+        return user.model_copy(deep=True) if user is not None else None
     
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def get_user_name(self, id):
         # given user id, find username from the index db
         mmsid = self.client.MMOpen(self.get_sid(), self.mid, "last")
@@ -109,6 +174,7 @@ class LeitherAPI:
             return None
         return json.loads(user_str).get("username")
 
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def register_temp_user(self, user: UserInDB) -> UserOut:
         user.mid = self.create_user_mm(user.username)
 
@@ -142,11 +208,13 @@ class LeitherAPI:
         self.client.Hset(mmsid, USER_ACCOUNT_KEY, user.id.upper(), user_str)    # user.id always as index to user object in main DB.
         self.client.MMBackup(self.sid, self.mid, "", "delRef=true")
         self.client.MiMeiPublish(self.sid, "", self.mid)
+        self.users.put(user.username, user.model_copy(deep=True))
         print("temp user created:", user)
         return UserOut(**user.model_dump())
 
     # The function is called when user create a real account by providing personal information.
     # Before it, a device identifier is used as username in temporary account, which will be deleted after registration. 
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def register_in_db(self, user_in: UserInDB) -> UserOut:
         mid = self.create_user_mm(user_in.username)
         mmsid = self.client.MMOpen(self.get_sid(), mid, "cur")
@@ -177,6 +245,7 @@ class LeitherAPI:
                 self.client.MMBackup(self.sid, self.mid, "", "delRef=true")
                 self.client.MMAddRef(self.sid, self.mid, mid)
                 self.client.MiMeiPublish(self.sid, "", self.mid)
+                self.users.put(user_in.username, user_in.model_copy(deep=True))
                 return UserOut(**user_in.model_dump())
 
             else:
@@ -214,13 +283,17 @@ class LeitherAPI:
                 self.client.MMBackup(self.sid, self.mid, "", "delRef=true")
                 self.client.MiMeiPublish(self.sid, "", self.mid)
                 self.client.MMDelVers(self.sid, user_in_db.mid)     # delete old mm created with user id
+                self.users.pop(user_in_db.username)
+                self.users.put(user_in_mm.username, user_in_mm.model_copy(deep=True))
 
                 return UserOut(**user_in_mm.model_dump())
         
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def update_user(self, user_in: UserInDB) -> UserOut:
         mmsid = self.client.MMOpen(self.get_sid(), user_in.mid, "cur")
         self.client.MFSetObject(mmsid, json.dumps(user_in.model_dump()))
         self.client.MMBackup(self.sid, user_in.mid, "", "delRef=true")
+        self.users.put(user_in.username, user_in.model_copy(deep=True))
 
         mmsid = self.client.MMOpen(self.sid, self.mid, "cur")
         self.client.Hset(mmsid, USER_ACCOUNT_KEY, user_in.id, json.dumps(user_in.model_dump()))     # update temp user account with registered one.
@@ -229,6 +302,7 @@ class LeitherAPI:
 
         return UserOut(**user_in.model_dump())
     
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def delete_user(self, user_in: UserInDB) -> dict:
         mmsid = self.client.MMOpen(self.get_sid(), self.mid, "last")
         user_in = UserInDB(**json.loads(self.client.Hget(mmsid, USER_ACCOUNT_KEY, user_in.id)))
@@ -237,24 +311,35 @@ class LeitherAPI:
         self.client.Hset(mmsid, USER_ACCOUNT_KEY, user_in.id, json.dumps(user_in.model_dump()))     # remove user from index db
         self.client.MMBackup(self.sid, self.mid, "", "delRef=true")
         self.client.MiMeiPublish(self.sid, "", self.mid)
+        self.users.pop(user_in.username)
         # self.client.MMDelRef(self.sid, self.mid, user_in.mid)     # remove reference to mimei
 
         #keep the mimei created from username, in case use re-register with the same username.
         return {"id": user_in.id}
 
     # After registration, username will be different from its identifier.
-    def get_user(self, username) -> UserInDB:
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
+    def get_user(self, username, fresh=False) -> UserInDB:
+        # fresh reads Leither even if the user is cached, for a record that is about to be written back
+        if not fresh:
+            user = self.cached_user(username)
+            if user is not None:
+                return user
+        started = time.monotonic()
         user_mid = self.create_user_mm(username)
         mmsid = self.client.MMOpen(self.get_sid(), user_mid, "cur")
         user = self.client.MFGetObject(mmsid)
         if user:
             # print("get_user() found: ", user_mid)
-            return UserInDB(**json.loads(user))
+            user = UserInDB(**json.loads(user))
+            self.users.fill(username, user.model_copy(deep=True), started)
+            return user
         else:
-            print("get_user() cannot found", username)
+            log.info("get_user() cannot find %s", username)
             return None
 
     # check user record in index db
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def get_user_in_db(self, user: UserInDB) -> UserInDB:
         mmsid = self.client.MMOpen(self.get_sid(), self.mid, "last")
         r = self.client.Hget(mmsid, USER_ACCOUNT_KEY, user.id)
@@ -266,6 +351,7 @@ class LeitherAPI:
                 return None
             return user_in_db
         
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def cash_coupon(self, user_in: UserInDB, coupon: str):
         mmsid = self.client.MMOpen(self.get_sid(), self.mid, "cur")
         coupon_in_db = self.client.Hget(mmsid, MIMEI_COUPON_KEY, coupon)
@@ -277,6 +363,7 @@ class LeitherAPI:
         user_in.dollar_balance += coupon_in_db.amount
         self.client.MFSetObject(mmsid, json.dumps(user_in.model_dump()))
         self.client.MMBackup(self.sid, user_in.mid, "", "delRef=true")
+        self.users.put(user_in.username, user_in.model_copy(deep=True))
 
         coupon_in_db.redeemed = True
         coupon_in_db.expiration_date = time.time()
@@ -285,6 +372,7 @@ class LeitherAPI:
         self.client.MiMeiPublish(self.sid, "", self.mid)
         return True
 
+    @timed(LEITHER_SECONDS, LEITHER_ERRORS)
     def bookkeeping(self, total_cost: float, token_cost: int, user_in_db: UserInDB):
         # update monthly expense. Times the cost efficiency to include profit.
         dollar_cost = total_cost * self.cost_efficiency
@@ -299,9 +387,110 @@ class LeitherAPI:
         else:
             user_in_db.monthly_usage[str(current_month)] += dollar_cost     # usage of the month
         user_in_db.timestamp = time.time()
-        print("In bookkeeper, user in db:", UserOut(**user_in_db.model_dump()))
-        sys.stdout.flush()
+        billing_log.info("Bookkeeping", extra={"fields": {
+            "user": user_in_db.username, "cost": dollar_cost, "tokens": int(token_cost * self.cost_efficiency),
+            "balance": user_in_db.dollar_balance}})
         
         mmsid_cur = self.client.MMOpen(self.get_sid(), user_in_db.mid, "cur")
         self.client.MFSetObject(mmsid_cur, json.dumps(user_in_db.model_dump()))
         self.client.MMBackup(self.sid, user_in_db.mid, "", "delRef=true")
+        self.users.put(user_in_db.username, user_in_db.model_copy(deep=True))
+
+
+class LeitherTimeout(Exception):
+    """A Leither call did not return in time. Answered with 503, on a WebSocket as a "storage_busy" error."""
+    code = "storage_busy"
+
+    def __init__(self, message: str, retry_after: float = 5.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# methods that write a user record. They are awaited to the end, whatever LEITHER_TIMEOUT says.
+WRITES = ("bookkeeping", "recharge_user", "subscribed", "update_user", "delete_user", "cash_coupon",
+          "register_in_db", "register_temp_user")
+
+
+class AsyncLeitherAPI:
+    """
+    The LeitherAPI methods as coroutines, for the event loop. hprose is synchronous, so calls run
+    on a small thread pool and a storage round trip never stalls other connections. At most
+    `workers` calls run at once, the rest queue for a thread. A read not done within `timeout`,
+    queueing included, raises LeitherTimeout. One that already started finishes in its thread.
+    Writes, and the read before billing, have no deadline, see WRITES.
+
+        user = await lapi.get_user(username)
+    """
+
+    def __init__(self, sync: LeitherAPI, workers: int = 8, timeout: float = 10.0):
+        self.sync = sync        # for callers that are on a thread already, such as the scheduler
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="leither")
+        self.active = 0         # calls submitted and not done, running or queued
+        self.calls = 0
+        self.timeouts = 0
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. Called again by the hourly reload, the pool size only at start."""
+        self.timeout = float(env.get("LEITHER_TIMEOUT", "10"))
+
+    def __getattr__(self, name: str):
+        # settings such as cost_efficiency are read as they are, methods become coroutines
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return call
+
+    async def get_user(self, username, fresh=False):
+        # a cached user is answered on the loop, without a trip to the thread pool
+        if not fresh:
+            user = self.sync.cached_user(username)
+            if user is not None:
+                return user
+        return await self.run(self.sync.get_user, username, True)
+
+    async def get_user_to_bill(self, username):
+        """
+        Fresh read of a record about to be billed, under the user's lock. No deadline, as for writes:
+        the output was streamed and paid for, giving up here would leave it unbilled.
+        """
+        return await self._submit(self.sync.get_user, username, True)
+
+    def user_lock(self, username: str):
+        """The user's lock across workers, held around reading, changing and writing back the record"""
+        return self.sync.shared.user_lock(username) if self.sync.shared is not None else contextlib.nullcontext()
+
+    def _submit(self, fn, *args, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+        self.calls += 1
+        self.active += 1
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        future = self._submit(fn, *args, **kwargs)
+        if fn.__name__ in WRITES:
+            # no deadline: the caller holds the user's lock, a write given up on would race the next one
+            return await future
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            LEITHER_TIMEOUTS.inc(1, fn.__name__)
+            log.warning("Leither call %s timed out after %ss", fn.__name__, self.timeout)
+            raise LeitherTimeout("Storage service not responding. Please try again.", self.timeout)
+
+    def _done(self, future) -> None:
+        self.active -= 1
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "active": self.active, "calls": self.calls, "timeouts": self.timeouts,
+                "cache": {"user": self.sync.users.stats(), "mid": self.sync.mids.stats()}}
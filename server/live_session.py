@@ -0,0 +1,137 @@
+"""
+Live Summarization Session
+Incremental summarization of a recording that is still in progress. The client appends
+transcript segments as they are recognized. Every chunk that is complete is summarized
+once, in the background, and kept. A rolling memo is available at any time, and the final
+memo merges the kept summaries instead of reprocessing the whole transcript.
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Optional, Union
+
+from llm_cache import ResponseCache
+from summarizer import ChunkResult, Spend, merge_summaries, summarize_chunks
+
+log = logging.getLogger("secretari.llm")
+
+ChunkHandler = Callable[[ChunkResult], Awaitable[None]]
+
+
+class LiveSession:
+    """Per-connection state of a live recording: the open tail of the transcript and finished chunk summaries"""
+
+    def __init__(self, llm, prompt: str, model_name: str, split: Callable[[str], list[str]],
+                 on_chunk: ChunkHandler, concurrency: int = 1,
+                 cache: Optional[ResponseCache] = None, temperature: float = 0.0,
+                 spend: Optional[Spend] = None, reduce_tokens: int = 0):
+        self.llm = llm
+        self.prompt = prompt
+        self.model_name = model_name
+        self.split = split                  # the request's text splitter
+        self.on_chunk = on_chunk            # called with the result of every chunk summarized in the background
+        self.concurrency = concurrency
+        self.cache = cache
+        self.temperature = temperature
+        self.spend = spend                  # usage of calls cut off when the session is cancelled
+        self.reduce_tokens = reduce_tokens  # largest input of a merge call, the chunk size of a plain request
+        self.tail = ""                      # text not yet part of a complete chunk
+        self.summaries: dict[int, str] = {}
+        self.unsummarized: dict[int, str] = {}  # chunks cut but without a summary yet
+        self.chunk_count = 0                # chunks cut so far, summarized or not
+        self._tasks: set[asyncio.Task] = set()
+        self.stopped = False
+
+    @property
+    def pending(self) -> int:
+        return len(self.unsummarized)
+
+    def append(self, text: str) -> int:
+        """
+        Add a transcript segment. Chunks that are complete now are sent to the LLM in the background.
+        Returns the number of new chunks.
+        """
+        if self.stopped:
+            raise RuntimeError("Session already stopped")
+        self.tail += text
+        chunks = self.split(self.tail)
+        if len(chunks) < 2:
+            return 0
+        # the last piece may still grow, everything before it is final
+        complete, self.tail = chunks[:-1], chunks[-1]
+        first = self.chunk_count
+        self.chunk_count += len(complete)
+        for i, chunk in enumerate(complete):
+            self.unsummarized[first + i] = chunk
+        task = asyncio.create_task(self._summarize(first, complete))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return len(complete)
+
+    async def _summarize(self, first: int, chunks: list[str]) -> None:
+        try:
+            async for item in summarize_chunks(self.llm, self.prompt, chunks, self.model_name,
+                                               self.concurrency, False, self.cache, self.temperature, self.spend):
+                if isinstance(item, ChunkResult):
+                    item.index += first
+                    item.eof = False
+                    self.summaries[item.index] = item.text
+                    self.unsummarized.pop(item.index, None)
+                    await self.on_chunk(item)
+        except Exception as e:
+            # the chunks stay unsummarized and are retried when the session stops
+            log.warning("Live session chunk %d failed: %s", first, e)
+
+    def memo(self) -> str:
+        """Rolling memo: the summaries finished so far, in transcript order"""
+        return "\n\n".join(self.summaries[i] for i in sorted(self.summaries))
+
+    async def stop(self) -> AsyncIterator[Union[str, ChunkResult]]:
+        """
+        Finish the session. Waits for background chunks, summarizes the open tail and merges
+        all summaries. Yields stream deltas and results like summarize_chunks, the last result
+        has eof set and carries the final memo.
+        """
+        self.stopped = True
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        for chunk in (self.split(self.tail) if self.tail.strip() else []):
+            self.unsummarized[self.chunk_count] = chunk
+            self.chunk_count += 1
+        self.tail = ""
+        indices = sorted(self.unsummarized)
+        do_merge = self.chunk_count > 1
+        final = None
+        async for item in summarize_chunks(self.llm, self.prompt, [self.unsummarized[i] for i in indices],
+                                           self.model_name, self.concurrency, False, self.cache, self.temperature,
+                                           self.spend):
+            if isinstance(item, ChunkResult):
+                item.index = indices[item.index]
+                item.eof = not do_merge and item.index == self.chunk_count - 1
+                self.summaries[item.index] = item.text
+                self.unsummarized.pop(item.index, None)
+                final = item if item.eof else None
+            yield item
+
+        if do_merge:
+            summaries = [self.summaries[i] for i in sorted(self.summaries)]
+            async for item in merge_summaries(self.llm, self.prompt, summaries, self.model_name,
+                                              self.cache, self.temperature, self.spend, self.concurrency,
+                                              self.reduce_tokens):
+                yield item
+        elif final is None:
+            # nothing left to summarize: the memo we have is the final one
+            yield ChunkResult(self.chunk_count, self.memo(), 0, 0.0, eof=True, reduced=True)
+
+    def close(self) -> None:
+        """Drop the session, e.g. when the client disconnects"""
+        self.stopped = True
+        for task in self._tasks:
+            task.cancel()
+
+    async def cancel(self) -> None:
+        """Drop the session and wait until its calls are cancelled, so `spend` is complete"""
+        tasks = list(self._tasks)
+        self.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
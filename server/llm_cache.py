@@ -0,0 +1,257 @@
+"""
+LLM Response Cache
+Content-addressed cache of LLM answers, so that a transcript resent with the same prompt
+is not summarized again. An in-memory LRU tier sits in front of an optional on-disk tier,
+whose file access runs on threads, never on the event loop.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+log = logging.getLogger("secretari.llm")
+
+BILLING_POLICIES = ("full", "discount", "free")
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,          -- bytes of the file
+    used REAL NOT NULL              -- last written or read
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL          -- sum of entries.size, kept by the triggers below
+);
+CREATE TRIGGER IF NOT EXISTS entries_added AFTER INSERT ON entries
+    BEGIN UPDATE usage SET bytes = bytes + NEW.size; END;
+CREATE TRIGGER IF NOT EXISTS entries_removed AFTER DELETE ON entries
+    BEGIN UPDATE usage SET bytes = bytes - OLD.size; END;
+CREATE TRIGGER IF NOT EXISTS entries_resized AFTER UPDATE OF size ON entries
+    BEGIN UPDATE usage SET bytes = bytes - OLD.size + NEW.size; END;
+INSERT OR IGNORE INTO usage (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM entries;
+"""
+
+
+@dataclass
+class CachedResponse:
+    text: str
+    total_tokens: int
+    total_cost: float
+    created: float
+
+
+class ResponseCache:
+    """Two tier cache keyed on hash(prompt, chunk, model, temperature)"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 86400, disk_dir: str = "",
+                 disk_bytes: int = 256 * 1024 * 1024, billing: str = "full", discount: float = 0.5):
+        self.max_entries = max_entries      # 0 disables the cache
+        self.ttl = ttl                      # seconds an answer stays valid, in both tiers
+        self.disk_dir = disk_dir            # empty string disables the disk tier
+        self.disk_bytes = disk_bytes        # byte budget of the disk tier
+        self.billing = billing              # how a hit is charged, one of BILLING_POLICIES
+        self.discount = discount            # fraction of the original cost charged by the "discount" policy
+        self._memory: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._local = threading.local()     # index connection per thread
+        self._disk_used = 0                 # bytes of the disk tier, all workers, as of the last disk access
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls, env: dict) -> "ResponseCache":
+        cache = cls()
+        cache.configure(env)
+        return cache
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. Called again by the hourly reload."""
+        self.max_entries = int(env.get("RESPONSE_CACHE_SIZE", "1024"))
+        self.ttl = float(env.get("RESPONSE_CACHE_TTL", "86400"))
+        self.disk_dir = env.get("RESPONSE_CACHE_DIR", "")
+        self.disk_bytes = int(float(env.get("RESPONSE_CACHE_DISK_MB", "256")) * 1024 * 1024)
+        billing = env.get("CACHE_HIT_BILLING", "full")
+        self.billing = billing if billing in BILLING_POLICIES else "full"
+        self.discount = float(env.get("CACHE_HIT_DISCOUNT", "0.5"))
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    @staticmethod
+    def make_key(prompt: str, chunk: str, model: str, temperature: float) -> str:
+        h = hashlib.sha256()
+        for part in (prompt, chunk, model, repr(float(temperature))):
+            data = part.encode("utf-8")
+            h.update(len(data).to_bytes(8, "big"))  # length prefix, so fields cannot run into each other
+            h.update(data)
+        return h.hexdigest()
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        if self.max_entries <= 0:
+            return None
+        entry = self._memory.get(key)
+        if entry is not None and self._expired(entry):
+            del self._memory[key]
+            entry = None
+        if entry is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        entry = await asyncio.to_thread(self._disk_get, key) if self.disk_dir else None
+        if entry is not None:
+            self._remember(key, entry)
+            self.hits += 1
+            self.disk_hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, text: str, total_tokens: int, total_cost: float) -> None:
+        if self.max_entries <= 0:
+            return
+        entry = CachedResponse(text, total_tokens, total_cost, time.time())
+        self._remember(key, entry)
+        if self.disk_dir:
+            await asyncio.to_thread(self._disk_put, key, entry)
+
+    def charge(self, total_cost: float, total_tokens: int) -> tuple[float, int]:
+        """Cost and tokens billed to the user for a cache hit"""
+        if self.billing == "free":
+            return 0.0, 0
+        if self.billing == "discount":
+            return total_cost * self.discount, int(total_tokens * self.discount)
+        return total_cost, total_tokens
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_bytes": self._disk_used,
+            "billing": self.billing,
+        }
+
+    def _expired(self, entry: CachedResponse) -> bool:
+        return time.time() - entry.created > self.ttl
+
+    def _remember(self, key: str, entry: CachedResponse) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    # Disk tier: one small json file per answer, run on threads. An SQLite index in the directory, shared by
+    # the workers, keeps the size and last use of every file, so the byte budget holds for all of them.
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _index(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None or getattr(self._local, "dir", None) != self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            path = os.path.join(self.disk_dir, "index.db")
+            new = not os.path.exists(path)
+            db = sqlite3.connect(path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("BEGIN IMMEDIATE;" + INDEX_SCHEMA + "COMMIT;")    # the total is summed once, by the first worker
+            self._local.db, self._local.dir = db, self.disk_dir
+            if new:
+                self._index_files(db)
+            self._disk_used = self._usage(db)
+        return db
+
+    @staticmethod
+    def _usage(db: sqlite3.Connection) -> int:
+        # bytes of the disk tier, a running total shared by the workers
+        return db.execute("SELECT bytes FROM usage").fetchone()[0]
+
+    def _index_files(self, db: sqlite3.Connection) -> None:
+        # a directory filled before the index existed, walked once
+        rows = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    try:
+                        st = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    rows.append((name[:-5], st.st_size, st.st_mtime))
+        db.executemany("INSERT OR IGNORE INTO entries (key, size, used) VALUES (?, ?, ?)", rows)
+
+    def _disk_get(self, key: str) -> Optional[CachedResponse]:
+        try:
+            with open(self._path(key), "r") as f:
+                entry = CachedResponse(**json.load(f))
+            db = self._index()
+            if self._expired(entry):
+                self._disk_remove(db, [key])
+                return None
+            db.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        except (OSError, ValueError, TypeError, sqlite3.Error):
+            return None
+        return entry
+
+    def _disk_put(self, key: str, entry: CachedResponse) -> None:
+        data = json.dumps(asdict(entry)).encode("utf-8")
+        if len(data) > self.disk_bytes:
+            return
+        path = self._path(key)
+        try:
+            db = self._index()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"     # writers of the same answer do not collide
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            db.execute("INSERT INTO entries (key, size, used) VALUES (?, ?, ?) "
+                       "ON CONFLICT (key) DO UPDATE SET size = excluded.size, used = excluded.used",
+                       (key, len(data), time.time()))
+            self._disk_used = self._usage(db)
+            if self._disk_used > self.disk_bytes:
+                self._evict_disk(db)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Response cache write failed: %s", e)
+
+    def _disk_remove(self, db: sqlite3.Connection, keys: list[str]) -> None:
+        db.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in keys])
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _evict_disk(self, db: sqlite3.Connection) -> None:
+        # drop answers unused for the TTL, then the least recently used until usage is under 90% of the budget
+        db.execute("BEGIN IMMEDIATE")     # one worker evicts at a time
+        try:
+            evict, used = [], self._usage(db)
+            stale = time.time() - self.ttl
+            for key, size, last_used in db.execute("SELECT key, size, used FROM entries ORDER BY used"):
+                if last_used >= stale and used <= self.disk_bytes * 0.9:
+                    break
+                evict.append(key)
+                used -= size
+            db.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in evict])
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+        self._disk_used = used
+        for key in evict:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
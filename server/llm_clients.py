@@ -0,0 +1,262 @@
+"""
+LLM Client Registry
+Keeps long-lived chat clients per (API key, model), all sharing one keep-alive
+HTTP connection pool, instead of building a new client for every request.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import AsyncIterator, Optional
+
+import httpx
+import openai
+from langchain_community.callbacks.manager import openai_callback_var
+from langchain_openai import ChatOpenAI
+
+from admission import AdmissionController, Flow
+from hedging import Hedger
+from key_scheduler import KeyScheduler, mask_key
+from metrics import LLM_CALLS, LLM_DURATION, LLM_TTFT
+from openaiCBHandler import CostTrackerCallback
+from prompt_layout import prompt_text
+
+log = logging.getLogger("secretari.llm")
+
+OUTPUT_RESERVE = 512        # tokens of output assumed per call when leasing a key
+MAX_KEY_ATTEMPTS = 3        # keys tried when OpenAI answers 429 before the first token
+_END = object()             # end of an attempt's stream in a hedged call
+
+
+class LLMClientRegistry:
+    """Long-lived ChatOpenAI instances per (API key, model). Temperature is passed per call."""
+
+    def __init__(self, keys: list[str], max_connections: int = 200, max_keepalive: int = 50,
+                 keepalive_expiry: float = 60.0, timeout: float = 120.0, base_url: Optional[str] = None):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(timeout, connect=10.0),
+        )
+        self._lock = threading.Lock()
+        self._keys: tuple[str, ...] = tuple(keys)
+        self.base_url = base_url or None        # another OpenAI compatible server, e.g. mock_llm_server.py
+        self._clients: dict[tuple[str, str], ChatOpenAI] = {}
+
+    @property
+    def keys(self) -> tuple[str, ...]:
+        return self._keys
+
+    def reload(self, keys: list[str], base_url: Optional[str] = None) -> None:
+        """
+        Swap in a new key list, e.g. after .env is reloaded. Clients of keys that are still
+        listed are kept, the others are dropped. Requests already streaming keep their client.
+        A new base_url drops all clients.
+        """
+        keys, base_url = tuple(keys), base_url or None
+        with self._lock:
+            if base_url != self.base_url:
+                clients = {}
+            else:
+                clients = {k: v for k, v in self._clients.items() if k[0] in keys}
+            self._keys, self._clients, self.base_url = keys, clients, base_url
+
+    def get(self, model: str, api_key: Optional[str] = None) -> ChatOpenAI:
+        """Client of the given key and model. A random key from the list is used if none is given."""
+        keys, clients = self._keys, self._clients
+        if api_key is None:
+            api_key = random.choice(keys)
+        client = clients.get((api_key, model))
+        if client is None:
+            client = ChatOpenAI(
+                api_key = api_key,
+                model = model,
+                streaming = True,
+                verbose = True,
+                max_retries = 0,                        # 429s are retried on another key by ScheduledLLM
+                stream_usage = True,                    # usage, with cached prompt tokens, at the end of the stream
+                http_async_client = self.http_client,   # connections are reused across keys and models
+                base_url = self.base_url,               # None is the OpenAI API
+            )
+            with self._lock:
+                if api_key in self._keys:
+                    client = self._clients.setdefault((api_key, model), client)
+        return client
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+
+def estimate_tokens(text: str) -> int:
+    # cheap upper estimate: English runs ~4 characters a token, CJK close to 1
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def _retry_after(e: openai.RateLimitError) -> Optional[float]:
+    try:
+        return float(e.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class ScheduledLLM:
+    """
+    Chat model of one request. Every call first waits for a slot from the admission
+    controller, if any, then leases a key from the KeyScheduler and uses the pooled
+    client of that key. A call rejected with 429 before streaming anything is retried
+    on another key. With a Hedger, a call slow to start is raced against one on another key.
+    """
+
+    def __init__(self, registry: LLMClientRegistry, scheduler: KeyScheduler, model: str, temperature: float,
+                 admission: Optional[AdmissionController] = None, flow: Optional[Flow] = None,
+                 hedger: Optional[Hedger] = None):
+        self.registry = registry
+        self.scheduler = scheduler
+        self.model = model
+        self.temperature = temperature
+        self.admission = admission
+        self.flow = flow
+        self.hedger = hedger
+
+    def _stream(self, prompt) -> AsyncIterator:
+        if self.hedger is not None and self.hedger.enabled and len(self.registry.keys) > 1:
+            return self._hedged(prompt)
+        return self._astream(prompt)
+
+    async def astream(self, prompt) -> AsyncIterator:
+        if self.admission is None:
+            async for piece in self._stream(prompt):
+                yield piece
+            return
+        async with self.admission.slot(self.flow):
+            async for piece in self._stream(prompt):
+                yield piece
+
+    async def _hedged(self, prompt) -> AsyncIterator:
+        """
+        Stream of the first call to start. Every attempt runs in its own task with its own cost
+        tracker, and only the winner's usage reaches the tracker of the request, so the user is
+        billed for one call.
+        """
+        outer = openai_callback_var.get()
+        queue: asyncio.Queue = asyncio.Queue()     # (attempt, piece, _END or exception)
+        attempts: list[tuple[asyncio.Task, Optional[CostTrackerCallback], list[str]]] = []
+
+        def launch(avoid: tuple[str, ...]) -> None:
+            number = len(attempts)
+            tracker = CostTrackerCallback(outer.model_name, outer.known_prompt_tokens) \
+                if isinstance(outer, CostTrackerCallback) else None
+            keys: list[str] = []
+
+            async def run():
+                openai_callback_var.set(tracker)    # private to this task's context
+                try:
+                    async for piece in self._astream(prompt, avoid, keys):
+                        queue.put_nowait((number, piece))
+                    queue.put_nowait((number, _END))
+                except Exception as e:
+                    queue.put_nowait((number, e))
+            attempts.append((asyncio.create_task(run()), tracker, keys))
+
+        def sync(tracker: Optional[CostTrackerCallback]) -> None:
+            # progress of the winner, for the partial bill should the request be cancelled
+            if tracker is not None and isinstance(outer, CostTrackerCallback):
+                outer.prompt_tokens = tracker.prompt_tokens
+                outer.completion_tokens = tracker.completion_tokens
+                outer.cached_tokens = tracker.cached_tokens
+
+        launch(())
+        delay = self.hedger.delay(self.model)
+        deadline = time.monotonic() + delay
+        winner, item, failed = None, None, 0
+        try:
+            while winner is None:
+                timeout = max(0.0, deadline - time.monotonic()) if deadline else None
+                try:
+                    number, item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    deadline = None
+                    if self.hedger.allow(self.model):
+                        log.info("No first token after %.2fs, hedging on another key", delay)
+                        launch(tuple(attempts[0][2]))
+                    continue
+                if isinstance(item, Exception):
+                    failed += 1
+                    if failed == len(attempts):
+                        raise item      # nothing left to wait for
+                    continue
+                winner = number
+
+            # the other stream is cancelled, what it used so far is the server's cost
+            wasted_cost, wasted_tokens = 0.0, 0
+            for number, (task, tracker, _) in enumerate(attempts):
+                if number != winner and not task.done():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    if tracker is not None:
+                        cost, tokens = tracker.partial_usage()
+                        wasted_cost += cost
+                        wasted_tokens += tokens
+            if len(attempts) > 1:
+                self.hedger.settle(self.model, winner > 0, wasted_cost, wasted_tokens)
+
+            tracker = attempts[winner][1]
+            while item is not _END:
+                if isinstance(item, Exception):
+                    raise item
+                sync(tracker)
+                yield item
+                number, item = await queue.get()
+                while number != winner:
+                    number, item = await queue.get()
+            sync(tracker)
+            if tracker is not None and isinstance(outer, CostTrackerCallback):
+                outer.total_cost += tracker.total_cost
+                outer.total_tokens = tracker.total_tokens
+                outer.successful_requests += tracker.successful_requests
+        finally:
+            for task, _, _ in attempts:
+                task.cancel()
+            await asyncio.gather(*(task for task, _, _ in attempts), return_exceptions=True)
+
+    async def _astream(self, prompt, avoid: tuple[str, ...] = (), leased: Optional[list[str]] = None) -> AsyncIterator:
+        estimated = estimate_tokens(prompt_text(prompt)) + OUTPUT_RESERVE
+        tried: tuple[str, ...] = avoid
+        for attempt in range(MAX_KEY_ATTEMPTS):
+            lease = await self.scheduler.acquire(estimated, exclude=tried)
+            tried += (lease.key,)
+            if leased is not None:
+                leased.append(lease.key)
+            llm = self.registry.get(self.model, lease.key).bind(temperature=self.temperature)
+            streamed = 0
+            key = mask_key(lease.key)
+            started = time.perf_counter()
+            try:
+                async for piece in llm.astream(prompt):
+                    if not streamed:
+                        LLM_TTFT.observe(time.perf_counter() - started, self.model, key)
+                        if self.hedger is not None:
+                            self.hedger.observe(self.model, time.perf_counter() - started)
+                    streamed += 1
+                    yield piece
+            except openai.RateLimitError as e:
+                LLM_CALLS.inc(1, self.model, key, "rate_limited")
+                self.scheduler.release(lease, rate_limited=True, retry_after=_retry_after(e))
+                if streamed or attempt == MAX_KEY_ATTEMPTS - 1:
+                    raise
+                log.warning("OpenAI key rate limited, retrying on another key (%d/%d)", attempt + 1, MAX_KEY_ATTEMPTS)
+                continue
+            except BaseException as e:
+                LLM_CALLS.inc(1, self.model, key, "cancelled" if isinstance(e, (GeneratorExit, asyncio.CancelledError)) else "error")
+                self.scheduler.release(lease)
+                raise
+            LLM_CALLS.inc(1, self.model, key, "ok")
+            LLM_DURATION.observe(time.perf_counter() - started, self.model, key)
+            # one streamed piece is about one token
+            self.scheduler.release(lease, used_tokens=estimated - OUTPUT_RESERVE + streamed)
+            return
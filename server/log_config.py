@@ -0,0 +1,163 @@
+"""
+Logging
+Log records are put on a queue by the caller and written by a listener thread, so a slow
+stdout under systemd never blocks the event loop. Records are JSON lines with the fields
+passed in `extra={"fields": {...}}`, long values are truncated, levels can be set per
+category, and per-token debug output is sampled. LOG_VERBOSE=true turns all of that off
+again for debugging: everything at DEBUG, nothing truncated, every token logged.
+
+    log = logging.getLogger("secretari.ws")
+    log.info("Incoming event", extra={"fields": redact_event(event)})
+"""
+
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Optional
+
+CATEGORIES = ("ws", "llm", "tokens", "billing", "leither", "apple")    # loggers below "secretari."
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_formatter: Optional["JsonFormatter"] = None
+_samplers: list["SampleFilter"] = []
+_verbose = False
+
+
+def truncate(value, limit: int):
+    """Cut long strings to `limit` characters, saying how much was left out"""
+    if limit and isinstance(value, str) and len(value) > limit:
+        return value[:limit] + f"...(+{len(value) - limit} chars)"
+    return value
+
+
+def redact_event(event: dict) -> dict:
+    """A client event without its transcript, which can be megabytes. Keeps the lengths."""
+    if _verbose:
+        return event
+    event = dict(event)
+    if isinstance(event.get("input"), dict) and "rawtext" in event["input"]:
+        event["input"] = dict(event["input"], rawtext=f"<{len(event['input']['rawtext'] or '')} chars>")
+    if isinstance(event.get("text"), str):
+        event["text"] = f"<{len(event['text'])} chars>"
+    if isinstance(event.get("data"), str):
+        event["data"] = f"<{len(event['data'])} chars>"
+    return event
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the record's fields"""
+
+    def __init__(self, max_field: int = 500):
+        super().__init__()
+        self.max_field = max_field      # 0 keeps values whole
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": truncate(record.getMessage(), self.max_field),
+        }
+        for key, value in (getattr(record, "fields", None) or {}).items():
+            entry[key] = self._clip(value)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def _clip(self, value):
+        if isinstance(value, dict):
+            return {k: self._clip(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._clip(v) for v in value]
+        return truncate(value, self.max_field)
+
+
+class SampleFilter(logging.Filter):
+    """Lets one record in `every` through, for output that would otherwise come per token"""
+
+    def __init__(self, every: int = 100):
+        super().__init__()
+        self.every = max(1, every)
+        self._count = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return next(self._count) % self.every == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only merge the message arguments here, the formatting happens in the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_logging(env: dict) -> None:
+    """Route all logging through the queue. Called once at startup."""
+    global _listener, _formatter
+    if _listener is not None:
+        return
+    if env.get("LOG_FILE"):
+        output = logging.handlers.WatchedFileHandler(env["LOG_FILE"], encoding="utf-8")    # works with logrotate
+    else:
+        output = logging.StreamHandler(sys.stdout)
+    if env.get("LOG_FORMAT", "json") == "text":
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        _formatter = JsonFormatter()
+        output.setFormatter(_formatter)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    configure_logging(env)
+
+
+def configure_logging(env: dict) -> None:
+    """
+    Apply levels from .env. Called again by the hourly reload.
+        LOG_LEVEL=INFO                  all categories
+        LOG_LEVELS=ws=DEBUG,llm=WARNING  single categories
+        LOG_TOKEN_SAMPLE=100            log one stream delta in 100 when "tokens" is at DEBUG
+        LOG_MAX_FIELD=500               characters kept of long values
+        LOG_VERBOSE=true                everything at DEBUG, untruncated, every token, whole transcripts
+    """
+    global _verbose
+    verbose = _verbose = env.get("LOG_VERBOSE", "false") == "true"
+    default = "DEBUG" if verbose else env.get("LOG_LEVEL", "INFO").upper()
+    logging.getLogger().setLevel(default)
+    levels = {}
+    for item in filter(None, (env.get("LOG_LEVELS") or "").split(",")):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    for name in CATEGORIES:
+        logging.getLogger("secretari." + name).setLevel("DEBUG" if verbose else levels.get(name, default))
+
+    tokens = logging.getLogger("secretari.tokens")
+    for sampler in _samplers:
+        tokens.removeFilter(sampler)
+    _samplers.clear()
+    if not verbose:
+        _samplers.append(SampleFilter(int(env.get("LOG_TOKEN_SAMPLE", "100"))))
+        tokens.addFilter(_samplers[0])
+    if _formatter is not None:
+        _formatter.max_field = 0 if verbose else int(env.get("LOG_MAX_FIELD", "500"))
+
+
+def shutdown_logging() -> None:
+    """Write out what is still queued"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,248 @@
+"""
+Metrics
+Counters, gauges and histograms rendered in the Prometheus text format for /metrics.
+Kept in-house and small: an update is a dict lookup and a few additions under a lock,
+cheap enough to leave on for every token path in production.
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import math
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+log = logging.getLogger("secretari.ws")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labelvalues: tuple) -> tuple:
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        return tuple(str(v) for v in labelvalues)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key: tuple, value) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, *labelvalues) -> None:
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labelvalues) -> None:
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, *labelvalues) -> None:
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, *labelvalues) -> None:
+        self.inc(-amount, *labelvalues)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues) -> None:
+        key = self._key(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)     # first bucket with bound >= value
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labelvalues) -> "_Timer":
+        """Context manager observing the seconds its block took"""
+        return _Timer(self, labelvalues)
+
+    def _samples(self, key: tuple, value) -> list[str]:
+        counts, total, count = value
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            le = 'le="%s"' % _number(bound)
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labelvalues: tuple):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labelvalues)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+        self._collectors: list[Callable[[], None]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect: Callable[[], None]) -> None:
+        """Called before every scrape, to set gauges that are read from elsewhere"""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception:
+                # the scrape goes on with the gauges as last set
+                log.exception("Metrics collector failed")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# WebSocket
+WS_CONNECTIONS = REGISTRY.register(Gauge("secretari_websocket_connections", "Open WebSocket connections"))
+WS_SESSIONS = REGISTRY.register(Counter("secretari_websocket_sessions_total", "WebSocket connections accepted"))
+WS_SESSION_SECONDS = REGISTRY.register(Histogram(
+    "secretari_websocket_session_seconds", "Lifetime of WebSocket connections",
+    buckets=(1, 5, 15, 60, 300, 900, 3600, 4 * 3600)))
+SEND_QUEUE_MESSAGES = REGISTRY.register(Gauge("secretari_websocket_send_queue_messages", "Messages waiting for slow sockets"))
+SEND_QUEUE_DEPTH = REGISTRY.register(Histogram(
+    "secretari_websocket_send_queue_depth", "Queue depth of a connection when a message is queued",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)))
+SLOW_CONSUMERS = REGISTRY.register(Counter(
+    "secretari_websocket_slow_consumers_total", "Times a connection's send queue filled up", ("policy",)))
+STREAM_DELTAS_SHED = REGISTRY.register(Counter(
+    "secretari_websocket_stream_deltas_shed_total", "Stream deltas merged or dropped for slow clients", ("action",)))
+REQUEST_CHUNKS = REGISTRY.register(Histogram(
+    "secretari_request_chunks", "Chunks per summary request", buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 100)))
+
+# Admission and LLM calls
+QUEUE_WAIT = REGISTRY.register(Histogram("secretari_admission_wait_seconds", "Time LLM calls waited for a slot", ("tier",)))
+QUEUE_SHED = REGISTRY.register(Counter("secretari_admission_shed_total", "LLM calls rejected under load", ("tier",)))
+LLM_TTFT = REGISTRY.register(Histogram("secretari_llm_ttft_seconds", "Time to the first streamed token", ("model", "key")))
+LLM_DURATION = REGISTRY.register(Histogram(
+    "secretari_llm_duration_seconds", "Duration of streamed LLM calls", ("model", "key"),
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)))
+LLM_CALLS = REGISTRY.register(Counter("secretari_llm_calls_total", "LLM calls by outcome", ("model", "key", "outcome")))
+LLM_HEDGES = REGISTRY.register(Counter(
+    "secretari_llm_hedges_total", "Hedged calls: sent, won by the hedge, lost to the first call, or over budget",
+    ("model", "outcome")))
+LLM_HEDGE_COST = REGISTRY.register(Counter(
+    "secretari_llm_hedge_cost_usd_total", "Cost of cancelled duplicate streams, paid by the server", ("model",)))
+LLM_TOKENS = REGISTRY.register(Counter("secretari_llm_tokens_total", "Tokens used, by kind", ("model", "kind")))
+LLM_COST = REGISTRY.register(Counter("secretari_llm_cost_usd_total", "OpenAI cost in USD", ("model",)))
+BATCH_JOBS = REGISTRY.register(Counter(
+    "secretari_batch_jobs_total", "Batch jobs by outcome: done, failed, cancelled or deferred", ("outcome",)))
+BATCH_QUEUED = REGISTRY.register(Gauge("secretari_batch_jobs_queued", "Batch jobs waiting to run, all workers"))
+UPLOAD_BYTES = REGISTRY.register(Counter(
+    "secretari_upload_bytes_total", "Bytes of fragmented transcript uploads, as sent (wire) and decompressed (text)", ("kind",)))
+
+# Storage and payments
+LEITHER_SECONDS = REGISTRY.register(Histogram("secretari_leither_call_seconds", "Latency of LeitherAPI methods", ("method",)))
+LEITHER_ERRORS = REGISTRY.register(Counter("secretari_leither_errors_total", "LeitherAPI calls that raised", ("method",)))
+LEITHER_TIMEOUTS = REGISTRY.register(Counter(
+    "secretari_leither_timeouts_total", "LeitherAPI calls from the event loop that gave up waiting", ("method",)))
+USER_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "secretari_user_cache_lookups_total", "Lookups of the user cache (mid or user) that hit or missed", ("cache", "result")))
+APPLE_SECONDS = REGISTRY.register(Histogram(
+    "secretari_apple_notification_seconds", "Processing time of App Store notifications", ("environment", "outcome")))
+
+# Process
+LOOP_LAG = REGISTRY.register(Histogram(
+    "secretari_event_loop_lag_seconds", "Delay of the event loop beyond a scheduled wake-up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)))
+
+
+def timed(histogram: Histogram, errors: Optional[Counter] = None, label: Optional[str] = None):
+    """Decorator observing the latency, and counting exceptions, of a function under its name as label"""
+    def decorate(func):
+        name = label or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(1, name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorate
+
+
+async def watch_event_loop_lag(interval: float = 0.5) -> None:
+    """Runs for the life of the server, sampling how late the loop wakes up"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
@@ -0,0 +1,179 @@
+"""
+Mock LLM Server
+A local stand-in for the OpenAI chat completions API, for load and latency tests of the
+WebSocket endpoint without spending money. Answers stream with a configurable time to first
+token and token rate. Errors, 429s and calls slow to start can be injected, and usage is
+reported like OpenAI does, including cached prompt tokens of a repeated system message.
+
+    python mock_llm_server.py --port 8600 --ttft 0.4 --tps 60 --rate-limit-rate 0.05
+
+Point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8600/v1 in .env.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("The", " team", " agreed", " to", " ship", " the", " release", " next", " week", ".", " Action",
+         " items", ":", " review", " budget", ",", " update", " roadmap", ",", " follow", " up", " with",
+         " customers", ".\n")
+CACHE_MIN_TOKENS = 1024     # OpenAI caches prefixes from this length on, in blocks of 128 tokens
+CACHE_BLOCK = 128
+
+
+@dataclass
+class MockSettings:
+    ttft: float = 0.5               # seconds before the first token
+    tps: float = 50.0               # tokens per second after that
+    jitter: float = 0.2             # +- fraction applied to ttft and every token gap
+    output_tokens: int = 200        # tokens per answer, unless max_tokens asks for fewer
+    error_rate: float = 0.0         # fraction of calls answered with 500
+    rate_limit_rate: float = 0.0    # fraction of calls answered with 429
+    retry_after: float = 1.0        # retry-after header of injected 429s
+    slow_rate: float = 0.0          # fraction of calls whose first token takes slow_ttft instead
+    slow_ttft: float = 5.0
+
+    @classmethod
+    def from_env(cls) -> "MockSettings":
+        return cls(
+            ttft=float(os.environ.get("MOCK_TTFT", "0.5")),
+            tps=float(os.environ.get("MOCK_TPS", "50")),
+            jitter=float(os.environ.get("MOCK_JITTER", "0.2")),
+            output_tokens=int(os.environ.get("MOCK_OUTPUT_TOKENS", "200")),
+            error_rate=float(os.environ.get("MOCK_ERROR_RATE", "0")),
+            rate_limit_rate=float(os.environ.get("MOCK_RATE_LIMIT_RATE", "0")),
+            retry_after=float(os.environ.get("MOCK_RETRY_AFTER", "1")),
+            slow_rate=float(os.environ.get("MOCK_SLOW_RATE", "0")),
+            slow_ttft=float(os.environ.get("MOCK_SLOW_TTFT", "5")),
+        )
+
+
+settings = MockSettings.from_env()
+seen_prefixes: set[str] = set()
+counters = {"calls": 0, "errors": 0, "rate_limited": 0, "slow": 0, "tokens": 0}
+app = FastAPI()
+
+
+def _jittered(seconds: float) -> float:
+    return max(0.0, seconds * (1 + random.uniform(-settings.jitter, settings.jitter)))
+
+
+def _tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def _usage(messages: list[dict], completion_tokens: int) -> dict:
+    prompt_tokens = sum(_tokens(str(m.get("content", ""))) + 4 for m in messages) + 3
+    cached = 0
+    if messages and messages[0].get("role") == "system":
+        system = json.dumps(messages[0], sort_keys=True)
+        digest = hashlib.sha256(system.encode("utf-8")).hexdigest()
+        if digest in seen_prefixes and _tokens(system) >= CACHE_MIN_TOKENS:
+            cached = _tokens(system) // CACHE_BLOCK * CACHE_BLOCK
+        seen_prefixes.add(digest)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+def _error(status: int, message: str, code: str, headers: dict = None) -> JSONResponse:
+    return JSONResponse({"error": {"message": message, "type": "mock", "code": code}},
+                        status_code=status, headers=headers)
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": m, "object": "model", "owned_by": "mock"}
+                                       for m in ("gpt-4o", "gpt-4o-mini", "gpt-4-turbo", "gpt-4", "gpt-3.5-turbo")]}
+
+
+@app.get("/mock/stats")
+async def stats():
+    return counters | {"settings": settings.__dict__}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    counters["calls"] += 1
+    roll = random.random()
+    if roll < settings.rate_limit_rate:
+        counters["rate_limited"] += 1
+        return _error(429, "Rate limit reached (mock)", "rate_limit_exceeded",
+                      {"retry-after": str(settings.retry_after)})
+    if roll < settings.rate_limit_rate + settings.error_rate:
+        counters["errors"] += 1
+        return _error(500, "Internal error (mock)", "server_error")
+
+    model = body.get("model", "gpt-4o")
+    count = min(settings.output_tokens, body.get("max_tokens") or body.get("max_completion_tokens") or settings.output_tokens)
+    words = [WORDS[i % len(WORDS)] for i in range(count)]
+    completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    counters["tokens"] += count
+    ttft = settings.ttft
+    if random.random() < settings.slow_rate:
+        counters["slow"] += 1
+        ttft = settings.slow_ttft
+
+    if not body.get("stream"):
+        await asyncio.sleep(_jittered(ttft) + count / max(settings.tps, 0.001))
+        return {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                         "finish_reason": "stop"}],
+            "usage": _usage(body.get("messages", []), count),
+        }
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    async def events():
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model}
+        await asyncio.sleep(_jittered(ttft))
+        yield "data: " + json.dumps(base | {"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""},
+                                                          "finish_reason": None}]}) + "\n\n"
+        gap = 1 / max(settings.tps, 0.001)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(_jittered(gap))
+            yield "data: " + json.dumps(base | {"choices": [{"index": 0, "delta": {"content": word},
+                                                              "finish_reason": None}]}) + "\n\n"
+        yield "data: " + json.dumps(base | {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}) + "\n\n"
+        if include_usage:
+            yield "data: " + json.dumps(base | {"choices": [], "usage": _usage(body.get("messages", []), count)}) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--ttft", type=float, default=settings.ttft, help="seconds to the first token")
+    parser.add_argument("--tps", type=float, default=settings.tps, help="tokens per second")
+    parser.add_argument("--jitter", type=float, default=settings.jitter)
+    parser.add_argument("--output-tokens", type=int, default=settings.output_tokens)
+    parser.add_argument("--error-rate", type=float, default=settings.error_rate, help="fraction of calls failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=settings.rate_limit_rate, help="fraction of calls failing with 429")
+    parser.add_argument("--retry-after", type=float, default=settings.retry_after)
+    parser.add_argument("--slow-rate", type=float, default=settings.slow_rate, help="fraction of calls slow to start")
+    parser.add_argument("--slow-ttft", type=float, default=settings.slow_ttft, help="seconds to the first token of those")
+    args = parser.parse_args()
+    settings = MockSettings(args.ttft, args.tps, args.jitter, args.output_tokens,
+                            args.error_rate, args.rate_limit_rate, args.retry_after, args.slow_rate, args.slow_ttft)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -1,12 +1,14 @@
 import threading
 from contextlib import contextmanager
-from typing import Any, Generator
+from typing import Any, Generator, Optional
 
-import tiktoken
 from langchain_community.callbacks.manager import openai_callback_var
 from langchain_community.callbacks.openai_info import MODEL_COST_PER_1K_TOKENS, OpenAICallbackHandler
 from langchain_core.outputs import LLMResult
 
+from metrics import LLM_COST, LLM_TOKENS
+from tokenization import get_encoding
+
 MODEL_COST_PER_1K_TOKENS = MODEL_COST_PER_1K_TOKENS | {
     # GPT-4 input
     "gpt-4-turbo": 0.01,
@@ -17,6 +19,12 @@ MODEL_COST_PER_1K_TOKENS = MODEL_COST_PER_1K_TOKENS | {
     "gpt-4o-completion": 0.015,
 }
 
+# Share of the input price billed for prompt tokens served from the provider's prefix cache
+CACHED_INPUT_PRICE_RATIO = {
+    "gpt-4o": 0.5,
+    "gpt-4o-mini": 0.5,
+}
+
 def standardize_model_name(
     model_name: str,
     is_completion: bool = False,
@@ -74,9 +82,11 @@ def get_openai_token_cost_for_model(
 
 class CostTrackerCallback(OpenAICallbackHandler):
 
-    def __init__(self, model_name: str) -> None:
+    def __init__(self, model_name: str, prompt_tokens: Optional[int] = None) -> None:
         super().__init__()
         self.model_name = model_name
+        self.known_prompt_tokens = prompt_tokens    # counted when the transcript was split, no need to encode again
+        self.cached_tokens = 0                      # prompt tokens the provider reported as read from its cache
         self._lock = threading.Lock()
 
     def on_llm_start(
@@ -85,28 +95,63 @@ class CostTrackerCallback(OpenAICallbackHandler):
         prompts: list[str],
         **kwargs: Any,
     ) -> None:
-        encoding = tiktoken.get_encoding("cl100k_base")
-        prompts_string = ''.join(prompts)
-        self.prompt_tokens = len(encoding.encode(prompts_string))
+        if self.known_prompt_tokens is not None:
+            self.prompt_tokens = self.known_prompt_tokens
+        else:
+            encoding = get_encoding(self.model_name)
+            prompts_string = ''.join(prompts)
+            self.prompt_tokens = len(encoding.encode(prompts_string))
         self.completion_tokens = 0
 
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         self.completion_tokens += 1
 
+    def _read_usage(self, response: LLMResult) -> None:
+        # the provider's own counts, sent at the end of the stream, win over local estimates
+        try:
+            usage = response.generations[0][0].message.usage_metadata
+        except (AttributeError, IndexError):
+            usage = None
+        if not usage:
+            return
+        self.prompt_tokens = usage.get("input_tokens") or self.prompt_tokens
+        self.completion_tokens = usage.get("output_tokens") or self.completion_tokens
+        self.cached_tokens = (usage.get("input_token_details") or {}).get("cache_read") or 0
+
+    def _cost(self) -> tuple[float, float]:
+        """Prompt and completion cost of the tokens counted so far"""
+        model_name = standardize_model_name(self.model_name)
+        if model_name not in MODEL_COST_PER_1K_TOKENS:
+            return 0, 0
+        completion_cost = get_openai_token_cost_for_model(
+            model_name, self.completion_tokens, is_completion=True
+        )
+        # cached prompt tokens are billed at a discount
+        cached = min(self.cached_tokens, self.prompt_tokens)
+        prompt_cost = get_openai_token_cost_for_model(model_name, self.prompt_tokens - cached) \
+            + get_openai_token_cost_for_model(model_name, cached) * CACHED_INPUT_PRICE_RATIO.get(model_name, 1.0)
+        return prompt_cost, completion_cost
+
+    def partial_usage(self) -> tuple[float, int]:
+        """Cost and tokens of a call cut off before it ended. The provider bills what it generated."""
+        if not self.prompt_tokens:
+            return 0.0, 0       # the request never went out
+        prompt_cost, completion_cost = self._cost()
+        return prompt_cost + completion_cost, self.prompt_tokens + self.completion_tokens
+
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """Run when chain ends running."""
         # text_response = response.generations[0][0].text
         # encoding = tiktoken.get_encoding("cl100k_base")
         # self.completion_tokens = len(encoding.encode(text_response))
-        model_name = standardize_model_name(self.model_name)
-        if model_name in MODEL_COST_PER_1K_TOKENS:
-            completion_cost = get_openai_token_cost_for_model(
-                model_name, self.completion_tokens, is_completion=True
-            )
-            prompt_cost = get_openai_token_cost_for_model(model_name, self.prompt_tokens)
-        else:
-            completion_cost = 0
-            prompt_cost = 0
+        self._read_usage(response)
+        prompt_cost, completion_cost = self._cost()
+
+        cached = min(self.cached_tokens, self.prompt_tokens)
+        LLM_TOKENS.inc(self.prompt_tokens - cached, self.model_name, "prompt")
+        LLM_TOKENS.inc(cached, self.model_name, "cached")
+        LLM_TOKENS.inc(self.completion_tokens, self.model_name, "completion")
+        LLM_COST.inc(prompt_cost + completion_cost, self.model_name)
 
         # update shared state behind lock
         with self._lock:
@@ -116,8 +161,8 @@ class CostTrackerCallback(OpenAICallbackHandler):
 
 
 @contextmanager
-def get_cost_tracker_callback(model_name) -> Generator[CostTrackerCallback, None, None]:
-    cb = CostTrackerCallback(model_name)
+def get_cost_tracker_callback(model_name, prompt_tokens: Optional[int] = None) -> Generator[CostTrackerCallback, None, None]:
+    cb = CostTrackerCallback(model_name, prompt_tokens)
     openai_callback_var.set(cb)
     yield cb
     openai_callback_var.set(None)
@@ -0,0 +1,23 @@
+"""
+Prompt Layout
+Builds the chat messages of a summarization call. The instruction always goes first, as a
+system message that is byte-identical for every chunk of a request, and the chunk follows
+as the user message. OpenAI caches prompt prefixes it has seen recently, so the instruction
+is processed once and later chunks are billed for it at the cached-input rate.
+"""
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+
+def build_messages(prompt: str, chunk: str) -> list[BaseMessage]:
+    """Messages of one call: the instruction as a stable system prefix, then the chunk"""
+    # nothing request specific (time, user, chunk number) may go into the system message,
+    # or the prefix changes and the provider cache misses
+    return [SystemMessage(content=prompt), HumanMessage(content=chunk)]
+
+
+def prompt_text(messages) -> str:
+    """Plain text of a prompt, for estimating its size. Accepts a string or a list of messages."""
+    if isinstance(messages, str):
+        return messages
+    return "".join(str(m.content) for m in messages)
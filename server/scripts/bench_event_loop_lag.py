@@ -0,0 +1,90 @@
+"""
+Event Loop Lag Benchmark
+Measures how much the event loop stalls while huge transcripts are prepared for the LLM,
+inline on the loop versus offloaded to the TextPrepPool.
+
+    python scripts/bench_event_loop_lag.py --mb 4 --jobs 4
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from text_prep import TextPrepPool
+from tokenization import get_encoding
+
+TICK = 0.005    # the probe wakes up every 5 ms, any delay beyond that is lag
+
+WORDS = ("we", "agreed", "to", "move", "the", "release", "budget", "review", "next", "week",
+         "会议", "讨论", "了", "项目", "进度", "customer", "feedback", "was", "positive")
+
+
+def make_transcript(size_mb: float) -> str:
+    rng = random.Random(42)
+    parts, size = [], 0
+    while size < size_mb * 1024 * 1024:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 20))) + ".\n"
+        parts.append(sentence)
+        size += len(sentence.encode("utf-8"))
+    return "".join(parts)
+
+
+async def probe(samples: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        samples.append(max(0.0, time.perf_counter() - started - TICK))
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def run(pool: TextPrepPool, text: str, jobs: int, model: str) -> tuple[list[float], float]:
+    samples: list[float] = []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(samples, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(pool.prepare(text, 6144, 50, model) for _ in range(jobs)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await prober
+    return samples, elapsed
+
+
+def report(name: str, samples: list[float], elapsed: float) -> None:
+    ms = [s * 1000 for s in samples]
+    print(f"{name:10s} wall {elapsed:6.2f}s  lag p50 {statistics.median(ms):8.2f}ms  "
+          f"p99 {percentile(ms, 0.99):8.2f}ms  max {max(ms):8.2f}ms  samples {len(ms)}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=float, default=4, help="transcript size in megabytes")
+    parser.add_argument("--jobs", type=int, default=4, help="transcripts prepared at the same time")
+    parser.add_argument("--workers", type=int, default=2, help="processes in the pool")
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+
+    text = make_transcript(args.mb)
+    get_encoding(args.model)    # load the encoding before measuring
+    print(f"transcript {len(text.encode('utf-8')) / 1024 / 1024:.1f} MB, {args.jobs} jobs")
+
+    inline = TextPrepPool(workers=0)
+    report("inline", *await run(inline, text, args.jobs, args.model))
+
+    pooled = TextPrepPool(workers=args.workers, inline_chars=0)
+    # start the workers and load their encodings outside the measurement
+    await asyncio.gather(*(pooled.prepare("warm up", 6144, 50, args.model) for _ in range(args.workers)))
+    report("offloaded", *await run(pooled, text, args.jobs, args.model))
+    pooled.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,145 @@
+"""
+Leither Call Benchmark
+Measures throughput and event loop lag of storage calls made from the event loop, calling
+LeitherAPI directly as the handlers used to, versus awaiting it through AsyncLeitherAPI,
+without and with the user cache.
+
+Without --port, Leither is simulated: every hprose call sleeps --latency ms, and a request
+reads a user and bills it, as a WebSocket request does. With --port the Leither server on that
+port is used, with the .env of the current directory, and a request only reads --user.
+
+    python scripts/bench_leither.py --requests 200 --latency 5 --workers 8
+    python scripts/bench_leither.py --port 8081 --user alice
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import leither_api
+from leither_api import AsyncLeitherAPI, LeitherAPI
+from utilities import UserInDB
+
+TICK = 0.005    # the probe wakes up every 5 ms, any delay beyond that is lag
+USERS = 20
+
+
+class SimulatedClient:
+    """hprose client of a Leither that answers every call after `latency` seconds"""
+    latency = 0.005
+    store: dict = {}
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def _wait(self):
+        time.sleep(self.latency)
+
+    def GetVar(self, *args): return "simulated"
+    def GetVarByContext(self, *args): return "ppt"
+    def Login(self, ppt): return types.SimpleNamespace(sid="sid", uid="uid")
+    def MMCreate(self, sid, key, ext, name, *args): self._wait(); return "mid-" + name
+    def MMOpen(self, sid, mid, version): self._wait(); return mid
+    def MFGetObject(self, mmsid): self._wait(); return self.store.get(mmsid, "")
+    def MFSetObject(self, mmsid, value): self._wait(); self.store[mmsid] = value
+    def MMBackup(self, *args): self._wait()
+    def MiMeiPublish(self, *args): self._wait()
+    def Hget(self, mmsid, key, field): self._wait(); return self.store.get((mmsid, key, field), "")
+    def Hset(self, mmsid, key, field, value): self._wait(); self.store[(mmsid, key, field)] = value
+
+
+def simulate(latency: float) -> LeitherAPI:
+    SimulatedClient.latency = latency
+    leither_api.hprose.HttpClient = SimulatedClient
+    LeitherAPI.load_env = lambda self: (setattr(self, "init_balance", 0.2), setattr(self, "cost_efficiency", 2.0))
+    for i in range(USERS):
+        user = UserInDB(id=f"user{i}", username=f"user{i}", hashed_password="x", mid=f"mid-user{i}",
+                        dollar_balance=10.0, monthly_usage={str(time.localtime().tm_mon): 0.0}, token_count=0)
+        SimulatedClient.store[user.mid] = json.dumps(user.model_dump())
+    return LeitherAPI()
+
+
+async def probe(samples: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        samples.append(max(0.0, time.perf_counter() - started - TICK))
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def blocking(lapi: LeitherAPI, username: str, bill: bool) -> None:
+    user = lapi.get_user(username)
+    if bill:
+        lapi.bookkeeping(0.001, 100, user)
+
+
+async def awaited(lapi: AsyncLeitherAPI, username: str, bill: bool) -> None:
+    user = await lapi.get_user(username)
+    if bill:
+        await lapi.bookkeeping(0.001, 100, user)
+
+
+async def run(request, lapi, usernames: list[str], bill: bool) -> tuple[list[float], float]:
+    samples: list[float] = []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(samples, stop))
+    await asyncio.sleep(TICK)   # the probe is waiting before the requests start
+    started = time.perf_counter()
+    await asyncio.gather(*(request(lapi, username, bill) for username in usernames))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await prober
+    return samples, elapsed
+
+
+def report(name: str, requests: int, samples: list[float], elapsed: float) -> None:
+    ms = [s * 1000 for s in samples] or [0.0]
+    print(f"{name:10s} wall {elapsed:6.2f}s  {requests / elapsed:7.1f} req/s  lag p50 {statistics.median(ms):8.2f}ms  "
+          f"p99 {percentile(ms, 0.99):8.2f}ms  max {max(ms):8.2f}ms")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests started at the same time")
+    parser.add_argument("--latency", type=float, default=5, help="milliseconds per simulated hprose call")
+    parser.add_argument("--workers", type=int, default=8, help="threads of AsyncLeitherAPI")
+    parser.add_argument("--port", type=int, help="use the Leither server on this port")
+    parser.add_argument("--user", help="username read from the Leither server, with --port")
+    args = parser.parse_args()
+
+    if args.port:
+        if not args.user:
+            parser.error("--port needs --user")
+        sync, usernames, bill = LeitherAPI(args.port), [args.user] * args.requests, False
+    else:
+        sync, usernames, bill = simulate(args.latency / 1000), [f"user{i % USERS}" for i in range(args.requests)], True
+    print(f"{args.requests} requests, {'read' if not bill else 'read and bill'}, "
+          f"{'port ' + str(args.port) if args.port else str(args.latency) + ' ms per call'}")
+
+    size, ttl, mid_ttl = sync.users.size, sync.users.ttl, sync.mids.ttl
+    sync.users.configure(0, 0)
+    sync.mids.configure(0, 0)
+    report("blocking", args.requests, *await run(blocking, sync, usernames, bill))
+    lapi = AsyncLeitherAPI(sync, args.workers, timeout=600)
+    report("awaited", args.requests, *await run(awaited, lapi, usernames, bill))
+    sync.users.configure(size, ttl)
+    sync.mids.configure(size, mid_ttl)
+    # users seen before, as on a server that has been up a while
+    await asyncio.gather(*(lapi.get_user(username) for username in set(usernames)))
+    report("cached", args.requests, *await run(awaited, lapi, usernames, bill))
+    print("cache", lapi.stats()["cache"])
+    lapi.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+WebSocket Latency Benchmark
+Logs in through /token, opens N WebSockets with real JWTs and sends each a summary request,
+the way the app does. Reports time to first token, inter-token latency, end-to-end latency
+and throughput percentiles. Run the backend against mock_llm_server.py to test without cost.
+
+    python mock_llm_server.py --ttft 0.4 --tps 60 &
+    python scripts/bench_ttft.py --url http://127.0.0.1:8506 --user bench --password secret -n 50
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import urllib.parse
+import urllib.request
+
+import websockets
+
+BASE_ROUTE = "/secretari"
+PROMPT = "Summarize the following meeting transcript into a memo with decisions and action items."
+TRANSCRIPT = ("Alice said the release is on track for next week. Bob will update the roadmap and "
+              "follow up with the two customers who reported issues. ") * 40
+
+
+def login(url: str, username: str, password: str) -> str:
+    """JWT of the user, from the same form post the app makes"""
+    data = urllib.parse.urlencode({"username": username, "password": password}).encode()
+    with urllib.request.urlopen(url + BASE_ROUTE + "/token", data=data, timeout=30) as response:
+        return json.loads(response.read())["token"]["access_token"]
+
+
+async def run_one(ws_url: str, token: str, transcript: str, coalesce: bool) -> dict:
+    query = urllib.parse.urlencode({"token": token, "coalesce": str(coalesce).lower()})
+    event = {
+        "input": {"prompt": PROMPT, "prompt_type": "memo", "rawtext": transcript, "subscription": True},
+        "parameters": {"llm": "openai", "temperature": "0.0"},
+    }
+    gaps, first, last, deltas = [], None, None, 0
+    async with websockets.connect(f"{ws_url}{BASE_ROUTE}/ws/?{query}", max_size=None) as ws:
+        started = time.perf_counter()
+        await ws.send(json.dumps(event))
+        async for frame in ws:
+            message = json.loads(frame)
+            now = time.perf_counter()
+            if message["type"] == "stream":
+                if first is None:
+                    first = now - started
+                else:
+                    gaps.append(now - last)
+                last = now
+                deltas += 1
+            elif message["type"] == "error":
+                return {"error": message.get("message")}
+            elif message["type"] == "result" and message.get("eof"):
+                return {"ttft": first, "gaps": gaps, "e2e": now - started, "deltas": deltas}
+    return {"error": "connection closed before the result"}
+
+
+def percentiles(name: str, values: list[float], unit: float = 1000) -> None:
+    if not values:
+        print(f"{name:18s} no samples")
+        return
+    values = sorted(v * unit for v in values)
+    at = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    print(f"{name:18s} p50 {at(0.5):9.1f}  p90 {at(0.9):9.1f}  p99 {at(0.99):9.1f}  "
+          f"max {values[-1]:9.1f}  mean {statistics.fmean(values):9.1f}  (n={len(values)})")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8506", help="backend base URL")
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("-n", "--connections", type=int, default=20, help="WebSockets opened at the same time")
+    parser.add_argument("--repeat", type=int, default=1, help="requests sent over each connection's lifetime")
+    parser.add_argument("--transcript-kb", type=float, default=0, help="transcript size, default a short meeting")
+    parser.add_argument("--coalesce", action="store_true", help="connect with coalesce=true")
+    args = parser.parse_args()
+
+    token = login(args.url, args.user, args.password)
+    ws_url = args.url.replace("http", "ws", 1)
+    transcript = TRANSCRIPT
+    if args.transcript_kb:
+        transcript = (TRANSCRIPT * int(args.transcript_kb * 1024 / len(TRANSCRIPT) + 1))[:int(args.transcript_kb * 1024)]
+
+    async def client() -> list[dict]:
+        return [await run_one(ws_url, token, transcript, args.coalesce) for _ in range(args.repeat)]
+
+    started = time.perf_counter()
+    results = [r for batch in await asyncio.gather(*(client() for _ in range(args.connections)),
+                                                   return_exceptions=True)
+               for r in (batch if isinstance(batch, list) else [{"error": str(batch)}])]
+    wall = time.perf_counter() - started
+
+    ok = [r for r in results if "error" not in r]
+    errors = [r["error"] for r in results if "error" in r]
+    print(f"{len(results)} requests over {args.connections} connections in {wall:.2f}s, {len(errors)} failed")
+    percentiles("ttft ms", [r["ttft"] for r in ok if r["ttft"] is not None])
+    percentiles("inter-token ms", [g for r in ok for g in r["gaps"]])
+    percentiles("end-to-end ms", [r["e2e"] for r in ok])
+    print(f"{'throughput':18s} {len(ok) / wall:.2f} requests/s, {sum(r['deltas'] for r in ok) / wall:.1f} deltas/s")
+    for error in sorted(set(errors))[:5]:
+        print("error:", error)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+"""
+Prompt Prefix Check
+Runs a transcript through summarize_chunks against a local stub of the OpenAI chat API and
+verifies that every call starts with the byte-identical system message, so the provider's
+prefix cache can serve it. The stub reports the repeated prefix as cached tokens, like
+OpenAI does, which also exercises the discounted pricing in the cost tracker.
+
+    python scripts/check_prompt_prefix.py --chunks 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_openai import ChatOpenAI
+
+from summarizer import ChunkResult, summarize_chunks
+from tokenization import get_encoding
+
+PROMPT = ("You are a meeting assistant. Summarize the transcript below into a memo with a title, "
+          "key decisions, action items with owners, and open questions. ") * 20
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Minimal /v1/chat/completions with streaming, records the bytes of every first message"""
+    prefixes: list[bytes] = []
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prefix = json.dumps(body["messages"][0], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        cached = len(prefix) // 4 if prefix in self.prefixes else 0
+        self.prefixes.append(prefix)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        base = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": body["model"]}
+        for word in ("Summary", " of", " chunk", "."):
+            self._event(base | {"choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]})
+        self._event(base | {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        prompt_tokens = sum(len(json.dumps(m)) for m in body["messages"]) // 4
+        self._event(base | {"choices": [], "usage": {
+            "prompt_tokens": prompt_tokens, "completion_tokens": 4, "total_tokens": prompt_tokens + 4,
+            "prompt_tokens_details": {"cached_tokens": cached}}})
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _event(self, data: dict) -> None:
+        self.wfile.write(b"data: " + json.dumps(data).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    llm = ChatOpenAI(api_key="sk-stub", model=args.model, streaming=True, stream_usage=True, max_retries=0,
+                     base_url=f"http://127.0.0.1:{server.server_address[1]}/v1")
+
+    get_encoding(args.model)
+    chunks = [f"Speaker {i}: we reviewed item {i} of the agenda and agreed on next steps." for i in range(args.chunks)]
+    cached_tokens, cost = 0, 0.0
+    async for item in summarize_chunks(llm, PROMPT, chunks, args.model, args.concurrency, reduce=True):
+        if isinstance(item, ChunkResult):
+            cached_tokens += item.cached_tokens
+            cost += item.total_cost
+    server.shutdown()
+
+    prefixes = StubHandler.prefixes
+    identical = len(set(prefixes)) == 1
+    print(f"calls {len(prefixes)}, distinct system prefixes {len(set(prefixes))}, "
+          f"cached prompt tokens {cached_tokens}, cost ${cost:.6f}")
+    print("OK: prefix is byte-identical across calls" if identical else "FAIL: prefix differs between calls")
+    return 0 if identical and cached_tokens > 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,196 @@
+"""
+Resumable Streams
+Output of requests that carry a request_id is written to a buffer instead of the socket,
+and the connection follows that buffer. When the phone switches networks the summary runs
+on, and the client reconnects and resumes from the last offset it received instead of
+submitting the transcript again. Buffers are bounded by a byte budget and dropped after a
+TTL without a client.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+log = logging.getLogger("secretari.ws")
+
+DELTA_TYPES = ("stream", "reduce")     # messages carrying a piece of text, merged when replayed
+
+
+class RequestStream:
+    """Buffered output of one resumable request. Has the send/stream interface of FrameWriter."""
+    connected = True    # output is always taken, whether a client is attached or not
+
+    def __init__(self, request_id: str, user: str, owner: Optional["StreamBuffer"] = None):
+        self.request_id = request_id
+        self.user = user
+        self.owner = owner                  # the buffer whose byte budget this stream counts against
+        self.messages: list[dict] = []
+        self.size = 0                       # bytes buffered, roughly
+        self.done = False
+        self.task: Optional[asyncio.Task] = None
+        self.listeners = 0
+        self.idle_since = time.monotonic()  # last time a client was attached or the output grew
+        self._changed = asyncio.Event()
+
+    async def send(self, message: dict) -> None:
+        self._append(message, len(json.dumps(message)))
+
+    async def stream(self, data: str, kind: str = "stream") -> None:
+        self._append({"type": kind, "data": data}, len(data) + 32)
+
+    def _append(self, message: dict, size: int) -> None:
+        self.messages.append(message)
+        self.size += size
+        self._wake()
+        if self.owner is not None:
+            self.owner._grew(self, size)
+
+    def finish(self) -> None:
+        self.done = True
+        self._wake()
+
+    def _wake(self) -> None:
+        if not self.listeners:
+            self.idle_since = time.monotonic()
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[tuple[int, dict]]:
+        """
+        Messages from `offset` on, each with the offset to resume after it, until the request
+        is done. Stream deltas that are already buffered go out merged into one message.
+        """
+        self.listeners += 1
+        try:
+            offset = max(0, offset)
+            while True:
+                end = len(self.messages)
+                if offset < end:
+                    message = self.messages[offset]
+                    kind = message["type"]
+                    if kind in DELTA_TYPES:
+                        stop = offset + 1
+                        while stop < end and self.messages[stop]["type"] == kind:
+                            stop += 1
+                        message = {"type": kind, "data": "".join(m["data"] for m in self.messages[offset:stop])}
+                        offset = stop
+                    else:
+                        offset += 1
+                    yield offset, message
+                elif self.done:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.listeners -= 1
+            self.idle_since = time.monotonic()
+
+
+class StreamBuffer:
+    """Resumable requests by (user, request_id), bounded by TTL and total size"""
+
+    def __init__(self, ttl: float = 600.0, max_bytes: int = 64 * 1024 * 1024):
+        self.ttl = ttl                  # seconds a stream is kept without a client
+        self.max_bytes = max_bytes
+        self._streams: dict[tuple[str, str], RequestStream] = {}
+        self.started = 0
+        self.resumed = 0
+        self.evicted = 0
+        self.cancelled = 0
+        self.size = 0                   # bytes of all streams, roughly
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. Called again by the hourly reload."""
+        self.ttl = float(env.get("RESUME_TTL", "600"))
+        self.max_bytes = int(float(env.get("RESUME_BUFFER_MB", "64")) * 1024 * 1024)
+
+    def get(self, user: str, request_id: str) -> Optional[RequestStream]:
+        """The user's stream of that request, if it is still buffered"""
+        self.evict()
+        stream = self._streams.get((user, request_id))
+        if stream is not None:
+            self.resumed += 1
+        return stream
+
+    def start(self, user: str, request_id: str, work: Callable[[RequestStream], Awaitable[None]]) -> RequestStream:
+        """Run `work` in the background with its output going into a new stream"""
+        self.evict()
+        stream = RequestStream(request_id, user, self)
+        stream.task = asyncio.create_task(self._run(stream, work))
+        self._streams[(user, request_id)] = stream
+        self.started += 1
+        return stream
+
+    async def _run(self, stream: RequestStream, work: Callable[[RequestStream], Awaitable[None]]) -> None:
+        try:
+            await work(stream)
+        except Exception as e:
+            log.exception("Resumable request %s failed: %s", stream.request_id, e)
+            await stream.send({"type": "error", "message": f"Server error: {str(e)}"})
+        finally:
+            stream.finish()
+
+    def cancel(self, user: str, request_id: str) -> bool:
+        """Stop a request the client no longer wants and forget its output. False if there was none."""
+        stream = self._streams.pop((user, request_id), None)
+        if stream is None:
+            return False
+        self._forget(stream)
+        if stream.task is not None and not stream.task.done():
+            stream.task.cancel()
+            self.cancelled += 1
+        return True
+
+    def _forget(self, stream: RequestStream) -> None:
+        stream.owner = None     # output it still writes, while its cancel lands, is not counted
+        self.size -= stream.size
+
+    def _grew(self, stream: RequestStream, size: int) -> None:
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    async def sweep(self, interval: float = 30.0) -> None:
+        """Runs for the life of the server, so buffers are freed without new resumable requests coming in"""
+        while True:
+            await asyncio.sleep(interval)
+            self.evict()
+
+    def _drop(self, key: tuple[str, str]) -> None:
+        stream = self._streams.pop(key)
+        self._forget(stream)
+        if stream.task is not None and not stream.task.done():
+            stream.task.cancel()    # nobody came back for it
+        self.evicted += 1
+
+    def evict(self) -> None:
+        """
+        Drop streams idle beyond the TTL, then the oldest idle ones while over the byte budget.
+        Runs when a stream grows past the budget, and from sweep. Streams a client follows are kept.
+        """
+        now = time.monotonic()
+        for key, stream in list(self._streams.items()):
+            if not stream.listeners and now - stream.idle_since > self.ttl:
+                self._drop(key)
+        if self.size <= self.max_bytes:
+            return
+        # finished streams go first, running ones only if that is not enough
+        idle = sorted((k for k, s in self._streams.items() if not s.listeners),
+                      key=lambda k: (not self._streams[k].done, self._streams[k].idle_since))
+        for key in idle:
+            if self.size <= self.max_bytes:
+                break
+            self._drop(key)
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "running": sum(1 for s in self._streams.values() if not s.done),
+            "bytes": self.size,
+            "started": self.started,
+            "resumed": self.resumed,
+            "evicted": self.evicted,
+            "cancelled": self.cancelled,
+        }
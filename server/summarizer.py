@@ -0,0 +1,305 @@
+"""
+Chunk Summarizer
+Runs the LLM over the chunks of a transcript, several at a time if allowed,
+and hands the output back in chunk order.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional, Union
+
+from llm_cache import ResponseCache
+from openaiCBHandler import get_cost_tracker_callback
+from prompt_layout import build_messages
+from tokenization import count_prompt_tokens, count_tokens
+
+_DONE = object()    # end of a chunk's stream in its queue
+OUTPUT_ESTIMATE = 500   # completion tokens of a typical chunk summary, to estimate what a cancel saved
+
+
+class ReduceDelta(str):
+    """Stream delta of the reduce pass, sent to clients apart from the deltas of the chunk summaries"""
+
+
+def frame_type(delta: str) -> str:
+    """Type of the WebSocket frame that carries a stream delta"""
+    return "reduce" if isinstance(delta, ReduceDelta) else "stream"
+
+
+@dataclass
+class ChunkResult:
+    """Outcome of one LLM call over a chunk, or of the final reduce pass"""
+    index: int
+    text: str
+    total_tokens: int
+    total_cost: float
+    eof: bool = False           # last result of the request
+    reduced: bool = False       # text is the merged memo of all chunks
+    cached: bool = False        # replayed from the response cache, no LLM call made
+    cached_tokens: int = 0      # prompt tokens the provider served from its prefix cache
+
+
+@dataclass
+class Spend:
+    """LLM usage of calls cut off by a cancel, e.g. a client disconnect, and what the cancel saved"""
+    tokens: int = 0             # prompt and generated tokens of calls stopped mid-stream, still billed
+    cost: float = 0.0
+    cancelled_calls: int = 0    # calls stopped mid-stream
+    skipped_chunks: int = 0     # chunks never sent to the LLM
+    saved_tokens: int = 0       # estimate of the tokens the cancel kept from being generated or sent
+
+    def add(self, other: "Spend") -> None:
+        self.tokens += other.tokens
+        self.cost += other.cost
+        self.cancelled_calls += other.cancelled_calls
+        self.skipped_chunks += other.skipped_chunks
+        self.saved_tokens += other.saved_tokens
+
+    def stats(self) -> dict:
+        return {
+            "cancelled_calls": self.cancelled_calls,
+            "skipped_chunks": self.skipped_chunks,
+            "partial_tokens": self.tokens,
+            "partial_cost": self.cost,
+            "saved_tokens": self.saved_tokens,
+        }
+
+
+async def _run_chunk(llm, prompt: str, chunk: str, model_name: str, index: int,
+                     queue: asyncio.Queue, semaphore: asyncio.Semaphore,
+                     cache: Optional[ResponseCache], temperature: float, spend: Optional[Spend]) -> None:
+    # Every chunk runs in its own task, so the cost tracker set in the context var is private to it.
+    cb = None
+    try:
+        key = cache.make_key(prompt, chunk, model_name, temperature) if cache else None
+        hit = await cache.get(key) if cache else None
+        if hit is not None:
+            # replay as one stream delta followed by the result
+            queue.put_nowait(hit.text)
+            queue.put_nowait(ChunkResult(index, hit.text, hit.total_tokens, hit.total_cost, cached=True))
+            queue.put_nowait(_DONE)
+            return
+
+        async with semaphore:
+            with get_cost_tracker_callback(model_name, count_prompt_tokens(prompt, chunk, model_name)) as cb:
+                text = ""
+                async for piece in llm.astream(build_messages(prompt, chunk)):
+                    text += piece.content
+                    queue.put_nowait(piece.content)
+        if cache:
+            await cache.put(key, text, cb.total_tokens, cb.total_cost)
+        queue.put_nowait(ChunkResult(index, text, cb.total_tokens, cb.total_cost, cached_tokens=cb.cached_tokens))
+    except asyncio.CancelledError:
+        # the HTTP stream is closed with the task, so the provider stops generating
+        if spend is not None:
+            cost, tokens = cb.partial_usage() if cb else (0.0, 0)
+            if tokens:
+                spend.tokens += tokens
+                spend.cost += cost
+                spend.cancelled_calls += 1
+                spend.saved_tokens += max(0, OUTPUT_ESTIMATE - cb.completion_tokens)
+            else:
+                spend.skipped_chunks += 1
+                spend.saved_tokens += count_prompt_tokens(prompt, chunk, model_name) + OUTPUT_ESTIMATE
+        raise
+    except Exception as e:
+        queue.put_nowait(e)
+    queue.put_nowait(_DONE)
+
+
+async def summarize_chunks(llm, prompt: str, chunks: list[str], model_name: str,
+                           concurrency: int = 1, reduce: bool = False,
+                           cache: Optional[ResponseCache] = None,
+                           temperature: float = 0.0,
+                           spend: Optional[Spend] = None,
+                           reduce_tokens: int = 0) -> AsyncIterator[Union[str, ChunkResult]]:
+    """
+    Summarize chunks with up to `concurrency` LLM calls in flight.
+    Yields stream deltas (str) and a ChunkResult after each chunk, strictly in chunk order.
+    Output of chunks that finish early is buffered until the ones before them are done.
+    If `reduce` is set and there is more than one chunk, the chunk summaries are merged
+    by merge_summaries, whose deltas are ReduceDelta and whose result is the last one yielded.
+    Answers found in `cache` are replayed instead of calling the LLM.
+    Closing the generator early cancels all calls in flight and all chunks not started yet.
+    What those calls already used, and what cancelling them saved, is added to `spend`.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    queues = [asyncio.Queue() for _ in chunks]
+    tasks = [asyncio.create_task(_run_chunk(llm, prompt, ci, model_name, index, queues[index], semaphore, cache, temperature, spend))
+             for index, ci in enumerate(chunks)]
+    do_reduce = reduce and len(chunks) > 1
+    summaries = []
+    try:
+        for index, queue in enumerate(queues):
+            while (item := await queue.get()) is not _DONE:
+                if isinstance(item, Exception):
+                    raise item
+                if isinstance(item, ChunkResult):
+                    item.eof = not do_reduce and index == len(chunks) - 1
+                    summaries.append(item.text)
+                yield item
+
+        if do_reduce:
+            async for item in merge_summaries(llm, prompt, summaries, model_name, cache, temperature, spend,
+                                              concurrency, reduce_tokens):
+                yield item
+    finally:
+        # also reached when the consumer stops early, so nothing keeps calling the LLM
+        for task in tasks:
+            task.cancel()
+        # wait for the cancelled tasks, so their usage is in `spend` when the caller looks
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if spend is not None:
+            # chunks that finished ahead of their turn were generated, and paid for, but never yielded
+            for queue in queues:
+                while not queue.empty():
+                    item = queue.get_nowait()
+                    if isinstance(item, ChunkResult) and not item.cached:
+                        spend.tokens += item.total_tokens
+                        spend.cost += item.total_cost
+
+
+async def summarize_stream(llm, prompt: str, chunks: AsyncIterator[str], model_name: str,
+                           concurrency: int = 1, reduce: bool = False,
+                           cache: Optional[ResponseCache] = None,
+                           temperature: float = 0.0,
+                           spend: Optional[Spend] = None,
+                           reduce_tokens: int = 0) -> AsyncIterator[Union[str, ChunkResult]]:
+    """
+    Like summarize_chunks, for chunks that are still being cut, e.g. from an upload in progress.
+    Every chunk goes to the LLM as soon as it arrives, and output comes strictly in chunk order.
+    The result of a chunk is held until the next chunk arrives or `chunks` ends, as only then
+    is it known whether it is the last one.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    arrived = asyncio.Queue()       # output queue of every chunk as it is cut, then _DONE
+    queues: list[asyncio.Queue] = []
+    tasks: list[asyncio.Task] = []
+
+    async def feed():
+        try:
+            async for chunk in chunks:
+                queue = asyncio.Queue()
+                tasks.append(asyncio.create_task(_run_chunk(llm, prompt, chunk, model_name, len(queues), queue, semaphore,
+                                                            cache, temperature, spend)))
+                queues.append(queue)
+                arrived.put_nowait(queue)
+        except Exception as e:
+            arrived.put_nowait(e)
+        arrived.put_nowait(_DONE)
+
+    feeder = asyncio.create_task(feed())
+    summaries = []
+    held = None
+    try:
+        while (queue := await arrived.get()) is not _DONE:
+            if isinstance(queue, Exception):
+                raise queue
+            if held is not None:
+                item, held = held, None
+                yield item
+            while (item := await queue.get()) is not _DONE:
+                if isinstance(item, Exception):
+                    raise item
+                if isinstance(item, ChunkResult):
+                    summaries.append(item.text)
+                    held = item
+                else:
+                    yield item
+
+        do_reduce = reduce and len(summaries) > 1
+        if held is not None:
+            item, held = held, None
+            item.eof = not do_reduce
+            yield item
+        if do_reduce:
+            async for item in merge_summaries(llm, prompt, summaries, model_name, cache, temperature, spend,
+                                              concurrency, reduce_tokens):
+                yield item
+    finally:
+        feeder.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(feeder, *tasks, return_exceptions=True)
+        if spend is not None:
+            # paid for but never yielded: a held result, and chunks that finished ahead of their turn
+            pending = [held] if held is not None else []
+            for queue in queues:
+                while not queue.empty():
+                    pending.append(queue.get_nowait())
+            for item in pending:
+                if isinstance(item, ChunkResult) and not item.cached:
+                    spend.tokens += item.total_tokens
+                    spend.cost += item.total_cost
+
+
+def _group(summaries: list[str], max_tokens: int, model_name: str) -> list[str]:
+    # consecutive summaries joined into inputs of at most max_tokens, a longer summary stays alone
+    groups, group, size = [], [], 0
+    for summary in summaries:
+        tokens = count_tokens(summary, model_name)
+        if group and size + tokens > max_tokens:
+            groups.append("\n\n".join(group))
+            group, size = [], 0
+        group.append(summary)
+        size += tokens
+    groups.append("\n\n".join(group))
+    return groups
+
+
+async def merge_summaries(llm, prompt: str, summaries: list[str], model_name: str,
+                          cache: Optional[ResponseCache] = None,
+                          temperature: float = 0.0,
+                          spend: Optional[Spend] = None,
+                          concurrency: int = 1,
+                          max_tokens: int = 0) -> AsyncIterator[Union[str, ChunkResult]]:
+    """
+    Reduce pass: one LLM call merging chunk summaries into a single memo. The result is marked eof.
+    If the summaries take more than `max_tokens`, the chunk size of the request's plan, they are
+    first merged in groups that fit, as often as needed. Only the last call is streamed, as
+    ReduceDelta, and its result carries the usage of all of them.
+    """
+    carried_tokens, carried_cost, cached = 0, 0.0, True
+    paid = Spend()      # intermediate merges that called the LLM, billed with the last one
+    task = None
+    try:
+        while max_tokens > 0 and len(summaries) > 1:
+            groups = _group(summaries, max_tokens, model_name)
+            if len(groups) == 1 or len(groups) == len(summaries):
+                break       # fits, or no group holds two summaries and grouping would not shrink anything
+            summaries = []
+            async for item in summarize_chunks(llm, prompt, groups, model_name, concurrency, False, cache,
+                                               temperature, spend):
+                if isinstance(item, ChunkResult):
+                    summaries.append(item.text)
+                    carried_tokens += item.total_tokens
+                    carried_cost += item.total_cost
+                    cached = cached and item.cached
+                    if not item.cached:
+                        paid.tokens += item.total_tokens
+                        paid.cost += item.total_cost
+
+        queue = asyncio.Queue()
+        task = asyncio.create_task(_run_chunk(llm, prompt, "\n\n".join(summaries), model_name, len(summaries),
+                                              queue, asyncio.Semaphore(1), cache, temperature, spend))
+        while (item := await queue.get()) is not _DONE:
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, ChunkResult):
+                item.eof = True
+                item.reduced = True
+                item.total_tokens += carried_tokens
+                item.total_cost += carried_cost
+                item.cached = item.cached and cached
+                paid = None
+                yield item
+            else:
+                yield ReduceDelta(item)
+    finally:
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if spend is not None and paid is not None:
+            # merged, and paid for, but cut off before the last call delivered
+            spend.tokens += paid.tokens
+            spend.cost += paid.cost
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, Flow
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_free_slots_admit_at_once():
+    admission = AdmissionController(limit=2)
+    await admission.acquire(Flow("a", "balance"))
+    await admission.acquire(Flow("b", "balance"))
+    assert admission.active == 2
+    admission.release(1.0)
+    assert admission.active == 1
+
+
+@pytest.mark.asyncio
+async def test_queued_calls_run_in_weighted_fair_order():
+    admission = AdmissionController(limit=1, deadline=60)
+    await admission.acquire(Flow("holder", "balance"))
+    order = []
+
+    async def call(name: str, flow: Flow):
+        await admission.acquire(flow)
+        order.append(name)
+        admission.release(0.0)
+
+    balance, subscriber = Flow("alice", "balance"), Flow("bob", "subscriber")
+    tasks = []
+    for name, flow in (("a1", balance), ("a2", balance), ("b1", subscriber), ("b2", subscriber)):
+        tasks.append(asyncio.create_task(call(name, flow)))
+        await settle()
+    assert len(admission._queue) == 4
+
+    admission.release(0.0)
+    await asyncio.gather(*tasks)
+    # finish tags: b1 0.5, a1 1.0, b2 1.0, a2 2.0. Ties go to the call queued first.
+    assert order == ["b1", "a1", "b2", "a2"]
+    assert admission.active == 0
+
+
+@pytest.mark.asyncio
+async def test_full_queue_sheds():
+    admission = AdmissionController(limit=1, deadline=60, max_queue=1)
+    await admission.acquire(Flow("holder", "balance"))
+    waiter = asyncio.create_task(admission.acquire(Flow("a", "balance")))
+    await settle()
+    with pytest.raises(AdmissionRejected) as rejected:
+        await admission.acquire(Flow("b", "balance"))
+    assert rejected.value.code == "overloaded"
+    assert admission.shed == 1
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_estimated_wait_over_deadline_sheds_at_once():
+    admission = AdmissionController(limit=1, deadline=1)
+    await admission.acquire(Flow("holder", "balance"))
+    with pytest.raises(AdmissionRejected) as rejected:
+        await admission.acquire(Flow("a", "balance"))
+    assert rejected.value.retry_after == pytest.approx(admission._service_time)
+    assert not admission._queue
+
+
+@pytest.mark.asyncio
+async def test_call_not_started_by_deadline_is_shed():
+    admission = AdmissionController(limit=1, deadline=0.05)
+    admission._service_time = 0.01
+    await admission.acquire(Flow("holder", "balance"))
+    with pytest.raises(AdmissionRejected):
+        await admission.acquire(Flow("a", "balance"))
+    assert not admission._queue
+    assert admission.active == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_leaves_the_queue():
+    admission = AdmissionController(limit=1, deadline=60)
+    await admission.acquire(Flow("holder", "balance"))
+    waiter = asyncio.create_task(admission.acquire(Flow("a", "balance")))
+    await settle()
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert not admission._queue
+    admission.release(0.0)
+    assert admission.active == 0
+
+
+@pytest.mark.asyncio
+async def test_slot_handed_to_cancelled_waiter_goes_to_the_next():
+    admission = AdmissionController(limit=1, deadline=60)
+    await admission.acquire(Flow("holder", "balance"))
+    first = asyncio.create_task(admission.acquire(Flow("a", "balance")))
+    await settle()
+    second = asyncio.create_task(admission.acquire(Flow("b", "balance")))
+    await settle()
+
+    admission.release(0.0)      # hands the slot to `first`, which is cancelled before it runs
+    first.cancel()
+    await asyncio.gather(first, return_exceptions=True)
+    await asyncio.wait_for(second, 1)
+    assert admission.active == 1
+    assert not admission._queue
+
+
+@pytest.mark.asyncio
+async def test_queue_positions_are_notified():
+    admission = AdmissionController(limit=1, deadline=60)
+    await admission.acquire(Flow("holder", "balance"))
+    positions = []
+
+    async def notify(position: int, wait: float):
+        positions.append(position)
+
+    waiters = [asyncio.create_task(admission.acquire(Flow(name, "balance", notify))) for name in ("a", "b")]
+    await settle()
+    assert sorted(positions) == [1, 2]
+    admission.release(0.0)
+    await settle()
+    assert positions[-1] == 1       # "b" moved up
+    for waiter in waiters:
+        waiter.cancel()
+    await asyncio.gather(*waiters, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_only_moved_waiters_are_notified_and_sends_are_held():
+    admission = AdmissionController(limit=1, deadline=60)
+    await admission.acquire(Flow("holder", "balance"))
+    sent = {"a": [], "b": [], "c": []}
+
+    def notifier(name: str):
+        async def notify(position: int, wait: float):
+            await asyncio.sleep(0)
+            sent[name].append(position)
+        return notify
+
+    waiters = [asyncio.create_task(admission.acquire(Flow(name, "balance", notifier(name)))) for name in sent]
+    await settle()
+    waiters[1].cancel()         # "c" moves up, "a" stays first
+    await asyncio.gather(waiters[1], return_exceptions=True)
+    assert len(admission._notifying) == 1
+    await settle()
+    assert sent == {"a": [1], "b": [2], "c": [3, 2]}
+    assert not admission._notifying
+    for waiter in waiters:
+        waiter.cancel()
+    await asyncio.gather(*waiters, return_exceptions=True)
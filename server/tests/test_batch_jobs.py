@@ -0,0 +1,120 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from batch_jobs import BatchRunner, JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+
+@pytest.fixture(scope="module")
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_claim_takes_the_oldest_due_job(store):
+    first = store.submit("alice", {"n": 1})
+    second = store.submit("bob", {"n": 2})
+    store.claim(os.getpid())
+    store.retry(first.id, 3600)     # deferred, not due before the next one
+
+    job = store.claim(os.getpid())
+    assert (job.id, job.status, job.attempts) == (second.id, "running", 1)
+    assert store.claim(os.getpid()) is None
+
+
+def test_claim_counts_attempts(store):
+    job = store.submit("alice", {})
+    store.claim(os.getpid())
+    store.retry(job.id, 0)
+    assert store.claim(os.getpid()).attempts == 2
+
+
+def test_concurrent_claims_take_every_job_once(store):
+    jobs = {store.submit("alice", {"n": n}).id for n in range(20)}
+    claimed, lock = [], threading.Lock()
+
+    def claim_all():
+        while (job := store.claim(os.getpid())) is not None:
+            with lock:
+                claimed.append(job.id)
+
+    threads = [threading.Thread(target=claim_all) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == sorted(jobs)
+
+
+def test_cancel_only_by_the_owner_and_only_while_unfinished(store):
+    job = store.submit("alice", {})
+    assert not store.cancel(job.id, "bob")
+    assert store.cancel(job.id, "alice")
+    assert store.get(job.id).status == "cancelled"
+    assert not store.cancel(job.id, "alice")
+    assert store.claim(os.getpid()) is None
+
+
+def test_job_cancelled_while_running_stays_cancelled(store):
+    job = store.submit("alice", {})
+    store.claim(os.getpid())
+    assert store.cancel(job.id, "alice")
+    store.finish(job.id, "done", "summary", 10, 0.01)
+    store.retry(job.id, 0)
+    assert store.get(job.id).status == "cancelled"
+
+
+def test_recover_requeues_jobs_of_dead_workers(store, dead_pid):
+    dead, live = store.submit("alice", {}), store.submit("bob", {})
+    store.claim(dead_pid)
+    store.claim(os.getppid())
+    assert store.recover() == 1
+    assert store.get(dead.id).status == "queued"
+    assert store.get(live.id).status == "running"
+    assert store.claim(os.getpid()).id == dead.id
+
+
+def test_own_jobs_are_recovered_at_start_only(store):
+    job = store.submit("alice", {})
+    store.claim(os.getpid())
+    assert store.recover(at_start=False) == 0
+    assert store.get(job.id).status == "running"
+    assert store.recover() == 1
+    assert store.get(job.id).status == "queued"
+
+
+@pytest.mark.asyncio
+async def test_runner_requeues_jobs_of_a_worker_that_died_while_it_runs(store, dead_pid):
+    done = []
+
+    async def handler(job):
+        done.append(job.id)
+        return "summary", 10, 0.01
+
+    load = [1.0]    # busy until the dead worker holds the job
+    runner = BatchRunner(store, handler, lambda: load[0])
+    runner.configure({"BATCH_POLL": "0.1"})
+    runner.start()
+    try:
+        job = store.submit("alice", {})
+        store.claim(dead_pid)
+        load[0] = 0.0
+        for _ in range(30):
+            if store.get(job.id).status == "done":
+                break
+            await asyncio.sleep(0.1)
+        assert done == [job.id]
+        assert store.get(job.id).status == "done"
+        assert (await runner.stats())["done"] == 1
+    finally:
+        await runner.stop()
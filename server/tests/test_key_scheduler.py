@@ -0,0 +1,127 @@
+import pytest
+
+import key_scheduler
+from key_scheduler import KeyScheduler, TokenBucket
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(key_scheduler.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_refills_per_minute_up_to_capacity():
+    bucket = TokenBucket(600)
+    now = bucket.updated
+    bucket.take(600, now)
+    assert bucket.available(now) == 0
+    assert bucket.available(now + 30) == pytest.approx(300)
+    assert bucket.available(now + 600) == 600
+
+
+def test_bucket_can_go_negative():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    bucket.take(90, now)
+    assert bucket.available(now) == -30
+    assert bucket.wait_time(60, now) == pytest.approx(90)
+
+
+def test_oversized_request_needs_a_full_bucket():
+    bucket = TokenBucket(100)
+    now = bucket.updated
+    assert bucket.has(500, now)
+    bucket.take(1, now)
+    assert not bucket.has(500, now)
+    assert bucket.wait_time(500, now) == pytest.approx(0.6)
+
+
+def test_resize_keeps_level_within_capacity():
+    bucket = TokenBucket(1000)
+    bucket.resize(100)
+    assert bucket.available(bucket.updated) == 100
+    bucket.resize(500)
+    assert bucket.available(bucket.updated) == 100
+
+
+def test_pick_prefers_least_loaded_key(clock):
+    scheduler = KeyScheduler(["a", "b"], rpm=10, tpm=1000)
+    with scheduler._lock:
+        scheduler._states["a"].tokens.take(500, clock.now)
+    assert scheduler._pick(100, False, ()).key == "b"
+
+
+def test_pick_breaks_ties_by_calls_in_flight(clock):
+    scheduler = KeyScheduler(["a", "b"], rpm=10, tpm=1000)
+    scheduler._states["a"].in_flight = 2
+    scheduler._states["b"].in_flight = 1
+    assert scheduler._pick(100, False, ()).key == "b"
+
+
+def test_pick_skips_keys_in_cooldown_and_without_budget(clock):
+    scheduler = KeyScheduler(["a", "b", "c"], rpm=10, tpm=1000)
+    scheduler._states["a"].cooldown_until = clock.now + 5
+    scheduler._states["b"].tokens.take(950, clock.now)
+    assert scheduler._pick(100, False, ()).key == "c"
+    scheduler._states["c"].requests.take(10, clock.now)
+    assert scheduler._pick(100, False, ()) is None
+
+
+def test_pick_forced_takes_key_that_frees_first(clock):
+    scheduler = KeyScheduler(["a", "b"], rpm=10, tpm=1000)
+    scheduler._states["a"].cooldown_until = clock.now + 30
+    scheduler._states["b"].tokens.take(1000, clock.now)    # 100 tokens back in 6 seconds
+    assert scheduler._pick(100, False, ()) is None
+    assert scheduler._pick(100, True, ()).key == "b"
+
+
+def test_pick_uses_excluded_keys_only_as_last_resort(clock):
+    scheduler = KeyScheduler(["a", "b"], rpm=10, tpm=1000)
+    scheduler._states["b"].in_flight = 5
+    assert scheduler._pick(100, False, ("a",)).key == "b"
+    assert KeyScheduler(["a"], rpm=10, tpm=1000)._pick(100, False, ("a",)).key == "a"
+
+
+@pytest.mark.asyncio
+async def test_acquire_and_release_correct_the_estimate(clock):
+    scheduler = KeyScheduler(["a"], rpm=10, tpm=1000)
+    lease = await scheduler.acquire(300)
+    state = scheduler._states["a"]
+    assert (state.in_flight, state.tokens.available(clock.now)) == (1, 700)
+    scheduler.release(lease, used_tokens=100)
+    assert (state.in_flight, state.tokens.available(clock.now), state.total_tokens) == (0, 900, 100)
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_key_cools_down_with_backoff(clock):
+    scheduler = KeyScheduler(["a", "b"], rpm=10, tpm=1000)
+    lease = await scheduler.acquire(100)
+    scheduler.release(lease, rate_limited=True)
+    state = scheduler._states[lease.key]
+    assert state.cooldown_until == clock.now + key_scheduler.BASE_COOLDOWN
+    assert (await scheduler.acquire(100)).key != lease.key
+
+    clock.now += key_scheduler.BASE_COOLDOWN
+    lease = await scheduler.acquire(100, exclude=("a" if lease.key == "b" else "b",))
+    scheduler.release(lease, rate_limited=True, retry_after=30)
+    assert state.cooldown_until == clock.now + 30
+    assert state.strikes == 2
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_no_longer_than_max_wait(clock, monkeypatch):
+    monkeypatch.setattr(key_scheduler, "MAX_WAIT", 0.0)
+    scheduler = KeyScheduler(["a"], rpm=1, tpm=1000)
+    await scheduler.acquire(100)
+    lease = await scheduler.acquire(100)    # over the budget, but nothing else left
+    assert lease.key == "a"
+    assert scheduler._states["a"].requests.available(clock.now) == -1
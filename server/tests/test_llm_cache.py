@@ -0,0 +1,42 @@
+import sqlite3
+
+from llm_cache import CachedResponse, ResponseCache
+
+
+def entry(text: str) -> CachedResponse:
+    return CachedResponse(text=text, total_tokens=10, total_cost=0.01, created=1e12)
+
+
+def summed(cache: ResponseCache) -> int:
+    return cache._index().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+
+def test_disk_total_follows_writes_rewrites_and_removals(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    cache._disk_put("a1", entry("x" * 100))
+    cache._disk_put("b2", entry("y" * 50))
+    cache._disk_put("a1", entry("x" * 10))      # rewritten smaller
+    assert cache._disk_used == summed(cache)
+    cache._disk_remove(cache._index(), ["b2"])
+    assert ResponseCache._usage(cache._index()) == summed(cache)
+
+
+def test_over_budget_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), disk_bytes=400)
+    for key in ("k1", "k2", "k3", "k4"):
+        cache._disk_put(key, entry("x" * 50))
+    assert cache._disk_used <= 400
+    assert cache._disk_used == summed(cache)
+    assert cache._disk_get("k1") is None
+    assert cache._disk_get("k4").text == "x" * 50
+
+
+def test_index_of_an_older_version_gets_its_total(tmp_path):
+    db = sqlite3.connect(tmp_path / "index.db")
+    db.executescript("CREATE TABLE entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL);"
+                     "INSERT INTO entries VALUES ('old', 70, 0);")
+    db.commit()
+    db.close()
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    cache._index()
+    assert cache._disk_used == 70
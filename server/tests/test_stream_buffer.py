@@ -0,0 +1,167 @@
+import asyncio
+
+import pytest
+
+from stream_buffer import RequestStream, StreamBuffer
+
+
+async def collect(stream: RequestStream, offset: int = 0) -> list[tuple[int, dict]]:
+    return [item async for item in stream.follow(offset)]
+
+
+async def finished_stream(*messages: dict) -> RequestStream:
+    stream = RequestStream("r1", "alice")
+    for message in messages:
+        if message["type"] in ("stream", "reduce"):
+            await stream.stream(message["data"], message["type"])
+        else:
+            await stream.send(message)
+    stream.finish()
+    return stream
+
+
+@pytest.mark.asyncio
+async def test_buffered_deltas_replay_merged_with_resume_offsets():
+    stream = await finished_stream(
+        {"type": "stream", "data": "a"}, {"type": "stream", "data": "b"}, {"type": "result", "answer": "ab"},
+        {"type": "reduce", "data": "c"}, {"type": "reduce", "data": "d"}, {"type": "result", "answer": "cd"})
+    assert await collect(stream) == [
+        (2, {"type": "stream", "data": "ab"}),
+        (3, {"type": "result", "answer": "ab"}),
+        (5, {"type": "reduce", "data": "cd"}),
+        (6, {"type": "result", "answer": "cd"}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_resume_from_offset_skips_what_was_received():
+    stream = await finished_stream(
+        {"type": "stream", "data": "a"}, {"type": "stream", "data": "b"}, {"type": "result", "answer": "ab"})
+    assert await collect(stream, 1) == [(2, {"type": "stream", "data": "b"}), (3, {"type": "result", "answer": "ab"})]
+    assert await collect(stream, 3) == []
+    assert await collect(stream, -5) == await collect(stream, 0)
+
+
+@pytest.mark.asyncio
+async def test_follow_waits_for_output_until_done():
+    stream = RequestStream("r1", "alice")
+    follower = asyncio.create_task(collect(stream))
+    await asyncio.sleep(0)
+    assert stream.listeners == 1
+    await stream.stream("a")
+    await asyncio.sleep(0)
+    await stream.send({"type": "result", "answer": "a"})
+    stream.finish()
+    assert await follower == [(1, {"type": "stream", "data": "a"}), (2, {"type": "result", "answer": "a"})]
+    assert stream.listeners == 0
+
+
+@pytest.mark.asyncio
+async def test_work_runs_on_and_failures_become_error_messages():
+    buffer = StreamBuffer()
+
+    async def work(out: RequestStream):
+        await out.stream("partial")
+        raise ValueError("boom")
+
+    stream = buffer.start("alice", "r1", work)
+    await stream.task
+    assert stream.done
+    assert [m for _, m in await collect(stream)] == [
+        {"type": "stream", "data": "partial"}, {"type": "error", "message": "Server error: boom"}]
+    assert buffer.get("alice", "r1") is stream
+    assert buffer.get("bob", "r1") is None
+    assert buffer.stats()["resumed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_cancel_stops_the_work_and_forgets_the_output():
+    buffer = StreamBuffer()
+    stream = buffer.start("alice", "r1", lambda out: asyncio.sleep(60))
+    await asyncio.sleep(0)
+    assert buffer.cancel("alice", "r1")
+    await asyncio.gather(stream.task, return_exceptions=True)
+    assert stream.task.cancelled()
+    assert buffer.get("alice", "r1") is None
+    assert not buffer.cancel("alice", "r1")
+
+
+@pytest.mark.asyncio
+async def test_streams_idle_beyond_ttl_are_evicted():
+    buffer = StreamBuffer(ttl=10)
+    running = buffer.start("alice", "r1", lambda out: asyncio.sleep(60))
+    kept = buffer.start("alice", "r2", lambda out: asyncio.sleep(0))
+    await asyncio.sleep(0)
+    running.idle_since -= 11
+    buffer.evict()
+    await asyncio.gather(running.task, return_exceptions=True)
+    assert running.task.cancelled()
+    assert buffer.get("alice", "r1") is None
+    assert buffer.get("alice", "r2") is kept
+    assert buffer.stats()["evicted"] == 1
+
+
+@pytest.mark.asyncio
+async def test_streams_followed_by_a_client_are_not_evicted():
+    buffer = StreamBuffer(ttl=10)
+    stream = buffer.start("alice", "r1", lambda out: asyncio.sleep(60))
+    stream.idle_since -= 11
+    stream.listeners = 1
+    buffer.evict()
+    assert buffer.get("alice", "r1") is stream
+    stream.task.cancel()
+    await asyncio.gather(stream.task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_over_budget_drops_finished_streams_first_oldest_first():
+    buffer = StreamBuffer(max_bytes=250)
+
+    def writer(seconds: float):
+        async def work(out: RequestStream):
+            await out.stream("x" * 68)     # 100 bytes with the message overhead
+            await asyncio.sleep(seconds)
+        return work
+
+    old = buffer.start("alice", "old", writer(0))
+    await old.task
+    new = buffer.start("alice", "new", writer(0))
+    await new.task
+    running = buffer.start("alice", "running", writer(60))     # takes the buffer past its budget
+    await asyncio.sleep(0)
+
+    assert buffer.stats()["bytes"] == 200
+    assert buffer.get("alice", "old") is None
+    assert buffer.get("alice", "new") is new
+    assert buffer.get("alice", "running") is running
+    running.task.cancel()
+    await asyncio.gather(running.task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_running_stream_over_budget_is_dropped_as_it_grows():
+    buffer = StreamBuffer(max_bytes=250)
+
+    async def work(out: RequestStream):
+        for _ in range(10):
+            await out.stream("x" * 68)
+            await asyncio.sleep(0)
+
+    stream = buffer.start("alice", "r1", work)
+    await asyncio.gather(stream.task, return_exceptions=True)
+    assert stream.task.cancelled()
+    assert buffer.get("alice", "r1") is None
+    assert buffer.stats()["bytes"] == 0
+
+
+@pytest.mark.asyncio
+async def test_sweep_frees_abandoned_streams_without_new_requests():
+    buffer = StreamBuffer(ttl=10)
+    stream = buffer.start("alice", "r1", lambda out: out.stream("done"))
+    await stream.task
+    stream.idle_since -= 11
+    sweeper = asyncio.create_task(buffer.sweep(0.01))
+    await asyncio.sleep(0.05)
+    sweeper.cancel()
+    assert buffer.stats()["streams"] == 0
+    assert buffer.stats()["bytes"] == 0
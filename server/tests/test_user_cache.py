@@ -0,0 +1,158 @@
+import json
+import time
+import types
+
+import pytest
+
+import leither_api
+import user_cache
+from leither_api import AsyncLeitherAPI, LeitherAPI
+from user_cache import TTLCache
+from utilities import UserInDB
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(user_cache.time, "monotonic", clock)
+    return clock
+
+
+class FakeLeither:
+    """hprose client of an in-memory Leither, counting reads of user records"""
+    store: dict = {}
+    reads = 0
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def GetVar(self, *args): return "test"
+    def GetVarByContext(self, *args): return "ppt"
+    def Login(self, ppt): return types.SimpleNamespace(sid="sid", uid="uid")
+    def MMCreate(self, sid, key, ext, name, *args): return "mid-" + name
+    def MMOpen(self, sid, mid, version): return mid
+    def MMBackup(self, *args): pass
+    def MiMeiPublish(self, *args): pass
+    def MFSetObject(self, mmsid, value): self.store[mmsid] = value
+    def Hget(self, mmsid, key, field): return self.store.get((mmsid, key, field), "")
+    def Hset(self, mmsid, key, field, value): self.store[(mmsid, key, field)] = value
+
+    def MFGetObject(self, mmsid):
+        FakeLeither.reads += 1
+        return self.store.get(mmsid, "")
+
+
+def user(balance: float = 10.0) -> UserInDB:
+    return UserInDB(id="id-alice", username="alice", hashed_password="x", mid="mid-alice",
+                    dollar_balance=balance, monthly_usage={str(time.localtime().tm_mon): 0.0}, token_count=0)
+
+
+def stored_balance() -> float:
+    return json.loads(FakeLeither.store["mid-alice"])["dollar_balance"]
+
+
+@pytest.fixture
+def lapi(monkeypatch, clock):
+    monkeypatch.setattr(leither_api.hprose, "HttpClient", FakeLeither)
+    monkeypatch.setattr(LeitherAPI, "load_env", lambda self: setattr(self, "cost_efficiency", 2.0))
+    FakeLeither.store = {"mid-alice": json.dumps(user().model_dump())}
+    FakeLeither.reads = 0
+    return LeitherAPI()
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = TTLCache("test", 10, 30)
+    cache.put("a", 1)
+    clock.now += 29
+    assert cache.get("a") == 1
+    clock.now += 2
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_goes_first(clock):
+    cache = TTLCache("test", 2, 30)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+
+
+def test_read_does_not_replace_a_newer_write(clock):
+    cache = TTLCache("test", 10, 30)
+    started = clock.now
+    clock.now += 1
+    cache.put("a", "written")
+    cache.fill("a", "read before the write", started)
+    assert cache.get("a") == "written"
+    cache.fill("a", "read after the write", clock.now + 1)
+    assert cache.get("a") == "read after the write"
+
+
+def test_zero_size_or_ttl_turns_the_cache_off(clock):
+    cache = TTLCache("test", 10, 30)
+    cache.put("a", 1)
+    cache.configure(10, 0)
+    assert cache.get("a") is None
+    cache.put("a", 1)
+    assert cache.get("a") is None
+
+
+def test_get_user_reads_leither_once(lapi):
+    assert lapi.get_user("alice").dollar_balance == 10.0
+    assert lapi.get_user("alice").dollar_balance == 10.0
+    assert FakeLeither.reads == 1
+    lapi.get_user("alice", fresh=True)
+    assert FakeLeither.reads == 2
+
+
+def test_cached_user_is_a_copy(lapi):
+    lapi.get_user("alice").dollar_balance = 0.0
+    assert lapi.get_user("alice").dollar_balance == 10.0
+
+
+def test_bookkeeping_updates_the_cached_user(lapi):
+    lapi.get_user("alice")
+    lapi.bookkeeping(1.0, 100, lapi.get_user("alice", fresh=True))
+    reads = FakeLeither.reads
+    cached = lapi.get_user("alice")
+    assert FakeLeither.reads == reads
+    assert cached.dollar_balance == stored_balance() == 8.0
+    assert cached.token_count == 200
+
+
+def test_writes_of_other_workers_show_after_ttl(lapi, clock):
+    lapi.get_user("alice")
+    FakeLeither.store["mid-alice"] = json.dumps(user(balance=3.0).model_dump())
+    assert lapi.get_user("alice").dollar_balance == 10.0
+    clock.now += lapi.users.ttl + 1
+    assert lapi.get_user("alice").dollar_balance == 3.0
+
+
+def test_deleted_user_leaves_the_cache(lapi):
+    FakeLeither.store[("mid-secretari backend", leither_api.USER_ACCOUNT_KEY, "id-alice")] = \
+        json.dumps(user().model_dump())
+    lapi.get_user("alice")
+    lapi.delete_user(user())
+    assert lapi.cached_user("alice") is None
+
+
+@pytest.mark.asyncio
+async def test_async_get_user_sees_bookkeeping_without_a_read(lapi):
+    alapi = AsyncLeitherAPI(lapi, workers=2, timeout=5)
+    try:
+        await alapi.bookkeeping(0.5, 10, await alapi.get_user("alice", fresh=True))
+        reads = FakeLeither.reads
+        assert (await alapi.get_user("alice")).dollar_balance == 9.0
+        assert FakeLeither.reads == reads
+    finally:
+        alapi.close()
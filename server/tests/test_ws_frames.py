@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.websockets import WebSocketState
+
+from ws_frames import FrameWriter
+
+
+class StuckSocket:
+    """WebSocket of a client that reads nothing until `release` is set"""
+
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.release = asyncio.Event()
+        self.sent: list[dict] = []
+        self.closed = False
+
+    async def send_text(self, text: str):
+        await self.release.wait()
+        self.sent.append(json.loads(text))
+
+    async def close(self, code: int = 1000):
+        self.closed = True
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+async def stall(writer: FrameWriter):
+    # the sender takes the first message and hangs on the socket
+    await writer.send({"type": "first"})
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_queue_updates_replace_each_other_and_deltas_merge_per_request():
+    socket = StuckSocket()
+    writer = FrameWriter(socket, max_queue=2)
+    await stall(writer)
+    for position in (3, 2, 1):
+        await writer.send({"type": "queue", "position": position})
+    await writer.stream("a", "reduce", request_id="r1", offset=1)
+    await writer.stream("b", "reduce", request_id="r1", offset=2)
+    assert list(writer._queue) == [
+        {"type": "queue", "position": 1}, {"type": "reduce", "request_id": "r1", "offset": 2, "data": "ab"}]
+    socket.release.set()
+    await writer.drain(1)
+    assert socket.sent[-1]["data"] == "ab"
+    await writer.aclose()
+
+
+@pytest.mark.asyncio
+async def test_messages_wait_for_room_in_a_full_queue():
+    socket = StuckSocket()
+    writer = FrameWriter(socket, max_queue=1)
+    await stall(writer)
+    await writer.send({"type": "result", "n": 1})
+    waiting = asyncio.create_task(writer.send({"type": "result", "n": 2}))
+    await asyncio.sleep(0.01)
+    assert not waiting.done() and len(writer._queue) == 1
+    socket.release.set()
+    await asyncio.wait_for(waiting, 1)
+    await writer.drain(1)
+    assert [m.get("n") for m in socket.sent] == [None, 1, 2]
+    await writer.aclose()
+
+
+@pytest.mark.asyncio
+async def test_client_taking_nothing_is_closed():
+    socket = StuckSocket()
+    writer = FrameWriter(socket, max_queue=1, send_timeout=0.05)
+    await stall(writer)
+    await writer.send({"type": "result", "n": 1})
+    with pytest.raises(ConnectionError):
+        await writer.send({"type": "result", "n": 2})
+    assert socket.closed and not writer.connected
+    assert not writer._queue
@@ -0,0 +1,55 @@
+"""
+Text Preparation Pool
+Runs the CPU heavy preparation of large transcripts (normalizing, encoding, splitting) in a
+small process pool, so a multi-megabyte transcript does not stall the event loop for every
+other connection. Short transcripts are still prepared inline, where it is cheaper.
+"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from tokenization import TextChunk, prepare_text
+
+
+class TextPrepPool:
+    """Bounded process pool for prepare_text, used above a size threshold"""
+
+    def __init__(self, workers: int = 2, inline_chars: int = 200_000):
+        self.workers = workers                  # 0 keeps all preparation inline
+        self.inline_chars = inline_chars        # transcripts up to this length are prepared on the event loop
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.offloaded = 0
+        self.inline = 0
+
+    def configure(self, env: dict) -> None:
+        """Apply settings from .env. A new worker count takes effect when the pool is next created."""
+        self.workers = int(env.get("TEXT_PREP_WORKERS", "2"))
+        self.inline_chars = int(env.get("TEXT_PREP_INLINE_CHARS", "200000"))
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, not fork: the server process has threads (scheduler, pools) that must not be copied
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            self._slots = asyncio.Semaphore(self.workers * 2)   # jobs queued for the pool at most
+        return self._executor
+
+    async def prepare(self, text: str, chunk_size: int, overlap: int, model_name: str) -> list[TextChunk]:
+        if self.workers <= 0 or len(text) <= self.inline_chars:
+            self.inline += 1
+            return prepare_text(text, chunk_size, overlap, model_name)
+        pool = self._pool()
+        async with self._slots:
+            self.offloaded += 1
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, prepare_text, text, chunk_size, overlap, model_name)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "inline": self.inline, "offloaded": self.offloaded}
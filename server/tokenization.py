@@ -0,0 +1,107 @@
+"""
+Tokenization
+Encodes a transcript once and cuts it into chunks on token boundaries. Every chunk keeps
+its token count, which is handed to the cost tracker so the prompt is not encoded again.
+"""
+
+import re
+import unicodedata
+from functools import lru_cache
+
+import tiktoken
+
+CHAT_OVERHEAD_TOKENS = 9    # system and user message framing, 3 tokens each, plus 3 priming the reply
+BOUNDARY_SLACK = 0.1        # fraction of a chunk searched backwards for a line or sentence end
+SENTENCE_ENDS = tuple(s.encode("utf-8") for s in ("\n", ". ", ".", "!", "?", "。", "！", "？"))
+
+
+class TextChunk(str):
+    """A piece of transcript that knows its own token count"""
+    tokens: int
+
+    def __new__(cls, text: str, tokens: int):
+        chunk = super().__new__(cls, text)
+        chunk.tokens = tokens
+        return chunk
+
+    def __reduce__(self):
+        # keep the token count when chunks come back from a worker process
+        return TextChunk, (str(self), self.tokens)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Encoding of a model, built once per model"""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=256)
+def count_tokens(text: str, model_name: str) -> int:
+    # cached, since the same few prompts come with every request
+    return len(get_encoding(model_name).encode(text))
+
+
+def count_prompt_tokens(prompt: str, chunk: str, model_name: str) -> int:
+    """Tokens of the system prompt and chunk messages. Only encodes what is not known yet."""
+    chunk_tokens = chunk.tokens if isinstance(chunk, TextChunk) else len(get_encoding(model_name).encode(chunk))
+    return count_tokens(prompt, model_name) + chunk_tokens + CHAT_OVERHEAD_TOKENS
+
+
+def _starts_mid_char(encoding: tiktoken.Encoding, token: int) -> bool:
+    # a UTF-8 continuation byte: the character began in the token before
+    return 0x80 <= encoding.decode_single_token_bytes(token)[0] <= 0xBF
+
+
+def _cut(encoding: tiktoken.Encoding, tokens: list[int], start: int, end: int) -> int:
+    """Move a chunk end back to the closest line or sentence end, and never into a character"""
+    floor = max(start + 1, end - int((end - start) * BOUNDARY_SLACK))
+    for i in range(end, floor - 1, -1):
+        if encoding.decode_single_token_bytes(tokens[i - 1]).endswith(SENTENCE_ENDS) and not _starts_mid_char(encoding, tokens[i]):
+            return i
+    while end > start + 1 and _starts_mid_char(encoding, tokens[end]):
+        end -= 1
+    return end
+
+
+def split_tokens(text: str, chunk_size: int, overlap: int, model_name: str) -> list[TextChunk]:
+    """
+    Split text into chunks of at most chunk_size tokens, with about `overlap` tokens repeated
+    between neighbours. The text is encoded exactly once.
+    """
+    encoding = get_encoding(model_name)
+    tokens = encoding.encode(text)
+    chunk_size = max(1, int(chunk_size))
+    if len(tokens) <= chunk_size:
+        return [TextChunk(text, len(tokens))] if text.strip() else []
+
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + chunk_size, len(tokens))
+        if end < len(tokens):
+            end = _cut(encoding, tokens, start, end)
+        piece = encoding.decode(tokens[start:end])
+        if piece.strip():
+            chunks.append(TextChunk(piece, end - start))
+        if end >= len(tokens):
+            break
+        next_start = max(start + 1, end - overlap)
+        while next_start > start + 1 and _starts_mid_char(encoding, tokens[next_start]):
+            next_start -= 1
+        start = next_start
+    return chunks
+
+
+def normalize_text(text: str) -> str:
+    """Canonical Unicode form, no trailing spaces on lines, at most one blank line in a row"""
+    text = unicodedata.normalize("NFC", text)
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def prepare_text(text: str, chunk_size: int, overlap: int, model_name: str) -> list[TextChunk]:
+    """Everything done to a transcript before it goes to the LLM: normalize, encode once, split"""
+    return split_tokens(normalize_text(text), chunk_size, overlap, model_name)
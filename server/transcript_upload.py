@@ -0,0 +1,139 @@
+"""
+Transcript Upload
+A transcript sent in numbered fragments instead of one JSON message, optionally compressed.
+Fragments are decompressed and decoded as they arrive, and every chunk that is complete is
+handed to the summarizer at once, so LLM calls run while the rest is still uploading. The
+text held is the open tail only, never the whole transcript, and an upload larger than the
+connection's byte budget is rejected.
+"""
+
+import asyncio
+import base64
+import binascii
+import codecs
+import zlib
+from typing import AsyncIterator, Callable, Optional, Union
+
+from metrics import UPLOAD_BYTES
+
+ENCODINGS = {"identity": None, "gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}    # zlib wbits
+MIN_SPLIT_CHARS = 4096      # the tail is not split again before it has grown by a quarter, or this much at first
+
+
+class UploadError(Exception):
+    """The upload cannot go on. Sent to the client as an error of this code."""
+
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.code = code
+
+
+class TranscriptUpload:
+    """One transcript arriving in fragments. Complete chunks come out of `chunks()` while it arrives."""
+
+    def __init__(self, split: Callable[[str], list[str]], max_bytes: int, encoding: str = "identity"):
+        if encoding not in ENCODINGS:
+            raise UploadError(f"Unknown encoding {encoding}. Use one of {', '.join(ENCODINGS)}.", "bad_encoding")
+        self.split = split                  # the live session splitter, chunks of LIVE_CHUNK_TOKENS
+        self.max_bytes = max_bytes
+        self.encoding = encoding
+        self._inflate = zlib.decompressobj(ENCODINGS[encoding]) if ENCODINGS[encoding] else None
+        self._decode = codecs.getincrementaldecoder("utf-8")()     # characters may be cut between fragments
+        self.next_seq = 0
+        self.received = 0                   # bytes as sent
+        self.size = 0                       # bytes of transcript, after decompression
+        self.tail = ""                      # text not yet part of a complete chunk
+        self.chunk_count = 0
+        self.done = False
+        self._split_at = MIN_SPLIT_CHARS
+        self._chunks: asyncio.Queue = asyncio.Queue()
+
+    def append(self, seq: int, data: bytes) -> int:
+        """
+        Add fragment `seq`, which must be the next one. A fragment sent again is ignored.
+        Returns the number of chunks it completed.
+        """
+        if self.done:
+            raise UploadError("The upload is finished.", "upload_closed")
+        if seq < self.next_seq:
+            return 0
+        if seq > self.next_seq:
+            raise UploadError(f"Fragment {seq} arrived, expected {self.next_seq}.", "upload_sequence")
+        self.next_seq += 1
+        self.received += len(data)
+        UPLOAD_BYTES.inc(len(data), "wire")
+        if self.received > self.max_bytes:
+            raise UploadError(f"Upload larger than {self.max_bytes} bytes.", "too_large")
+        self.tail += self._text(data, final=False)
+        if len(self.tail) < self._split_at:
+            return 0
+        return self._cut()
+
+    def _text(self, data: bytes, final: bool) -> str:
+        try:
+            if self._inflate is not None:
+                # never inflate beyond the budget, whatever the compression ratio
+                limit = self.max_bytes - self.size + 1
+                data = self._inflate.flush() if final else self._inflate.decompress(data, limit)
+                if self._inflate.unconsumed_tail:
+                    raise UploadError(f"Upload larger than {self.max_bytes} bytes.", "too_large")
+                if final and not self._inflate.eof:
+                    raise UploadError("The compressed data ends early.", "bad_data")
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                raise UploadError(f"Upload larger than {self.max_bytes} bytes.", "too_large")
+            UPLOAD_BYTES.inc(len(data), "text")
+            return self._decode.decode(data, final)
+        except zlib.error as e:
+            raise UploadError(f"Cannot decompress the upload: {e}", "bad_data")
+        except UnicodeDecodeError:
+            raise UploadError("The upload is not UTF-8 text.", "bad_data")
+
+    def _cut(self) -> int:
+        chunks = self.split(self.tail)
+        # the last piece may still grow, everything before it is final
+        complete, self.tail = chunks[:-1], chunks[-1] if chunks else ""
+        self._split_at = max(MIN_SPLIT_CHARS, len(self.tail) * 5 // 4)
+        for chunk in complete:
+            self._chunks.put_nowait(chunk)
+        self.chunk_count += len(complete)
+        return len(complete)
+
+    def finish(self, parts: Optional[int] = None) -> None:
+        """All fragments are sent. `parts`, the client's count of them, is checked if given."""
+        if self.done:
+            raise UploadError("The upload is finished.", "upload_closed")
+        if parts is not None and parts != self.next_seq:
+            raise UploadError(f"{self.next_seq} of {parts} fragments arrived.", "upload_incomplete")
+        self.tail += self._text(b"", final=True)
+        for chunk in (self.split(self.tail) if self.tail.strip() else []):
+            self._chunks.put_nowait(chunk)
+            self.chunk_count += 1
+        self.tail = ""
+        self.done = True
+        self._chunks.put_nowait(None)
+
+    def abort(self, error: Exception) -> None:
+        """Stop the upload, the summarizer gets `error` instead of further chunks"""
+        self.done = True
+        self.tail = ""
+        self._chunks.put_nowait(error)
+
+    async def chunks(self) -> AsyncIterator[str]:
+        """Complete chunks as they are cut, until the upload is finished"""
+        while (chunk := await self._chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+
+def fragment_data(data: Union[str, bytes], encoding: str) -> bytes:
+    """Payload of a fragment sent in a JSON message: text, or base64 of the compressed bytes"""
+    if isinstance(data, bytes):
+        return data
+    if encoding == "identity":
+        return data.encode("utf-8")
+    try:
+        return base64.b64decode(data, validate=True)
+    except binascii.Error:
+        raise UploadError("A compressed fragment in JSON must be base64.", "bad_data")
@@ -0,0 +1,95 @@
+"""
+User Cache
+Users read from Leither, kept for a short while. Every request looks up its user, which takes
+three hprose round trips, while a record only changes when the user is billed, pays or edits
+the account. Writes of this process update the cache at once, writes of other workers show
+after the TTL. Billing always reads the record from Leither.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from metrics import USER_CACHE_LOOKUPS
+
+
+class TTLCache:
+    """At most `size` entries, least recently used dropped first, each kept `ttl` seconds. Thread safe."""
+
+    def __init__(self, name: str, size: int, ttl: float):
+        self.name = name            # label of the hit and miss counts
+        self.size = size
+        self.ttl = ttl
+        self._items: OrderedDict[Hashable, tuple[float, float, object]] = OrderedDict()    # key: (expires, stored, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, size: int, ttl: float) -> None:
+        """A size or TTL of 0 turns the cache off"""
+        with self._lock:
+            self.size, self.ttl = size, ttl
+            if size <= 0 or ttl <= 0:
+                self._items.clear()
+            while len(self._items) > max(size, 0):
+                self._items.popitem(last=False)
+
+    def get(self, key: Hashable) -> Optional[object]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] <= now:
+                del self._items[key]
+                item = None
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        USER_CACHE_LOOKUPS.inc(1, self.name, "miss" if item is None else "hit")
+        return item[2] if item is not None else None
+
+    def put(self, key: Hashable, value: object) -> None:
+        """Store what was just written"""
+        self._store(key, value, None)
+
+    def fill(self, key: Hashable, value: object, since: float) -> None:
+        """
+        Store what was read from Leither by a read that started at `since`, time.monotonic().
+        A value put by a write meanwhile is newer and stays.
+        """
+        self._store(key, value, since)
+
+    def _store(self, key: Hashable, value: object, since: Optional[float]) -> None:
+        if self.size <= 0 or self.ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if since is not None and item is not None and item[1] >= since:
+                return
+            self._items[key] = (now + self.ttl, now, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "size": self.size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
@@ -1,9 +1,12 @@
 from fastapi import WebSocket
-import sys, ipaddress, re, time
+from fastapi.websockets import WebSocketState
+import asyncio, sys, ipaddress, logging, re, time, uuid
 from typing import Union
 from pydantic import BaseModel
 from enum import Enum
 
+log = logging.getLogger("secretari.ws")
+
 # Function to check if an IP is a local network IP
 def is_local_network_ip(ip):
     addr = re.findall(r'\[(.+)\]', ip[:ip.rfind(':')])
@@ -70,20 +73,130 @@ class UserInDB(UserOut):
                                                     # or {start date, end date, monthly/yearly, price}
     disabled: Union[bool, None] = False             # disabled by admin
 
+class Connection:
+    """One open WebSocket, with who it belongs to and when the client was last heard from"""
+    __slots__ = ("id", "websocket", "username", "writer", "heartbeat", "connected_at", "last_seen")
+
+    def __init__(self, websocket: WebSocket):
+        self.id = uuid.uuid4().hex[:16]
+        self.websocket = websocket
+        self.username: Union[str, None] = None
+        self.writer = None              # the connection's FrameWriter, pings go through its queue
+        self.heartbeat = False          # the client answers {"type": "ping"} with {"action": "pong"}
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    """
+    Open WebSockets by connection id and by user. A heartbeat task drops entries of sockets
+    that ended on any path, pings clients that asked for it and closes those that stopped
+    answering. Every operation is O(1) per connection, so it holds tens of thousands.
+    """
+    def __init__(self, ping_interval: float = 30.0, idle_timeout: float = 90.0, send_timeout: float = 5.0):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout        # seconds without a message before a heartbeat client is closed
+        self.send_timeout = send_timeout        # per socket, in broadcasts
+        self._connections: dict[str, Connection] = {}
+        self._by_user: dict[str, set[str]] = {}
+        self.reaped = 0
+
+    def configure(self, env: dict):
+        self.ping_interval = float(env.get("HEARTBEAT_INTERVAL", "30"))
+        self.idle_timeout = float(env.get("HEARTBEAT_TIMEOUT", "90"))
+        self.send_timeout = float(env.get("BROADCAST_TIMEOUT", "5"))
 
-    async def connect(self, websocket: WebSocket):
+    def __len__(self):
+        return len(self._connections)
+
+    async def connect(self, websocket: WebSocket) -> Connection:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = Connection(websocket)
+        self._connections[connection.id] = connection
+        return connection
+
+    def identify(self, connection: Connection, username: str):
+        # called once the token is verified
+        connection.username = username
+        self._by_user.setdefault(username, set()).add(connection.id)
+
+    def disconnect(self, connection: Connection):
+        # safe to call more than once
+        if self._connections.pop(connection.id, None) is None:
+            return
+        if connection.username is not None:
+            ids = self._by_user.get(connection.username)
+            if ids is not None:
+                ids.discard(connection.id)
+                if not ids:
+                    del self._by_user[connection.username]
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def touch(self, connection: Connection):
+        connection.last_seen = time.monotonic()
+
+    def get(self, connection_id: str) -> Union[Connection, None]:
+        return self._connections.get(connection_id)
+
+    def for_user(self, username: str) -> list[Connection]:
+        return [self._connections[i] for i in self._by_user.get(username, ())]
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    async def broadcast(self, message: str) -> int:
+        """Send to all connections at once. Sockets that fail or take longer than send_timeout are dropped."""
+        connections = list(self._connections.values())
+        results = await asyncio.gather(*(self._send(c, message) for c in connections))
+        return sum(results)
+
+    async def _send(self, connection: Connection, message: str) -> bool:
+        try:
+            await asyncio.wait_for(connection.websocket.send_text(message), self.send_timeout)
+            return True
+        except Exception:
+            await self._reap(connection)
+            return False
+
+    async def _reap(self, connection: Connection):
+        self.disconnect(connection)
+        self.reaped += 1
+        if connection.websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await asyncio.wait_for(connection.websocket.close(code=1001), self.send_timeout)
+            except Exception:
+                pass
+
+    async def heartbeat(self):
+        """Runs for the life of the server"""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                log.warning("Heartbeat failed: %s", e)
+
+    async def sweep(self):
+        now = time.monotonic()
+        silent = []
+        for connection in list(self._connections.values()):
+            websocket = connection.websocket
+            if websocket.client_state != WebSocketState.CONNECTED or \
+                    websocket.application_state != WebSocketState.CONNECTED:
+                self.disconnect(connection)     # ended without passing through disconnect()
+                self.reaped += 1
+            elif connection.heartbeat:
+                if now - connection.last_seen > self.idle_timeout:
+                    silent.append(connection)
+                elif connection.writer is not None:
+                    try:
+                        await connection.writer.send({"type": "ping"})     # only queued, never waits for the socket
+                    except Exception:
+                        silent.append(connection)
+        await asyncio.gather(*(self._reap(c) for c in silent))
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self._connections),
+            "users": len(self._by_user),
+            "heartbeat": sum(1 for c in self._connections.values() if c.heartbeat),
+            "reaped": self.reaped,
+        }
@@ -0,0 +1,172 @@
+"""
+Worker State
+What the uvicorn workers of one host share when the server runs with --workers N. It is kept
+in small JSON files under WORKER_STATE_DIR and guarded by fcntl locks, which the kernel drops
+when a process dies, so a crashed worker never leaves a lock behind.
+    - one worker is elected leader and runs the hourly Leither checks
+    - the Leither session id is refreshed by one worker and read by all
+    - every worker publishes its connection count every few seconds, /server/status shows the sum
+    - per-user locks serialize balance updates across connections and processes
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Optional
+
+log = logging.getLogger("secretari.ws")
+
+
+class WorkerState:
+    """Shared state of the workers on this host, in files under `directory`"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.pid = os.getpid()
+        self._leader_fd: Optional[int] = None
+        self._user_locks: dict[str, list] = {}      # username -> [asyncio.Lock, holders and waiters]
+        self.lock_waits = 0                         # user locks that had to wait for another holder
+        for sub in ("", "workers", "locks"):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    @classmethod
+    def from_env(cls, env: dict) -> "WorkerState":
+        return cls(env.get("WORKER_STATE_DIR") or "/tmp/secretari-workers")
+
+    def _path(self, *parts: str) -> str:
+        return os.path.join(self.directory, *parts)
+
+    # leader election
+
+    def is_leader(self) -> bool:
+        """True in the one worker holding the leader lock. Others take over when it dies."""
+        if self._leader_fd is not None:
+            return True
+        fd = os.open(self._path("leader.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._leader_fd = fd    # held, open, for the life of the process
+        os.ftruncate(fd, 0)
+        os.write(fd, str(self.pid).encode())
+        log.info("Worker %s elected leader", self.pid)
+        return True
+
+    # shared values
+
+    def read(self, name: str) -> Optional[dict]:
+        try:
+            with open(self._path(name + ".json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write(self, name: str, value: dict) -> None:
+        # written aside and renamed, so readers never see half a file
+        path = self._path(name + ".json")
+        tmp = f"{path}.{self.pid}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+
+    @contextmanager
+    def locked(self, name: str):
+        """Blocking lock across workers, for short critical sections outside the event loop's hot path"""
+        fd = os.open(self._path(name + ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)    # closing drops the lock
+
+    # connection counts
+
+    def set_connections(self, count: int) -> None:
+        self.write(os.path.join("workers", str(self.pid)), {"connections": count, "time": time.time()})
+
+    async def publish_connections(self, count: Callable[[], int], interval: float = 2.0) -> None:
+        """Runs for the life of the worker. Writes the count, on a thread, when it changed since the last write."""
+        published = None
+        while True:
+            current = count()
+            if current != published:
+                try:
+                    await asyncio.to_thread(self.set_connections, current)
+                    published = current
+                except OSError as e:
+                    log.warning("Connection count not published: %s", e)
+            await asyncio.sleep(interval)
+
+    def connections(self) -> dict:
+        """Open connections per live worker, by pid. Files of dead workers are removed."""
+        counts = {}
+        for entry in os.listdir(self._path("workers")):
+            if not entry.endswith(".json"):
+                continue
+            pid = int(entry[:-5])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                try:
+                    os.remove(self._path("workers", entry))
+                except FileNotFoundError:
+                    pass
+                continue
+            except PermissionError:
+                pass    # alive, run by another user
+            value = self.read(os.path.join("workers", str(pid)))
+            if value is not None:
+                counts[pid] = value["connections"]
+        return counts
+
+    # per-user locks
+
+    @asynccontextmanager
+    async def user_lock(self, username: str):
+        """
+        Exclusive access to a user's account across coroutines and workers. Coroutines of this
+        worker queue on an asyncio lock, only one of them polls the file lock at a time.
+        """
+        entry = self._user_locks.get(username)
+        if entry is None:
+            entry = self._user_locks[username] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                name = hashlib.sha1(username.encode("utf-8")).hexdigest()[:20]
+                fd = os.open(self._path("locks", name + ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    delay = 0.002
+                    while True:
+                        try:
+                            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            if delay == 0.002:
+                                self.lock_waits += 1
+                            await asyncio.sleep(delay)  # held by another worker, never block the loop
+                            delay = min(delay * 2, 0.05)
+                    yield
+                finally:
+                    os.close(fd)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[username]
+
+    def stats(self) -> dict:
+        counts = self.connections()
+        return {
+            "pid": self.pid,
+            "leader": self._leader_fd is not None,
+            "workers": len(counts),
+            "connections": sum(counts.values()),
+            "user_lock_waits": self.lock_waits,
+        }
@@ -0,0 +1,307 @@
+"""
+WebSocket Frame Writer
+Encodes the messages of one connection in the framing negotiated at connect time,
+and optionally coalesces stream deltas into fewer, larger frames.
+
+Framings:
+    json     one JSON text frame per message. The default, and what old clients expect.
+    msgpack  one msgpack binary frame per message. Needs the msgpack package.
+    lp       binary frames holding one or more length-prefixed records:
+             1 byte record type, 4 byte big-endian payload length, payload.
+             Type 1 is a stream delta as raw UTF-8, type 0 is any other message as JSON.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+import time
+from collections import deque
+from typing import Optional
+
+from fastapi import WebSocket
+from fastapi.websockets import WebSocketState
+
+from metrics import SEND_QUEUE_DEPTH, SEND_QUEUE_MESSAGES, SLOW_CONSUMERS, STREAM_DELTAS_SHED
+from stream_buffer import DELTA_TYPES
+
+log = logging.getLogger("secretari.ws")
+
+try:
+    import msgpack
+except ImportError:     # optional, only needed by clients asking for msgpack framing
+    msgpack = None
+
+FRAMINGS = ("json", "msgpack", "lp")
+SLOW_CLIENT_POLICIES = ("coalesce", "results")
+RECORD_MESSAGE = 0
+RECORD_STREAM = 1
+
+
+def negotiate_framing(requested: str) -> str:
+    """Framing to use for a client that asked for `requested`. Falls back to json."""
+    if requested not in FRAMINGS or (requested == "msgpack" and msgpack is None):
+        return "json"
+    return requested
+
+
+class FrameWriter:
+    """
+    Sends the messages of one connection from its own sender task, so a slow client never
+    stalls the LLM stream feeding it. Deltas ("stream" and "reduce" messages) may be held back
+    and merged. When more than `max_queue` messages wait for the socket, the client is a slow
+    consumer and:
+        - its deltas are merged into the last queued one of the same request ("coalesce"),
+          or dropped until the queue is empty again ("results": the result message carries
+          the whole answer anyway)
+        - a queue position update replaces the one still queued
+        - any other message waits for room, up to `send_timeout` seconds, after which the
+          client is taken for gone and the socket is closed. These are never dropped.
+    """
+
+    def __init__(self, websocket: WebSocket, framing: str = "json", coalesce_ms: float = 0, coalesce_bytes: int = 0,
+                 max_queue: int = 256, policy: str = "coalesce", send_timeout: float = 30.0):
+        self.websocket = websocket
+        self.framing = negotiate_framing(framing)
+        self.window = coalesce_ms / 1000        # flush deltas at least this often, 0 sends every delta at once
+        self.max_bytes = coalesce_bytes         # flush once this many characters are pending, 0 means no size trigger
+        self.max_queue = max(1, max_queue)
+        self.policy = policy if policy in SLOW_CLIENT_POLICIES else "coalesce"
+        self.send_timeout = send_timeout
+        self._pending: list[str] = []
+        self._pending_fields: dict = {}         # type, and request_id and offset of a resumed request, of the pending deltas
+        self._pending_bytes = 0
+        self._pending_since = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._queue: deque[dict] = deque()
+        self._ready = asyncio.Event()           # set when the queue has messages
+        self._drained = asyncio.Event()         # set when everything queued has been written
+        self._drained.set()
+        self._room = asyncio.Event()            # set when the queue is below max_queue
+        self._room.set()
+        self._sender: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+        self.slow = False                       # in slow consumer mode until the queue is empty again
+        self.frames_sent = 0
+
+    @property
+    def coalescing(self) -> bool:
+        return self.window > 0 or self.max_bytes > 0
+
+    @property
+    def connected(self) -> bool:
+        return self._error is None and self.websocket.client_state == WebSocketState.CONNECTED
+
+    async def send(self, message: dict) -> None:
+        """
+        Queue a message. Pending stream data goes out first, so ordering is kept.
+        Waits while a slow client's queue is full, raises ConnectionError if it stays full.
+        """
+        if message.get("type") in DELTA_TYPES:
+            fields = {k: v for k, v in message.items() if k not in ("type", "data")}
+            await self.stream(message["data"], message["type"], **fields)
+            return
+        if message.get("type") == "queue":
+            self._put(self._take_pending() + [message])     # superseded updates are dropped in _put
+            return
+        await self._wait_for_room()
+        self._put(self._take_pending() + [message])
+
+    async def stream(self, data: str, kind: str = "stream", **fields) -> None:
+        """
+        Send a delta, or hold it back until the coalescing window or byte threshold is reached.
+        `kind` is the message type, "stream" or "reduce". `fields`, such as the request_id and offset
+        of a resumed request, go with the message, pending deltas with other fields are sent first.
+        """
+        fields = {"type": kind} | fields
+        if not self.coalescing:
+            self._put([fields | {"data": data}])
+            return
+
+        if self._pending and fields != self._pending_fields:
+            if fields.keys() == self._pending_fields.keys() and \
+                    all(fields[k] == self._pending_fields[k] for k in fields if k != "offset"):
+                self._pending_fields = fields       # same request, resume after the latest offset
+            else:
+                self._put(self._take_pending())
+        if not self._pending:
+            self._pending_since = time.monotonic()
+            self._pending_fields = fields
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        if (self.max_bytes and self._pending_bytes >= self.max_bytes) or \
+                (self.window and time.monotonic() - self._pending_since >= self.window):
+            await self.flush()
+        elif self._timer is None and self.window:
+            # make sure held back deltas go out even if the LLM stalls
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._on_timer)
+
+    async def flush(self) -> None:
+        self._put(self._take_pending())
+
+    async def drain(self, timeout: Optional[float] = None) -> None:
+        """Wait until everything queued has been written, e.g. before closing the socket"""
+        await self.flush()
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.info("Gave up draining %d queued messages", len(self._queue))
+
+    async def aclose(self) -> None:
+        """Write out what is queued, briefly, then stop the sender"""
+        if self.connected:
+            await self.drain(timeout=1.0)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._sender is not None:
+            self._sender.cancel()
+            await asyncio.gather(self._sender, return_exceptions=True)
+            self._sender = None
+        SEND_QUEUE_MESSAGES.dec(len(self._queue))
+        self._queue.clear()
+        self._room.set()
+        if self._error is None:
+            self._error = ConnectionError("connection closed")
+
+    async def _wait_for_room(self) -> None:
+        if self._error is not None:
+            raise self._error
+        if len(self._queue) < self.max_queue:
+            return
+        self._slow_consumer()
+        self._room.clear()
+        try:
+            await asyncio.wait_for(self._room.wait(), self.send_timeout)
+        except asyncio.TimeoutError:
+            log.warning("Client took no messages for %ss, closing", self.send_timeout)
+            self._error = ConnectionError("client not reading")
+            if self._sender is not None:
+                self._sender.cancel()
+            SEND_QUEUE_MESSAGES.dec(len(self._queue))
+            self._queue.clear()
+            self._drained.set()
+            try:
+                await asyncio.wait_for(self.websocket.close(code=1001), 1.0)
+            except Exception:
+                pass
+        if self._error is not None:
+            raise self._error
+
+    def _slow_consumer(self) -> None:
+        if not self.slow:
+            self.slow = True
+            SLOW_CONSUMERS.inc(1, self.policy)
+            log.warning("Slow client, %d messages queued, policy %s", len(self._queue), self.policy)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        if self._error is None:
+            self._put(self._take_pending())
+
+    def _take_pending(self) -> list[dict]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return []
+        data = "".join(self._pending)
+        self._pending.clear()
+        self._pending_bytes = 0
+        return [self._pending_fields | {"data": data}]
+
+    def _put(self, messages: list[dict]) -> None:
+        if self._error is not None:
+            raise self._error
+        for message in messages:
+            kind = message.get("type")
+            if kind == "queue":
+                # only the latest position matters
+                for queued in [m for m in self._queue if m.get("type") == "queue"]:
+                    self._queue.remove(queued)
+                    SEND_QUEUE_MESSAGES.dec()
+            elif kind in DELTA_TYPES and len(self._queue) >= self.max_queue:
+                self._slow_consumer()
+                tail = self._queue[-1]
+                if self.policy == "results":
+                    STREAM_DELTAS_SHED.inc(1, "dropped")
+                    continue
+                if tail.get("type") == kind and tail.get("request_id") == message.get("request_id"):
+                    self._queue[-1] = tail | message | {"data": tail["data"] + message["data"]}
+                    STREAM_DELTAS_SHED.inc(1, "coalesced")
+                    continue
+            if self.slow and self.policy == "results" and kind in DELTA_TYPES:
+                STREAM_DELTAS_SHED.inc(1, "dropped")
+                continue
+            self._queue.append(message)
+            SEND_QUEUE_MESSAGES.inc()
+        if not self._queue:
+            return
+        if len(self._queue) >= self.max_queue:
+            self._room.clear()
+        SEND_QUEUE_DEPTH.observe(len(self._queue))
+        self._drained.clear()
+        self._ready.set()
+        if self._sender is None:
+            self._sender = asyncio.create_task(self._send_loop())
+
+    async def _send_loop(self) -> None:
+        try:
+            while True:
+                await self._ready.wait()
+                # everything queued goes out together, in one frame with lp framing
+                batch = list(self._queue)
+                self._queue.clear()
+                self._ready.clear()
+                SEND_QUEUE_MESSAGES.dec(len(batch))
+                self._room.set()
+                await self._write(batch)
+                if not self._queue:
+                    self.slow = False
+                    self._drained.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the client is gone. Producers see it in `connected`, or get this error on their next send.
+            self._error = e
+            SEND_QUEUE_MESSAGES.dec(len(self._queue))
+            self._queue.clear()
+            self._drained.set()
+            self._room.set()
+            log.info("WebSocket send failed: %s", e)
+
+    async def _write(self, messages: list[dict]) -> None:
+        if not messages:
+            return
+        if self.framing == "json":
+            for message in messages:
+                await self.websocket.send_text(json.dumps(message))
+                self.frames_sent += 1
+        elif self.framing == "msgpack":
+            for message in messages:
+                await self.websocket.send_bytes(msgpack.packb(message))
+                self.frames_sent += 1
+        else:
+            await self.websocket.send_bytes(b"".join(encode_record(m) for m in messages))
+            self.frames_sent += 1
+
+
+def encode_record(message: dict) -> bytes:
+    """One length-prefixed record of the lp framing"""
+    if message.get("type") == "stream" and len(message) == 2:
+        kind, payload = RECORD_STREAM, message["data"].encode("utf-8")
+    else:
+        kind, payload = RECORD_MESSAGE, json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return struct.pack(">BI", kind, len(payload)) + payload
+
+
+def decode_records(frame: bytes) -> list[dict]:
+    """Inverse of encode_record over a whole binary frame. Used by test clients and benchmarks."""
+    messages, offset = [], 0
+    while offset < len(frame):
+        kind, length = struct.unpack_from(">BI", frame, offset)
+        offset += 5
+        payload = frame[offset:offset + length].decode("utf-8")
+        offset += length
+        messages.append({"type": "stream", "data": payload} if kind == RECORD_STREAM else json.loads(payload))
+    return messages
@@ -0,0 +1,46 @@
+"""
+WebSocket Disconnect Watch
+Runs a piece of work, e.g. summarizing a transcript, while listening on the socket. When
+the client goes away the work is cancelled at once, instead of streaming into a closed
+connection until every chunk has been paid for.
+"""
+
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from fastapi import WebSocket
+
+
+async def run_until_disconnect(websocket: WebSocket, work: Awaitable, backlog: deque,
+                               on_receive: Optional[Callable[[], None]] = None) -> bool:
+    """
+    Await `work` and return False, or cancel it and return True as soon as the client
+    disconnects. Messages that arrive meanwhile, text or binary, are appended to `backlog`
+    for the receive loop, and `on_receive` is called for each. Exceptions of the work are raised.
+    """
+    task = asyncio.ensure_future(work)
+    receiver = None
+    try:
+        while True:
+            receiver = asyncio.ensure_future(websocket.receive())
+            done, _ = await asyncio.wait({task, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver not in done:
+                task.result()
+                return False
+            message = receiver.result()
+            if message["type"] == "websocket.disconnect":
+                return True
+            if on_receive is not None:
+                on_receive()
+            if message.get("text") is not None:
+                backlog.append(message["text"])
+            elif message.get("bytes") is not None:
+                backlog.append(message["bytes"])    # an upload fragment
+    finally:
+        # cancelling a pending receive loses no message, it stays queued by the server
+        if receiver is not None and not receiver.done():
+            receiver.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)